@@ -103,6 +103,9 @@ def parse_options(argv):
                       help=_("use the given interface"))
     parser.add_option("--ignore-locks", action="store_true",
                       help=_("don't respect locking"))
+    parser.add_option("--profile-solver", metavar=_("FILE"),
+                      help=_("write statistics about the dependency "
+                             "solver to FILE, in JSON format"))
     parser.add_option("-o", "--option", action="append", default=[],
                       metavar=_("OPT"),
                       help=_("set the option given by a name=value pair"))
@@ -176,6 +179,8 @@ def main(argv):
                     loglevel=opts.log_level)
         if opts.option:
             set_config_options(opts.option)
+        if opts.profile_solver:
+            sysconf.set("profile-solver", opts.profile_solver, soft=True)
         initDistro(ctrl)
         initPlugins()
         initPycurl()
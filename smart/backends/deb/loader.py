@@ -22,7 +22,7 @@
 #
 from smart.cache import Loader, PackageInfo
 from smart.util.strtools import globdistance
-from smart.util.tagfile import TagFile
+from smart.util.tagfile import TagFile, TagSection
 from smart.channel import FileChannel
 from smart.backends.deb.debver import parserelation, parserelations
 from smart.backends.deb.base import *
@@ -155,6 +155,7 @@ class DebTagLoader(Loader):
 
     def reset(self):
         Loader.reset(self)
+        self._sections.clear()
 
     def load(self):
         Pkg = DebPackage
@@ -324,6 +325,8 @@ class DebTagFileLoader(DebTagLoader):
     _filelistsname = None
     _changelogname = None
 
+    _loadattrs = ("_sections",)
+
     def __init__(self, filename, baseurl=None, filelistsname="", changelogname=""):
         DebTagLoader.__init__(self, baseurl)
         self._filename = filename
@@ -347,9 +350,7 @@ class DebTagFileLoader(DebTagLoader):
             lastoffset = offset
 
     def getDict(self, pkg):
-        self._tagfile.setOffset(pkg.loaders[self])
-        self._tagfile.advanceSection()
-        return self._tagfile.copy()
+        return TagSection(self._tagfile, pkg.loaders[self])
 
     def getFileName(self, info):
         return info._dict.get("filename")
@@ -473,6 +473,8 @@ class RPMHeaderLoader(Loader):
 
 class RPMHeaderListLoader(RPMHeaderLoader):
 
+    _loadattrs = ("_offsets", "_groups")
+
     def __init__(self, filename, baseurl, count=None):
         RPMHeaderLoader.__init__(self)
         self._filename = filename
@@ -32,6 +32,9 @@ except ImportError:
     except ImportError:     
         from smart.util import cElementTree
 
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+
 from smart import *
 import posixpath
 import locale
@@ -43,15 +46,52 @@ NS_FILELISTS = "http://linux.duke.edu/metadata/filelists"
 
 BYTESPERPKG = 3000
 
+COMPMAP = { "EQ":"=", "LT":"<", "LE":"<=", "GT":">", "GE":">="}
+
 def nstag(ns, tag):
     return "{%s}%s" % (ns, tag)
 
+def nsname(ns, tag):
+    # Names of elements as given by expat when namespaces are
+    # separated by a space.
+    return "%s %s" % (ns, tag)
+
+PACKAGE     = nsname(NS_COMMON, "package")
+NAME        = nsname(NS_COMMON, "name")
+ARCH        = nsname(NS_COMMON, "arch")
+VERSION     = nsname(NS_COMMON, "version")
+SUMMARY     = nsname(NS_COMMON, "summary")
+DESCRIPTION = nsname(NS_COMMON, "description")
+URL         = nsname(NS_COMMON, "url")
+TIME        = nsname(NS_COMMON, "time")
+SIZE        = nsname(NS_COMMON, "size")
+LOCATION    = nsname(NS_COMMON, "location")
+CHECKSUM    = nsname(NS_COMMON, "checksum")
+FILE        = nsname(NS_COMMON, "file")
+SOURCERPM   = nsname(NS_RPM, "sourcerpm")
+GROUP       = nsname(NS_RPM, "group")
+LICENSE     = nsname(NS_RPM, "license")
+ENTRY       = nsname(NS_RPM, "entry")
+REQUIRES    = nsname(NS_RPM, "requires")
+RECOMMENDS  = nsname(NS_RPM, "recommends")
+PROVIDES    = nsname(NS_RPM, "provides")
+CONFLICTS   = nsname(NS_RPM, "conflicts")
+OBSOLETES   = nsname(NS_RPM, "obsoletes")
+DISTTAG     = nsname(NS_RPM, "disttag")
+DISTEPOCH   = nsname(NS_RPM, "distepoch")
+
 class RPMMetaDataPackageInfo(PackageInfo):
 
-    def __init__(self, package, loader, info):
+    class LazyInfo(object):
+        def __get__(self, obj, type):
+            obj._info = obj._loader.getDict(obj._package)
+            return obj._info
+
+    _info = LazyInfo()
+
+    def __init__(self, package, loader):
         PackageInfo.__init__(self, package)
         self._loader = loader
-        self._info = info
 
     def getURLs(self):
         url = self._info.get("location")
@@ -101,7 +141,9 @@ class RPMMetaDataPackageInfo(PackageInfo):
 
 class RPMMetaDataLoader(Loader):
 
-    __stateversion__ = Loader.__stateversion__+3
+    __stateversion__ = Loader.__stateversion__+4
+
+    _loadattrs = ("_fileprovides", "_pkgids", "_namespaces")
  
     def __init__(self, filename, filelistsname, baseurl):
         Loader.__init__(self)
@@ -111,6 +153,7 @@ class RPMMetaDataLoader(Loader):
         self._fileprovides = {}
         self._parsedflist = False
         self._pkgids = {}
+        self._namespaces = {}
 
     def reset(self):
         Loader.reset(self)
@@ -119,283 +162,28 @@ class RPMMetaDataLoader(Loader):
         self._pkgids.clear()
 
     def getInfo(self, pkg):
-        return RPMMetaDataPackageInfo(pkg, self, pkg.loaders[self])
+        return RPMMetaDataPackageInfo(pkg, self)
+
+    def getDict(self, pkg):
+        offset, length = pkg.loaders[self]
+        file = open(self._filename)
+        try:
+            file.seek(offset)
+            data = file.read(length)
+        finally:
+            file.close()
+        return parseInfo(data, self._namespaces)
 
     def getLoadSteps(self):
         return os.path.getsize(self._filename)/BYTESPERPKG
 
     def load(self):
-        METADATA    = nstag(NS_COMMON, "metadata")
-        PACKAGE     = nstag(NS_COMMON, "package")
-        NAME        = nstag(NS_COMMON, "name")
-        ARCH        = nstag(NS_COMMON, "arch")
-        VERSION     = nstag(NS_COMMON, "version")
-        SUMMARY     = nstag(NS_COMMON, "summary")
-        DESCRIPTION = nstag(NS_COMMON, "description")
-        URL         = nstag(NS_COMMON, "url")
-        TIME        = nstag(NS_COMMON, "time")
-        SIZE        = nstag(NS_COMMON, "size")
-        LOCATION    = nstag(NS_COMMON, "location")
-        FORMAT      = nstag(NS_COMMON, "format")
-        CHECKSUM    = nstag(NS_COMMON, "checksum")
-        FILE        = nstag(NS_COMMON, "file")
-        SOURCERPM   = nstag(NS_RPM, "sourcerpm")
-        GROUP       = nstag(NS_RPM, "group")
-        LICENSE     = nstag(NS_RPM, "license")
-        ENTRY       = nstag(NS_RPM, "entry")
-        REQUIRES    = nstag(NS_RPM, "requires")
-        RECOMMENDS  = nstag(NS_RPM, "recommends")
-        PROVIDES    = nstag(NS_RPM, "provides")
-        CONFLICTS   = nstag(NS_RPM, "conflicts")
-        OBSOLETES   = nstag(NS_RPM, "obsoletes")
-        DISTTAG     = nstag(NS_RPM, "disttag")
-        DISTEPOCH   = nstag(NS_RPM, "distepoch")
-
-        COMPMAP = { "EQ":"=", "LT":"<", "LE":"<=", "GT":">", "GE":">="}
-
-        # Prepare progress reporting.
-        lastoffset = 0
-        mod = 0
-        progress = iface.getProgress(self._cache)
-
-        # Prepare package information.
-        name = None
-        version = None
-        arch = None
-        disttag = None
-        distepoch = None
-        info = {}
-        reqdict = {}
-        recdict = {}
-        prvdict = {}
-        upgdict = {}
-        cnfdict = {}
-        filedict = {}
-
-        # Prepare data useful for the iteration
-        skip = None
-        queue = []
-
+        self._namespaces = {}
         file = open(self._filename)
-        for event, elem in cElementTree.iterparse(file, ("start", "end")):
-            tag = elem.tag
-
-            if event == "start":
-
-                if not skip and tag == PACKAGE:
-                    if elem.get("type") != "rpm":
-                        skip = PACKAGE
-
-                queue.append(elem)
-
-            elif event == "end":
-
-                popped = queue.pop()
-                assert popped is elem
-
-                if skip:
-                    if tag == skip:
-                        skip = None
-
-                elif tag == ARCH:
-                    if getArchScore(elem.text) == 0:
-                        skip = PACKAGE
-                    else:
-                        arch = elem.text
-
-                elif tag == NAME:
-                    name = elem.text
-
-                elif tag == VERSION:
-                    e = elem.get("epoch")
-                    if e and e != "0":
-                        version = "%s:%s-%s" % \
-                                  (e, elem.get("ver"), elem.get("rel"))
-                    else:
-                        version = "%s-%s" % \
-                                  (elem.get("ver"), elem.get("rel"))
-
-                elif tag == DISTTAG:
-                    disttag = elem.text
-
-                elif tag == DISTEPOCH:
-                    distepoch = elem.text
-
-                elif tag == SUMMARY:
-                    if elem.text:
-                        info["summary"] = elem.text
-
-                elif tag == DESCRIPTION:
-                    if elem.text:
-                        info["description"] = elem.text
-
-                elif tag == URL:
-                    if elem.text:
-                        info["url"] = elem.text
-
-                elif tag == TIME:
-                    info["time"] = int(elem.get("file"))
-                    info["build_time"] = int(elem.get("build"))
-
-                elif tag == SIZE:
-                    info["size"] = int(elem.get("package"))
-                    if elem.get("installed"):
-                        info["installed_size"] = int(elem.get("installed"))
-
-                elif tag == CHECKSUM:
-                    info[elem.get("type")] = elem.text
-                    if elem.get("pkgid") == "YES":
-                        pkgid = elem.text
-
-                elif tag == LOCATION:
-                    info["location"] = elem.get("href")
-
-                elif tag == SOURCERPM:
-                    if elem.text:
-                        info["sourcerpm"] = elem.text
-
-                elif tag == GROUP:
-                    if elem.text:
-                        info["group"] = elem.text
-
-                elif tag == LICENSE:
-                    if elem.text:
-                        info["license"] = elem.text
-
-                elif tag == FILE:
-                    filedict[elem.text] = True
-
-                elif tag == ENTRY:
-                    ename = elem.get("name")
-                    if (not ename or
-                        ename[:7] in ("rpmlib(", "config(")):
-                        continue
-
-                    if "ver" in elem.keys():
-                        e = elem.get("epoch")
-                        v = elem.get("ver")
-                        r = elem.get("rel")
-                        eversion = v
-                        if e and e != "0":
-                            eversion = "%s:%s" % (e, eversion)
-                        if r:
-                            eversion = "%s-%s" % (eversion, r)
-                        if "flags" in elem.keys():
-                            erelation = COMPMAP.get(elem.get("flags"))
-                        else:
-                            erelation = None
-                    else:
-                        eversion = None
-                        erelation = None
-
-                    lasttag = queue[-1].tag
-                    if lasttag == REQUIRES:
-                        if elem.get("pre") == "1":
-                            reqdict[(RPMPreRequires,
-                                     ename, erelation, eversion)] = True
-                        elif elem.get("hint") == "1" or elem.get("missingok") == "1":
-                            recdict[(RPMRequires,
-                                     ename, erelation, eversion)] = True
-                        else:
-                            reqdict[(RPMRequires,
-                                     ename, erelation, eversion)] = True
-
-                    elif lasttag == RECOMMENDS:
-                        recdict[(RPMRequires,
-                                 ename, erelation, eversion)] = True
-
-                    elif lasttag == PROVIDES:
-                        if ename[0] == "/":
-                            filedict[ename] = True
-                        else:
-                            if ename == name and checkver(eversion, version):
-                                eversion = "%s@%s" % (eversion, arch)
-                                Prv = RPMNameProvides
-                            else:
-                                Prv = RPMProvides
-                            prvdict[(Prv, ename.encode('utf-8'), eversion)] = True
-
-                    elif lasttag == OBSOLETES:
-                        tup = (RPMObsoletes, ename, erelation, eversion)
-                        upgdict[tup] = True
-                        cnfdict[tup] = True
-
-                    elif lasttag == CONFLICTS:
-                        cnfdict[(RPMConflicts,
-                                 ename, erelation, eversion)] = True
-                                    
-                elif elem.tag == PACKAGE:
-
-                    # Use all the information acquired to build the package.
-
-                    versionarch = "%s@%s" % (version, arch)
-
-                    upgdict[(RPMObsoletes,
-                             name, '<', versionarch)] = True
-
-                    reqargs = [x for x in reqdict
-                               if not ((x[2] is None or "=" in x[2]) and
-                                       (RPMProvides, x[1], x[3]) in prvdict or
-                                       system_provides.match(x[1], x[2], x[3]))]
-                    reqargs = collapse_libc_requires(reqargs)
-
-                    recargs = [x for x in recdict
-                               if not ((x[2] is None or "=" in x[2]) and
-                                       (RPMProvides, x[1], x[3]) in prvdict or
-                                       system_provides.match(x[1], x[2], x[3]))]
-
-                    prvargs = prvdict.keys()
-                    cnfargs = cnfdict.keys()
-                    upgargs = upgdict.keys()
-
-                    if disttag:
-                        distversion = "%s-%s" % (version, disttag)
-                        if distepoch:
-                            distversion += distepoch
-                        versionarch = "%s@%s" % (distversion, arch)
-
-                    pkg = self.buildPackage((RPMPackage, name, versionarch),
-                                            prvargs, reqargs, upgargs, cnfargs, recargs)
-                    pkg.loaders[self] = info
-
-                    # Store the provided files for future usage.
-                    if filedict:
-                        for filename in filedict:
-                            lst = self._fileprovides.get(filename)
-                            if not lst:
-                                self._fileprovides[filename] = [pkg]
-                            else:
-                                lst.append(pkg)
-
-                    if pkgid:
-                        self._pkgids[pkgid] = pkg
-
-                    # Reset all information.
-                    name = None
-                    version = None
-                    arch = None
-                    disttag = None
-                    distepoch = None
-                    pkgid = None
-                    reqdict.clear()
-                    recdict.clear()
-                    prvdict.clear()
-                    upgdict.clear()
-                    cnfdict.clear()
-                    filedict.clear()
-                    # Do not clear it. pkg.loaders has a reference.
-                    info = {}
-
-                    # Update progress
-                    offset = file.tell()
-                    div, mod = divmod(offset-lastoffset+mod, BYTESPERPKG)
-                    lastoffset = offset
-                    progress.add(div)
-                    progress.show()
-
-                elem.clear()
-
-        file.close()
+        try:
+            PrimaryParser(self).parse(file)
+        finally:
+            file.close()
 
     def loadFileProvides(self, fndict):
         bfp = self.buildFileProvides
@@ -451,8 +239,310 @@ class RPMMetaDataLoader(Loader):
                 elem.clear()
         file.close()
 
+class PrimaryParser(object):
+    """
+    Streaming parser of primary.xml files, building the packages of
+    the loader as their elements end. Packages keep where their element
+    is in the file, rather than their information, which is parsed by
+    parseInfo() when asked for.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._buildPackage = loader.buildPackage
+        self._parser = None
+
+        self._lastoffset = 0
+        self._mod = 0
+        self._progress = None
+
+        self._skip = False
+        self._text = None
+
+        self._reqdict = {}
+        self._recdict = {}
+        self._prvdict = {}
+        self._upgdict = {}
+        self._cnfdict = {}
+        self._filedict = {}
+
+        self.resetPackage()
+
+    def resetPackage(self):
+        self._offset = None
+        self._name = None
+        self._version = None
+        self._arch = None
+        self._disttag = None
+        self._distepoch = None
+        self._pkgid = None
+        self._relations = None
+        self._reqdict.clear()
+        self._recdict.clear()
+        self._prvdict.clear()
+        self._upgdict.clear()
+        self._cnfdict.clear()
+        self._filedict.clear()
+
+    def startNamespace(self, prefix, uri):
+        self._loader._namespaces[prefix] = uri
+
+    def startElement(self, name, attrs):
+        if self._skip:
+            return
+        if name == ENTRY:
+            self.handleEntry(attrs)
+        elif name in (NAME, ARCH, FILE, DISTTAG, DISTEPOCH):
+            self._text = []
+        elif name in (REQUIRES, RECOMMENDS, PROVIDES, OBSOLETES, CONFLICTS):
+            self._relations = name
+        elif name == VERSION:
+            e = attrs.get("epoch")
+            if e and e != "0":
+                self._version = "%s:%s-%s" % \
+                                (e, attrs.get("ver"), attrs.get("rel"))
+            else:
+                self._version = "%s-%s" % (attrs.get("ver"), attrs.get("rel"))
+        elif name == CHECKSUM:
+            if attrs.get("pkgid") == "YES":
+                self._text = []
+        elif name == PACKAGE:
+            if attrs.get("type") != "rpm":
+                self._skip = True
+            else:
+                self.resetPackage()
+                self._offset = self._parser.CurrentByteIndex
+
+    def endElement(self, name):
+        if self._skip:
+            if name == PACKAGE:
+                self._skip = False
+            return
+        if self._text is not None:
+            data = "".join(self._text)
+            self._text = None
+            if name == FILE:
+                self._filedict[data] = True
+            elif name == NAME:
+                self._name = intern(data)
+            elif name == ARCH:
+                if getArchScore(data) == 0:
+                    self._skip = True
+                else:
+                    self._arch = intern(data)
+            elif name == CHECKSUM:
+                self._pkgid = data
+            elif name == DISTTAG:
+                self._disttag = data
+            elif name == DISTEPOCH:
+                self._distepoch = data
+        elif name == self._relations:
+            self._relations = None
+        elif name == PACKAGE:
+            self.handlePackageEnd()
+
+    def charData(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def handleEntry(self, attrs):
+        relations = self._relations
+        if relations is None:
+            return
+        ename = attrs.get("name")
+        if not ename or ename[:7] in ("rpmlib(", "config("):
+            return
+        ename = intern(ename)
+
+        if "ver" in attrs:
+            e = attrs.get("epoch")
+            v = attrs.get("ver")
+            r = attrs.get("rel")
+            eversion = v
+            if e and e != "0":
+                eversion = "%s:%s" % (e, eversion)
+            if r:
+                eversion = "%s-%s" % (eversion, r)
+            if "flags" in attrs:
+                erelation = COMPMAP.get(attrs.get("flags"))
+            else:
+                erelation = None
+        else:
+            eversion = None
+            erelation = None
+
+        if relations == REQUIRES:
+            if attrs.get("pre") == "1":
+                self._reqdict[(RPMPreRequires,
+                               ename, erelation, eversion)] = True
+            elif attrs.get("hint") == "1" or attrs.get("missingok") == "1":
+                self._recdict[(RPMRequires,
+                               ename, erelation, eversion)] = True
+            else:
+                self._reqdict[(RPMRequires,
+                               ename, erelation, eversion)] = True
+
+        elif relations == RECOMMENDS:
+            self._recdict[(RPMRequires, ename, erelation, eversion)] = True
+
+        elif relations == PROVIDES:
+            if ename[0] == "/":
+                self._filedict[ename] = True
+            else:
+                if ename == self._name and checkver(eversion, self._version):
+                    eversion = "%s@%s" % (eversion, self._arch)
+                    Prv = RPMNameProvides
+                else:
+                    Prv = RPMProvides
+                self._prvdict[(Prv, ename, eversion)] = True
+
+        elif relations == OBSOLETES:
+            tup = (RPMObsoletes, ename, erelation, eversion)
+            self._upgdict[tup] = True
+            self._cnfdict[tup] = True
+
+        elif relations == CONFLICTS:
+            self._cnfdict[(RPMConflicts, ename, erelation, eversion)] = True
+
+    def handlePackageEnd(self):
+        name = self._name
+        version = self._version
+        arch = self._arch
+        prvdict = self._prvdict
+
+        versionarch = "%s@%s" % (version, arch)
+
+        self._upgdict[(RPMObsoletes, name, '<', versionarch)] = True
+
+        reqargs = [x for x in self._reqdict
+                   if not ((x[2] is None or "=" in x[2]) and
+                           (RPMProvides, x[1], x[3]) in prvdict or
+                           system_provides.match(x[1], x[2], x[3]))]
+        reqargs = collapse_libc_requires(reqargs)
+
+        recargs = [x for x in self._recdict
+                   if not ((x[2] is None or "=" in x[2]) and
+                           (RPMProvides, x[1], x[3]) in prvdict or
+                           system_provides.match(x[1], x[2], x[3]))]
+
+        prvargs = prvdict.keys()
+        cnfargs = self._cnfdict.keys()
+        upgargs = self._upgdict.keys()
+
+        if self._disttag:
+            distversion = "%s-%s" % (version, self._disttag)
+            if self._distepoch:
+                distversion += self._distepoch
+            versionarch = "%s@%s" % (distversion, arch)
+
+        loader = self._loader
+        pkg = self._buildPackage((RPMPackage, name, versionarch),
+                                 prvargs, reqargs, upgargs, cnfargs, recargs)
+        offset = self._parser.CurrentByteIndex
+        pkg.loaders[loader] = (self._offset, offset-self._offset)
+
+        # Store the provided files for future usage.
+        fileprovides = loader._fileprovides
+        for filename in self._filedict:
+            lst = fileprovides.get(filename)
+            if not lst:
+                fileprovides[filename] = [pkg]
+            else:
+                lst.append(pkg)
+
+        if self._pkgid:
+            loader._pkgids[self._pkgid] = pkg
+
+        self.resetPackage()
+
+        div, self._mod = divmod(offset-self._lastoffset+self._mod,
+                                BYTESPERPKG)
+        self._lastoffset = offset
+        self._progress.add(div)
+        self._progress.show()
+
+    def parse(self, file):
+        parser = expat.ParserCreate(namespace_separator=" ")
+        parser.returns_unicode = False
+        parser.buffer_text = True
+        parser.StartNamespaceDeclHandler = self.startNamespace
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.charData
+
+        self._parser = parser
+        self._progress = iface.getProgress(self._loader._cache)
+        try:
+            parser.ParseFile(file)
+        except expat.ExpatError, e:
+            raise Error, _("Invalid XML file:\n  %s\n  %s") % \
+                          (self._loader._filename, unicode(e))
+        finally:
+            self._parser = None
+
+def parseInfo(data, namespaces):
+    """
+    Return the information in the package element data was taken
+    from, in a primary.xml file declaring the given namespaces.
+    """
+    info = {}
+    text = []
+    attributes = {}
+
+    def startElement(name, attrs):
+        del text[:]
+        attributes.clear()
+        attributes.update(attrs)
+        if name == TIME:
+            info["time"] = int(attrs.get("file"))
+            info["build_time"] = int(attrs.get("build"))
+        elif name == SIZE:
+            info["size"] = int(attrs.get("package"))
+            if attrs.get("installed"):
+                info["installed_size"] = int(attrs.get("installed"))
+        elif name == LOCATION:
+            info["location"] = toASCII(attrs.get("href"))
+
+    def endElement(name):
+        if name in TEXTINFO:
+            data = toASCII("".join(text))
+            if data:
+                info[TEXTINFO[name]] = data
+        elif name == CHECKSUM:
+            info[toASCII(attributes.get("type"))] = toASCII("".join(text))
+
+    parser = expat.ParserCreate(namespace_separator=" ")
+    parser.buffer_text = True
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    parser.CharacterDataHandler = text.append
+    decls = []
+    for prefix, uri in namespaces.items():
+        if prefix:
+            decls.append(" xmlns:%s=%s" % (prefix, quoteattr(uri)))
+        else:
+            decls.append(" xmlns=%s" % quoteattr(uri))
+    # Neither the root nor the package element are closed, but it
+    # doesn't matter as long as the parsing isn't told to be done.
+    parser.Parse("<metadata%s>" % "".join(decls))
+    parser.Parse(data)
+    return info
+
+TEXTINFO = {SUMMARY: "summary", DESCRIPTION: "description", URL: "url",
+            SOURCERPM: "sourcerpm", GROUP: "group", LICENSE: "license"}
+
+def toASCII(data):
+    # Give plain strings when possible, as ElementTree would.
+    if data is not None:
+        try:
+            return data.encode("ascii")
+        except UnicodeError:
+            pass
+    return data
+
 def enablePsyco(psyco):
     psyco.bind(RPMMetaDataLoader.load)
+    psyco.bind(PrimaryParser)
     psyco.bind(RPMMetaDataLoader.loadFileProvides)
     psyco.bind(RPMMetaDataLoader.parseFilesList)
 
@@ -89,6 +89,8 @@ class URPMISynthesisLoader(Loader):
 
     __stateversion__ = Loader.__stateversion__+3
 
+    _loadattrs = ()
+
     def __init__(self, filename, baseurl, listfile, infofile=None):
         Loader.__init__(self)
         self._filename = filename
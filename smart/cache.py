@@ -26,6 +26,15 @@ import os
 
 class StateVersionError(Error): pass
 
+def _removeIdentical(lst, obj):
+    # Relations compare equal by name and version only, so
+    # list.remove() could take out the wrong object.
+    for i in range(len(lst)):
+        if lst[i] is obj:
+            del lst[i]
+            return True
+    return False
+
 class Package(object):
 
     def __init__(self, name, version):
@@ -362,6 +371,10 @@ class Conflicts(Depends): pass
 
 class Loader(object):
 
+    # Attributes load() fills in besides the packages, when it may run
+    # in a worker process, so that they're sent back with them.
+    _loadattrs = None
+
     def __init__(self):
         self._packages = []
         self._channel = None
@@ -500,6 +513,8 @@ class Loader(object):
             return
 
         prv.packages.append(pkg)
+        if not pkg.provides:
+            pkg.provides = []
         pkg.provides.append(prv)
 
         for req in pkg.requires[:]:
@@ -513,59 +528,8 @@ class Loader(object):
         # Loaders are responsible for searching on PackageInfo. They
         # should use the fastest possible method. The one here is
         # generic, and should be replaced if possible.
-        ic = searcher.ignorecase
         for pkg in self._packages:
-            info = self.getInfo(pkg)
-            ratio = 0
-            if searcher.url:
-                for url, cutoff in searcher.url:
-                    for refurl in info.getReferenceURLs():
-                        _, newratio = globdistance(url, refurl, cutoff, ic)
-                        if newratio > ratio:
-                            ratio = newratio
-                            if ratio == 1:
-                                break
-                    else:
-                        continue
-                    break
-            if ratio == 1:
-                searcher.addResult(pkg, ratio)
-                continue
-            if searcher.path:
-                for spath, cutoff in searcher.path:
-                    for path in info.getPathList():
-                        _, newratio = globdistance(spath, path, cutoff, ic)
-                        if newratio > ratio:
-                            ratio = newratio
-                            if ratio == 1:
-                                break
-                    else:
-                        continue
-                    break
-            if ratio == 1:
-                searcher.addResult(pkg, ratio)
-                continue
-            if searcher.group:
-                for pat in searcher.group:
-                    if pat.search(info.getGroup()):
-                        ratio = 1
-                        break
-            if ratio == 1:
-                searcher.addResult(pkg, ratio)
-                continue
-            if searcher.summary:
-                for pat in searcher.summary:
-                    if pat.search(info.getSummary()):
-                        ratio = 1
-                        break
-            if ratio == 1:
-                searcher.addResult(pkg, ratio)
-                continue
-            if searcher.description:
-                for pat in searcher.description:
-                    if pat.search(info.getDescription()):
-                        ratio = 1
-                        break
+            ratio = searcher.getInfoRatio(self.getInfo(pkg))
             if ratio:
                 searcher.addResult(pkg, ratio)
 
@@ -593,6 +557,14 @@ class Cache(object):
         self._upgrades = []
         self._conflicts = []
         self._objmap = {}
+        self._prvnames = None
+        self._reqnames = None
+        self._recnames = None
+        self._upgnames = None
+        self._cnfnames = None
+        self._newloaders = []
+        self._byname = {}
+        self._upgindex = None
 
     def reset(self):
         for prv in self._provides:
@@ -628,21 +600,48 @@ class Cache(object):
         del self._upgrades[:]
         del self._conflicts[:]
         self._objmap.clear()
+        self._prvnames = None
+        self._reqnames = None
+        self._recnames = None
+        self._upgnames = None
+        self._cnfnames = None
+        del self._newloaders[:]
+        self._byname.clear()
+        self._upgindex = None
 
     def addLoader(self, loader):
         if loader:
             if loader not in self._loaders:
                 self._loaders.append(loader)
                 loader.setCache(self)
+                if self._prvnames is not None:
+                    self._newloaders.append(loader)
 
     def removeLoader(self, loader):
         if loader:
             if loader in self._loaders:
                 self._loaders.remove(loader)
+                if loader in self._newloaders:
+                    self._newloaders.remove(loader)
                 loader.setCache(None)
                 loader.unload()
 
     def _reload(self):
+        # Packages are recollected from the loaders, so forget about
+        # the ones known so far. Links between relations are kept, and
+        # will be fixed by load() if the cache was already linked.
+        self._byname.clear()
+        self._upgindex = None
+        for prv in self._provides:
+            del prv.packages[:]
+        for req in self._requires:
+            del req.packages[:]
+        for rec in self._recommends:
+            del rec.packages[:]
+        for upg in self._upgrades:
+            del upg.packages[:]
+        for cnf in self._conflicts:
+            del cnf.packages[:]
         packages = {}
         provides = {}
         requires = {}
@@ -695,6 +694,15 @@ class Cache(object):
         self._conflicts[:] = conflicts.keys()
 
     def load(self):
+        # Once the cache is linked, only the difference introduced by
+        # added and removed loaders is linked on further loads.
+        linked = self._prvnames is not None
+        if linked:
+            oldprovides = dict.fromkeys(self._provides, True)
+            oldrequires = dict.fromkeys(self._requires, True)
+            oldrecommends = dict.fromkeys(self._recommends, True)
+            oldupgrades = dict.fromkeys(self._upgrades, True)
+            oldconflicts = dict.fromkeys(self._conflicts, True)
         self._reload()
         prog = iface.getProgress(self)
         prog.start()
@@ -707,13 +715,26 @@ class Cache(object):
                 total += loader.getLoadSteps()
         prog.set(0, total)
         prog.show()
-        for loader in self._loaders:
-            if not loader._packages:
-                loader.load()
-        self.loadFileProvides()
+        from smart.loadpool import loadLoaders
+        for loader in loadLoaders([x for x in self._loaders
+                                   if not x._packages]):
+            if linked and loader not in self._newloaders:
+                self._newloaders.append(loader)
+        if linked:
+            self._loadNewFileProvides(oldrequires)
+        else:
+            self.loadFileProvides()
+        # Loaders may have changed the relation lists while loading.
+        self._byname.clear()
         hooks.call("cache-loaded-pre-link", self)
         self._objmap.clear()
-        self.linkDeps()
+        if linked:
+            self._relinkDeps(oldprovides, oldrequires, oldrecommends,
+                             oldupgrades, oldconflicts)
+        else:
+            self.linkDeps()
+        self._upgindex = None
+        del self._newloaders[:]
         prog.setDone()
         prog.show()
         prog.stop()
@@ -733,6 +754,141 @@ class Cache(object):
         for loader in self._loaders:
             loader.loadFileProvides(fndict)
 
+    def _loadNewFileProvides(self, oldrequires):
+        # Loaders which were already in the cache only have to look
+        # for file names which weren't required before.
+        oldfndict = {}
+        for req in oldrequires:
+            name = req.name
+            if name[0] == "/":
+                oldfndict[name] = name
+        fndict = {}
+        newfndict = {}
+        for req in self._requires:
+            name = req.name
+            if name[0] == "/":
+                fndict[name] = name
+                if name not in oldfndict:
+                    newfndict[name] = name
+        for loader in self._loaders:
+            if loader in self._newloaders:
+                loader.loadFileProvides(fndict)
+            elif newfndict:
+                loader.loadFileProvides(newfndict)
+
+    def _relinkDeps(self, oldprovides, oldrequires, oldrecommends,
+                    oldupgrades, oldconflicts):
+        prvnames = self._prvnames
+        kinds = [(self._requires, oldrequires,
+                  self._reqnames, "requiredby"),
+                 (self._recommends, oldrecommends,
+                  self._recnames, "recommendedby"),
+                 (self._upgrades, oldupgrades,
+                  self._upgnames, "upgradedby"),
+                 (self._conflicts, oldconflicts,
+                  self._cnfnames, "conflictedby")]
+
+        # Unlink provides which are gone.
+        provides = dict.fromkeys(self._provides, True)
+        for prv in oldprovides:
+            if prv not in provides:
+                lst = prvnames[prv.name]
+                _removeIdentical(lst, prv)
+                if not lst:
+                    del prvnames[prv.name]
+                for _, _, _, attr in kinds:
+                    lst = getattr(prv, attr)
+                    if lst:
+                        for dep in lst:
+                            _removeIdentical(dep.providedby, prv)
+                        del lst[:]
+
+        # Unlink dependencies which are gone.
+        newdeps = []
+        for deps, olddeps, names, attr in kinds:
+            current = dict.fromkeys(deps, True)
+            for dep in olddeps:
+                if dep not in current:
+                    for name in dep.getMatchNames():
+                        lst = names[name]
+                        _removeIdentical(lst, dep)
+                        if not lst:
+                            del names[name]
+                    if dep.providedby:
+                        for prv in dict.fromkeys(dep.providedby):
+                            lst = getattr(prv, attr)
+                            while lst and _removeIdentical(lst, dep):
+                                _removeIdentical(dep.providedby, prv)
+            newdeps.append([dep for dep in deps if dep not in olddeps])
+
+        # Link new provides with dependencies which were already there.
+        for prv in self._provides:
+            if prv in oldprovides:
+                continue
+            lst = prvnames.get(prv.name)
+            if lst:
+                lst.append(prv)
+            else:
+                prvnames[prv.name] = [prv]
+            for _, _, names, attr in kinds:
+                lst = names.get(prv.name)
+                if lst:
+                    for dep in lst:
+                        if dep.matches(prv):
+                            if dep.providedby:
+                                dep.providedby.append(prv)
+                            else:
+                                dep.providedby = [prv]
+                            by = getattr(prv, attr)
+                            if by:
+                                by.append(dep)
+                            else:
+                                setattr(prv, attr, [dep])
+
+        # Link new dependencies with all provides.
+        for (_, _, names, attr), deps in zip(kinds, newdeps):
+            for dep in deps:
+                for name in dep.getMatchNames():
+                    lst = names.get(name)
+                    if lst:
+                        lst.append(dep)
+                    else:
+                        names[name] = [dep]
+                    lst = prvnames.get(name)
+                    if lst:
+                        for prv in lst:
+                            if dep.matches(prv):
+                                if dep.providedby:
+                                    dep.providedby.append(prv)
+                                else:
+                                    dep.providedby = [prv]
+                                by = getattr(prv, attr)
+                                if by:
+                                    by.append(dep)
+                                else:
+                                    setattr(prv, attr, [dep])
+
+    def _buildProvidesIndex(self):
+        prvnames = {}
+        for prv in self._provides:
+            lst = prvnames.get(prv.name)
+            if lst:
+                lst.append(prv)
+            else:
+                prvnames[prv.name] = [prv]
+        return prvnames
+
+    def _buildDependsIndex(self, deps):
+        names = {}
+        for dep in deps:
+            for name in dep.getMatchNames():
+                lst = names.get(name)
+                if lst:
+                    lst.append(dep)
+                else:
+                    names[name] = [dep]
+        return names
+
     def linkDeps(self):
         reqnames = {}
         for req in self._requires:
@@ -815,49 +971,101 @@ class Cache(object):
                             prv.conflictedby.append(cnf)
                         else:
                             prv.conflictedby = [cnf]
+        self._prvnames = self._buildProvidesIndex()
+        self._reqnames = reqnames
+        self._recnames = recnames
+        self._upgnames = upgnames
+        self._cnfnames = cnfnames
+        self._upgindex = None
+
+    def _getByName(self, lst, name):
+        # Name indexes are built on first use, and dropped whenever
+        # the lists they were built from are changed.
+        index = self._byname.get(id(lst))
+        if index is None:
+            index = self._byname[id(lst)] = {}
+            for obj in lst:
+                objs = index.get(obj.name)
+                if objs:
+                    objs.append(obj)
+                else:
+                    index[obj.name] = [obj]
+        return index.get(name, [])[:]
 
     def getPackages(self, name=None):
         if not name:
             return self._packages
         else:
-            return [x for x in self._packages if x.name == name]
+            return self._getByName(self._packages, name)
 
     def getProvides(self, name=None):
         if not name:
             return self._provides
         else:
-            return [x for x in self._provides if x.name == name]
+            return self._getByName(self._provides, name)
 
     def getRequires(self, name=None):
         if not name:
             return self._requires
         else:
-            return [x for x in self._requires if x.name == name]
+            return self._getByName(self._requires, name)
 
     def getRecommends(self, name=None):
         if not name:
             return self._recommends
         else:
-            return [x for x in self._recommends if x.name == name]
+            return self._getByName(self._recommends, name)
 
     def getUpgrades(self, name=None):
         if not name:
             return self._upgrades
         else:
-            return [x for x in self._upgrades if x.name == name]
+            return self._getByName(self._upgrades, name)
 
     def getConflicts(self, name=None):
         if not name:
             return self._conflicts
         else:
-            return [x for x in self._conflicts if x.name == name]
+            return self._getByName(self._conflicts, name)
+
+    def getUpgradeIndex(self):
+        """
+        Return an (upgrades, upgradedby) tuple of dictionaries, mapping
+        packages to the list of packages they upgrade, and to the list
+        of packages upgrading them. Packages without such relations are
+        not included.
+
+        The index is built on first use, and dropped whenever packages
+        are relinked, so it must not be modified.
+        """
+        if self._upgindex is None:
+            upgrades = {}
+            upgradedby = {}
+            for pkg in self._packages:
+                for upg in pkg.upgrades:
+                    for prv in upg.providedby:
+                        for prvpkg in prv.packages:
+                            lst = upgrades.get(pkg)
+                            if lst is None:
+                                upgrades[pkg] = [prvpkg]
+                            elif prvpkg in lst:
+                                continue
+                            else:
+                                lst.append(prvpkg)
+                            lst = upgradedby.get(prvpkg)
+                            if lst is None:
+                                upgradedby[prvpkg] = [pkg]
+                            else:
+                                lst.append(pkg)
+            self._upgindex = (upgrades, upgradedby)
+        return self._upgindex
 
     def search(self, searcher):
         if searcher.nameversion:
-            for pkg in self._packages:
+            for pkg in searcher.getNameVersionCandidates(self):
                 pkg.search(searcher)
         if searcher.provides:
-            for prv in self._provides:
+            for prv in searcher.getProvidesCandidates(self):
                 prv.search(searcher)
         if searcher.requires:
             for prv in searcher.requires:
@@ -885,15 +1093,25 @@ class Cache(object):
                         searcher.addResult(cnf)
         if searcher.needsPackageInfo():
             for loader in self._loaders:
-                loader.search(searcher)
+                searcher.searchLoader(loader)
 
-    __stateversion__ = 1
+    __stateversion__ = 2
 
     def __getstate__(self):
         state = {}
         state["__stateversion__"] = self.__stateversion__
         state["_loaders"] = self._loaders
         state["_packages"] = self._packages
+        if self._prvnames is not None:
+            # Save links as well, so that a restored cache doesn't
+            # have to be linked from scratch on its next load.
+            links = []
+            for prv in self._provides:
+                if (prv.requiredby or prv.recommendedby or
+                    prv.upgradedby or prv.conflictedby):
+                    links.append((prv, prv.requiredby, prv.recommendedby,
+                                  prv.upgradedby, prv.conflictedby))
+            state["_links"] = links
         return state
 
     def __setstate__(self, state):
@@ -928,6 +1146,34 @@ class Cache(object):
         self._upgrades = upgrades.keys()
         self._conflicts = conflicts.keys()
         self._objmap = {}
+        self._newloaders = []
+        self._byname = {}
+        self._upgindex = None
+        links = state.get("_links")
+        if links is None:
+            self._prvnames = None
+            self._reqnames = None
+            self._recnames = None
+            self._upgnames = None
+            self._cnfnames = None
+            return
+        for prv, requiredby, recommendedby, upgradedby, conflictedby in links:
+            for attr, deps in (("requiredby", requiredby),
+                               ("recommendedby", recommendedby),
+                               ("upgradedby", upgradedby),
+                               ("conflictedby", conflictedby)):
+                if deps:
+                    setattr(prv, attr, deps)
+                    for dep in deps:
+                        if dep.providedby:
+                            dep.providedby.append(prv)
+                        else:
+                            dep.providedby = [prv]
+        self._prvnames = self._buildProvidesIndex()
+        self._reqnames = self._buildDependsIndex(self._requires)
+        self._recnames = self._buildDependsIndex(self._recommends)
+        self._upgnames = self._buildDependsIndex(self._upgrades)
+        self._cnfnames = self._buildDependsIndex(self._conflicts)
 
 from ccache import *
 
@@ -0,0 +1,237 @@
+#
+# Copyright (c) 2004 Conectiva, Inc.
+#
+# Written by Gustavo Niemeyer <niemeyer@conectiva.com>
+#
+# This file is part of Smart Package Manager.
+#
+# Smart Package Manager is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# Smart Package Manager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Smart Package Manager; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+from smart.util.cachefile import dumpCacheFile, loadCacheFile
+from smart.util.objdigest import getObjectDigest
+from smart.cache import Cache, Loader, Package, Provides, Depends
+from smart.const import DEBUG
+from smart import *
+import cStringIO
+import cPickle
+import os
+
+#
+# A cache segment holds the loaders of a single channel, with their
+# packages already built, so that a channel whose information didn't
+# change may be brought back without parsing its metadata again.
+#
+# Packages and relations are shared between loaders of different
+# channels (an installed package and the same package available in
+# a repository are the same object), so a segment can't simply be
+# unpickled and added to the cache. Instead, it's stored in two
+# parts: the packages of the channel, and the loaders referring to
+# these packages by index. When restoring, packages are first merged
+# with the ones already known, and only then the loaders are built,
+# so that any internal reference they keep points to the merged
+# packages.
+#
+
+SEGMENTVERSION = 2
+SEGMENTSUFFIX = "%%segment"
+
+def getSegmentPath(dir, channel):
+    return os.path.join(dir, channel.getAlias()+SEGMENTSUFFIX)
+
+def getSegmentKey(channel):
+    """
+    Return a key identifying the information of the given channel,
+    or None if the channel digest can't be compared across runs.
+    """
+    digest = channel.getDigest()
+    if type(digest) not in (str, int, long, float):
+        return None
+    config = [(key, value) for key, value in channel.__dict__.items()
+              if key not in ("_loaders", "_digest")]
+    config.sort()
+    return (digest, getObjectDigest((channel.__class__, config)))
+
+def _getRelations(pkg):
+    return (pkg.provides, pkg.requires, pkg.recommends,
+            pkg.upgrades, pkg.conflicts)
+
+def dumpSegment(path, channel):
+    key = getSegmentKey(channel)
+    if key is None:
+        return False
+    loaders = channel.getLoaders()
+    loaderindex = {}
+    for i, loader in enumerate(loaders):
+        if not loader.getPackages():
+            return False
+        loaderindex[loader] = i
+    packages = []
+    pkgindex = {}
+    for loader in loaders:
+        for pkg in loader.getPackages():
+            if pkg not in pkgindex:
+                pkgindex[pkg] = len(packages)
+                packages.append(pkg)
+
+    def pkgsPersistentId(obj):
+        if isinstance(obj, Loader):
+            return ("loader", loaderindex.get(obj))
+        if isinstance(obj, Cache):
+            return "cache"
+        return None
+
+    def loadersPersistentId(obj):
+        if isinstance(obj, Package):
+            return ("pkg", pkgindex.get(obj))
+        if isinstance(obj, (Provides, Depends)):
+            return ("rel", obj.getInitArgs())
+        if obj is channel:
+            return "channel"
+        if isinstance(obj, Cache):
+            return "cache"
+        if isinstance(obj, Loader) and obj not in loaderindex:
+            return ("loader", None)
+        return None
+
+    state = (key,
+             _dumps(packages, pkgsPersistentId),
+             _dumps(loaders, loadersPersistentId))
+    dumpCacheFile(path, state, SEGMENTVERSION)
+    return True
+
+def _dumps(obj, persistentid):
+    file = cStringIO.StringIO()
+    pickler = cPickle.Pickler(file, 2)
+    pickler.inst_persistent_id = persistentid
+    pickler.dump(obj)
+    return file.getvalue()
+
+def _loads(data, persistentload):
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.persistent_load = persistentload
+    return unpickler.load()
+
+class SegmentSplicer(object):
+    """
+    Restore cache segments on top of the loaders already in a cache,
+    merging restored packages and relations with the existing ones.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._pkgmap = None
+        self._relmap = None
+
+    def _buildIndex(self):
+        pkgmap = self._pkgmap = {}
+        relmap = self._relmap = {}
+        seen = {}
+        for loader in self._cache._loaders:
+            for pkg in loader.getPackages():
+                if pkg in seen:
+                    continue
+                seen[pkg] = True
+                pkgmap.setdefault(pkg.getInitArgs(), []).append(pkg)
+                for rels in _getRelations(pkg):
+                    for rel in rels:
+                        relmap[rel.getInitArgs()] = rel
+
+    def _merge(self, pkg):
+        relmap = self._relmap
+        for rels in _getRelations(pkg):
+            for i in range(len(rels)):
+                rel = rels[i]
+                args = rel.getInitArgs()
+                other = relmap.get(args)
+                if other is None:
+                    relmap[args] = rel
+                elif other is not rel:
+                    rels[i] = other
+        args = pkg.getInitArgs()
+        lst = self._pkgmap.get(args)
+        if lst is None:
+            self._pkgmap[args] = [pkg]
+        else:
+            for lstpkg in lst:
+                if pkg.equals(lstpkg):
+                    return lstpkg
+            lst.append(pkg)
+        return pkg
+
+    def restore(self, path, channel):
+        """
+        Restore the loaders of channel from the segment at path,
+        returning True if the segment was usable. Restored loaders
+        replace the ones in the channel, and are added to the cache.
+        """
+        key = getSegmentKey(channel)
+        if key is None or not os.path.isfile(path):
+            return False
+        try:
+            segkey, pkgsdata, loadersdata = \
+                loadCacheFile(path, SEGMENTVERSION)
+            if segkey != key:
+                return False
+            if self._pkgmap is None:
+                self._buildIndex()
+
+            def pkgsPersistentLoad(id):
+                if id == "cache":
+                    return None
+                return id
+            packages = _loads(pkgsdata, pkgsPersistentLoad)
+
+            merged = []
+            infos = []
+            for pkg in packages:
+                mergedpkg = self._merge(pkg)
+                for id, info in pkg.loaders.items():
+                    if id[1] is not None:
+                        infos.append((mergedpkg, id[1], info))
+                if mergedpkg is pkg:
+                    pkg.loaders.clear()
+                merged.append(mergedpkg)
+
+            relmap = self._relmap
+            def loadersPersistentLoad(id):
+                if id == "channel":
+                    return channel
+                if id == "cache":
+                    return None
+                kind, value = id
+                if kind == "pkg":
+                    return merged[value]
+                if kind == "rel":
+                    rel = relmap.get(value)
+                    if rel is None:
+                        rel = relmap[value] = value[0](*value[1:])
+                    return rel
+                return None
+            loaders = _loads(loadersdata, loadersPersistentLoad)
+        except:
+            if sysconf.get("log-level") == DEBUG:
+                import traceback
+                traceback.print_exc()
+            # The index may now refer to packages which won't be used.
+            self._pkgmap = self._relmap = None
+            return False
+
+        for pkg, i, info in infos:
+            pkg.loaders[loaders[i]] = info
+        channel.getLoaders()[:] = loaders
+        channel.addLoaders(self._cache)
+        return True
+
+# vim:ts=4:sw=4:et
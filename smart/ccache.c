@@ -44,6 +44,13 @@
 
 #define STR(obj) PyString_AS_STRING(obj)
 
+#define SET_NONE(x) \
+    do { \
+        Py_XDECREF(x); \
+        Py_INCREF(Py_None); \
+        (x) = Py_None; \
+    } while (0)
+
 
 #ifndef Py_VISIT
 #define Py_VISIT(op)					\
@@ -129,6 +136,14 @@ typedef struct {
     PyObject *_upgrades;
     PyObject *_conflicts;
     PyObject *_objmap;
+    PyObject *_prvnames;
+    PyObject *_reqnames;
+    PyObject *_recnames;
+    PyObject *_upgnames;
+    PyObject *_cnfnames;
+    PyObject *_newloaders;
+    PyObject *_byname;
+    PyObject *_upgindex;
 } CacheObject;
 
 static PyObject *
@@ -187,6 +202,71 @@ getGlobDistance(void)
     return globdistance;
 }
 
+static PyObject *
+getLoadLoaders(void)
+{
+    static PyObject *loadloaders = NULL;
+    if (loadloaders == NULL) {
+        PyObject *module = PyImport_ImportModule("smart.loadpool");
+        if (module) {
+            loadloaders = PyObject_GetAttrString(module, "loadLoaders");
+            Py_DECREF(module);
+        }
+    }
+    return loadloaders;
+}
+
+static PyObject *
+listToDict(PyObject *lst)
+{
+    /* return dict.fromkeys(lst, True) */
+    PyObject *dict = PyDict_New();
+    int i, len;
+    if (!dict) return NULL;
+    len = PyList_GET_SIZE(lst);
+    for (i = 0; i != len; i++) {
+        if (PyDict_SetItem(dict, PyList_GET_ITEM(lst, i), Py_True) == -1) {
+            Py_DECREF(dict);
+            return NULL;
+        }
+    }
+    return dict;
+}
+
+static int
+listContains(PyObject *lst, PyObject *obj)
+{
+    /* Same as "obj in lst", but comparing identity only. */
+    int i, len;
+    len = PyList_GET_SIZE(lst);
+    for (i = 0; i != len; i++)
+        if (PyList_GET_ITEM(lst, i) == obj)
+            return 1;
+    return 0;
+}
+
+static int
+listRemoveIdentical(PyObject *lst, PyObject *obj)
+{
+    /*
+       for i in range(len(lst)):
+           if lst[i] is obj:
+               del lst[i]
+               return True
+       return False
+    */
+    int i, len;
+    len = PyList_GET_SIZE(lst);
+    for (i = 0; i != len; i++) {
+        if (PyList_GET_ITEM(lst, i) == obj) {
+            if (PyList_SetSlice(lst, i, i+1, (PyObject *)NULL) == -1)
+                return -1;
+            return 1;
+        }
+    }
+    return 0;
+}
+
 static PyObject *
 _(const char *str)
 {
@@ -213,6 +293,8 @@ Package_init(PackageObject *self, PyObject *args)
         return -1;
     Py_INCREF(self->name);
     Py_INCREF(self->version);
+    /* Names are shared by many objects, so keep a single copy. */
+    PyString_InternInPlace(&self->name);
     self->provides = PyTuple_New(0);
     self->requires = PyList_New(0);
     self->recommends = PyList_New(0);
@@ -755,6 +837,9 @@ Package__setstate__(PackageObject *self, PyObject *state)
     Py_INCREF(self->priority);
     Py_INCREF(self->loaders);
 
+    if (PyString_CheckExact(self->name))
+        PyString_InternInPlace(&self->name);
+
     Py_INCREF(Py_None);
     return Py_None;
 }
@@ -840,6 +925,7 @@ Provides_init(ProvidesObject *self, PyObject *args)
         return -1;
     Py_INCREF(self->name);
     Py_INCREF(self->version);
+    PyString_InternInPlace(&self->name);
     self->packages = PyList_New(0);
     self->requiredby = PyTuple_New(0);
     self->recommendedby = PyTuple_New(0);
@@ -1116,6 +1202,7 @@ Depends_init(DependsObject *self, PyObject *args)
     Py_INCREF(self->name);
     Py_INCREF(self->relation);
     Py_INCREF(self->version);
+    PyString_InternInPlace(&self->name);
     self->packages = PyList_New(0);
     self->providedby = PyTuple_New(0);
     return 0;
@@ -1694,8 +1781,12 @@ Loader_buildPackage(LoaderObject *self, PyObject *args)
     /* relpkgs = [] */
     relpkgs = PyList_New(0);
 
+    /* As in the Python version, packages built without provides,
+       upgrades or conflicts keep the shared empty tuple rather than
+       getting an empty list of their own. */
+
     /* if prvargs: */
-    if (prvargs) {
+    if (prvargs && PyList_GET_SIZE(prvargs)) {
         int i = 0;
         int len = PyList_GET_SIZE(prvargs);
         /* pkg.provides = [] */
@@ -1853,61 +1944,8 @@ Loader_buildPackage(LoaderObject *self, PyObject *args)
         }
     }
 
-    /* if recargs: */
-    if (recargs) {
-        int i = 0;
-        int len = PyList_GET_SIZE(recargs);
-        /* pkg.recommends = [] */
-        Py_DECREF(pkgobj->recommends);
-        pkgobj->recommends = PyList_New(len);
-        /* for args in recargs: */
-        for (; i != len; i++) {
-            PyObject *args = PyList_GET_ITEM(recargs, i);
-            DependsObject *recobj;
-            PyObject *rec;
-            
-            if (!PyTuple_Check(args)) {
-                PyErr_SetString(PyExc_TypeError,
-                                "Item in recargs is not a tuple");
-                return NULL;
-            }
-
-            /* rec = cache._objmap.get(args) */
-            rec = PyDict_GetItem(cache->_objmap, args);
-            recobj = (DependsObject *)rec;
-
-            /* if not rec: */
-            if (!rec) {
-                if (!PyTuple_Check(args) || PyTuple_GET_SIZE(args) < 2) {
-                    PyErr_SetString(PyExc_ValueError, "Invalid recargs tuple");
-                    return NULL;
-                }
-                /* rec = args[0](*args[1:]) */
-                callargs = PyTuple_GetSlice(args, 1, PyTuple_GET_SIZE(args));
-                rec = PyObject_CallObject(PyTuple_GET_ITEM(args, 0), callargs);
-                Py_DECREF(callargs);
-                if (!rec) return NULL;
-                recobj = (DependsObject *)rec;
-
-                /* cache._objmap[args] = rec */
-                PyDict_SetItem(cache->_objmap, args, rec);
-                Py_DECREF(rec);
-
-                /* cache._recommends.append(rec) */
-                PyList_Append(cache->_recommends, rec);
-            }
-
-            /* relpkgs.append(rec.packages) */
-            PyList_Append(relpkgs, recobj->packages);
-
-            /* pkg.recommends.append(rec) */
-            Py_INCREF(rec);
-            PyList_SET_ITEM(pkgobj->recommends, i, rec);
-        }
-    }
-
     /* if upgargs: */
-    if (upgargs) {
+    if (upgargs && PyList_GET_SIZE(upgargs)) {
         int i = 0;
         int len = PyList_GET_SIZE(upgargs);
         /* pkg.upgrades = [] */
@@ -1960,7 +1998,7 @@ Loader_buildPackage(LoaderObject *self, PyObject *args)
     }
 
     /* if cnfargs: */
-    if (cnfargs) {
+    if (cnfargs && PyList_GET_SIZE(cnfargs)) {
         int i = 0;
         int len = PyList_GET_SIZE(cnfargs);
         /* pkg.conflicts = [] */
@@ -2166,6 +2204,12 @@ Loader_buildFileProvides(LoaderObject *self, PyObject *args)
     /* prv.packages.append(pkg) */
     PyList_Append(prvobj->packages, pkg);
 
+    /* if not pkg.provides: pkg.provides = [] */
+    if (!PyList_Check(pkgobj->provides)) {
+        Py_DECREF(pkgobj->provides);
+        pkgobj->provides = PyList_New(0);
+    }
+
     /* pkg.provides.append(prv) */
     PyList_Append(pkgobj->provides, prv);
 
@@ -2600,6 +2644,20 @@ Cache_init(CacheObject *self, PyObject *args)
     self->_upgrades = PyList_New(0);
     self->_conflicts = PyList_New(0);
     self->_objmap = PyDict_New();
+    Py_INCREF(Py_None);
+    self->_prvnames = Py_None;
+    Py_INCREF(Py_None);
+    self->_reqnames = Py_None;
+    Py_INCREF(Py_None);
+    self->_recnames = Py_None;
+    Py_INCREF(Py_None);
+    self->_upgnames = Py_None;
+    Py_INCREF(Py_None);
+    self->_cnfnames = Py_None;
+    self->_newloaders = PyList_New(0);
+    self->_byname = PyDict_New();
+    Py_INCREF(Py_None);
+    self->_upgindex = Py_None;
     return 0;
 }
 
@@ -2614,6 +2672,14 @@ Cache_traverse(CacheObject *self, visitproc visit, void *arg)
     Py_VISIT(self->_upgrades);
     Py_VISIT(self->_conflicts);
     Py_VISIT(self->_objmap);
+    Py_VISIT(self->_prvnames);
+    Py_VISIT(self->_reqnames);
+    Py_VISIT(self->_recnames);
+    Py_VISIT(self->_upgnames);
+    Py_VISIT(self->_cnfnames);
+    Py_VISIT(self->_newloaders);
+    Py_VISIT(self->_byname);
+    Py_VISIT(self->_upgindex);
     return 0;
 }
 
@@ -2628,6 +2694,14 @@ Cache_clear(CacheObject *self)
     Py_CLEAR(self->_upgrades);
     Py_CLEAR(self->_conflicts);
     Py_CLEAR(self->_objmap);
+    Py_CLEAR(self->_prvnames);
+    Py_CLEAR(self->_reqnames);
+    Py_CLEAR(self->_recnames);
+    Py_CLEAR(self->_upgnames);
+    Py_CLEAR(self->_cnfnames);
+    Py_CLEAR(self->_newloaders);
+    Py_CLEAR(self->_byname);
+    Py_CLEAR(self->_upgindex);
     return 0;
 }
 
@@ -2642,6 +2716,14 @@ Cache_dealloc(CacheObject *self)
     Py_XDECREF(self->_upgrades);
     Py_XDECREF(self->_conflicts);
     Py_XDECREF(self->_objmap);
+    Py_XDECREF(self->_prvnames);
+    Py_XDECREF(self->_reqnames);
+    Py_XDECREF(self->_recnames);
+    Py_XDECREF(self->_upgnames);
+    Py_XDECREF(self->_cnfnames);
+    Py_XDECREF(self->_newloaders);
+    Py_XDECREF(self->_byname);
+    Py_XDECREF(self->_upgindex);
     self->ob_type->tp_free((PyObject *)self);
 }
 
@@ -2722,6 +2804,14 @@ Cache_reset(CacheObject *self, PyObject *args)
     LIST_CLEAR(self->_upgrades);
     LIST_CLEAR(self->_conflicts);
     PyDict_Clear(self->_objmap);
+    SET_NONE(self->_prvnames);
+    SET_NONE(self->_reqnames);
+    SET_NONE(self->_recnames);
+    SET_NONE(self->_upgnames);
+    SET_NONE(self->_cnfnames);
+    LIST_CLEAR(self->_newloaders);
+    PyDict_Clear(self->_byname);
+    SET_NONE(self->_upgindex);
     Py_RETURN_NONE;
 }
 
@@ -2737,6 +2827,12 @@ Cache_addLoader(CacheObject *self, PyObject *loader)
         if (i == len) {
             PyList_Append(self->_loaders, loader);
             CALLMETHOD(loader, "setCache", "O", self);
+            /*
+               if self._prvnames is not None:
+                   self._newloaders.append(loader)
+            */
+            if (self->_prvnames != Py_None)
+                PyList_Append(self->_newloaders, loader);
         }
     }
     Py_RETURN_NONE;
@@ -2747,6 +2843,11 @@ Cache_removeLoader(CacheObject *self, PyObject *loader)
 {
     if (loader != Py_None) {
         int i, len;
+        len = PyList_GET_SIZE(self->_newloaders);
+        for (i = len-1; i >= 0; i--)
+            if (PyList_GET_ITEM(self->_newloaders, i) == loader)
+                PyList_SetSlice(self->_newloaders, i, i+1,
+                                (PyObject *)NULL);
         len = PyList_GET_SIZE(self->_loaders);
         for (i = len-1; i >= 0; i--)
             if (PyList_GET_ITEM(self->_loaders, i) == loader)
@@ -2782,6 +2883,56 @@ Cache__reload(CacheObject *self, PyObject *args)
     if (!packages || !provides || !requires || !recommends || !conflicts )
         return NULL;
 
+    /*
+       self._byname.clear()
+       self._upgindex = None
+    */
+    PyDict_Clear(self->_byname);
+    SET_NONE(self->_upgindex);
+
+    /*
+       for prv in self._provides:
+           del prv.packages[:]
+       for req in self._requires:
+           del req.packages[:]
+       for rec in self._recommends:
+           del rec.packages[:]
+       for upg in self._upgrades:
+           del upg.packages[:]
+       for cnf in self._conflicts:
+           del cnf.packages[:]
+    */
+    ilen = PyList_GET_SIZE(self->_provides);
+    for (i = 0; i != ilen; i++) {
+        ProvidesObject *prv =
+            (ProvidesObject *)PyList_GET_ITEM(self->_provides, i);
+        LIST_CLEAR(prv->packages);
+    }
+    ilen = PyList_GET_SIZE(self->_requires);
+    for (i = 0; i != ilen; i++) {
+        DependsObject *req =
+            (DependsObject *)PyList_GET_ITEM(self->_requires, i);
+        LIST_CLEAR(req->packages);
+    }
+    ilen = PyList_GET_SIZE(self->_recommends);
+    for (i = 0; i != ilen; i++) {
+        DependsObject *rec =
+            (DependsObject *)PyList_GET_ITEM(self->_recommends, i);
+        LIST_CLEAR(rec->packages);
+    }
+    ilen = PyList_GET_SIZE(self->_upgrades);
+    for (i = 0; i != ilen; i++) {
+        DependsObject *upg =
+            (DependsObject *)PyList_GET_ITEM(self->_upgrades, i);
+        LIST_CLEAR(upg->packages);
+    }
+    ilen = PyList_GET_SIZE(self->_conflicts);
+    for (i = 0; i != ilen; i++) {
+        DependsObject *cnf =
+            (DependsObject *)PyList_GET_ITEM(self->_conflicts, i);
+        LIST_CLEAR(cnf->packages);
+    }
+
     /* for loader in loaders: */
     ilen = PyList_GET_SIZE(self->_loaders);
     for (i = 0; i != ilen; i++) {
@@ -3053,53 +3204,167 @@ Cache_load(CacheObject *self, PyObject *args)
 {
     int i, len;
     int total = 1;
+    int linked;
     PyObject *hooks;
-    PyObject *prog;
+    PyObject *prog = NULL;
     PyObject *ret;
+    PyObject *oldprovides = NULL, *oldrequires = NULL;
+    PyObject *oldrecommends = NULL, *oldupgrades = NULL;
+    PyObject *oldconflicts = NULL;
+
+#define LOADCALL(obj, ...) \
+    do { \
+        ret = PyObject_CallMethod((PyObject *)(obj), __VA_ARGS__); \
+        if (!ret) goto error; \
+        Py_DECREF(ret); \
+    } while (0)
+
+    /*
+       linked = self._prvnames is not None
+       if linked:
+           oldprovides = dict.fromkeys(self._provides, True)
+           oldrequires = dict.fromkeys(self._requires, True)
+           oldrecommends = dict.fromkeys(self._recommends, True)
+           oldupgrades = dict.fromkeys(self._upgrades, True)
+           oldconflicts = dict.fromkeys(self._conflicts, True)
+    */
+    linked = (self->_prvnames != Py_None);
+    if (linked) {
+        oldprovides = listToDict(self->_provides);
+        oldrequires = listToDict(self->_requires);
+        oldrecommends = listToDict(self->_recommends);
+        oldupgrades = listToDict(self->_upgrades);
+        oldconflicts = listToDict(self->_conflicts);
+        if (!oldprovides || !oldrequires || !oldrecommends ||
+            !oldupgrades || !oldconflicts)
+            goto error;
+    }
 
     ret = Cache__reload(self, NULL);
     if (ret == NULL)
-        return NULL;
+        goto error;
     Py_DECREF(ret);
 
     prog = PyObject_CallMethod(getIface(), "getProgress", "OO",
                                self, Py_False);
-    CALLMETHOD(prog, "start", NULL);
-    CALLMETHOD(prog, "setTopic", "O", _("Updating cache..."));
-    CALLMETHOD(prog, "set", "ii", 0, 1);
-    CALLMETHOD(prog, "show", NULL);
+    if (!prog)
+        goto error;
+    LOADCALL(prog, "start", NULL);
+    LOADCALL(prog, "setTopic", "O", _("Updating cache..."));
+    LOADCALL(prog, "set", "ii", 0, 1);
+    LOADCALL(prog, "show", NULL);
     len = PyList_GET_SIZE(self->_loaders);
     for (i = 0; i != len; i++) {
         PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
         if (PyList_GET_SIZE(((LoaderObject *)loader)->_packages) == 0) {
             PyObject *res = PyObject_CallMethod(loader, "getLoadSteps", NULL);
-            if (!res) {
-                Py_DECREF(prog);
-                return NULL;
-            }
+            if (!res)
+                goto error;
             total += PyInt_AsLong(res);
             Py_DECREF(res);
         }
     }
-    CALLMETHOD(prog, "set", "ii", 0, total);
-    CALLMETHOD(prog, "show", NULL);
-    len = PyList_GET_SIZE(self->_loaders);
-    for (i = 0; i != len; i++) {
-        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
-        if (PyList_GET_SIZE(((LoaderObject *)loader)->_packages) == 0)
-            CALLMETHOD(loader, "load", NULL);
+    LOADCALL(prog, "set", "ii", 0, total);
+    LOADCALL(prog, "show", NULL);
+
+    /*
+       from smart.loadpool import loadLoaders
+       for loader in loadLoaders([x for x in self._loaders
+                                  if not x._packages]):
+           if linked and loader not in self._newloaders:
+               self._newloaders.append(loader)
+    */
+    {
+        PyObject *loadloaders = getLoadLoaders();
+        PyObject *loaders, *iter, *loader;
+        if (!loadloaders)
+            goto error;
+        loaders = PyList_New(0);
+        if (!loaders)
+            goto error;
+        len = PyList_GET_SIZE(self->_loaders);
+        for (i = 0; i != len; i++) {
+            loader = PyList_GET_ITEM(self->_loaders, i);
+            if (PyList_GET_SIZE(((LoaderObject *)loader)->_packages) == 0)
+                PyList_Append(loaders, loader);
+        }
+        ret = PyObject_CallFunctionObjArgs(loadloaders, loaders, NULL);
+        Py_DECREF(loaders);
+        if (!ret)
+            goto error;
+        iter = PyObject_GetIter(ret);
+        Py_DECREF(ret);
+        if (!iter)
+            goto error;
+        while ((loader = PyIter_Next(iter))) {
+            if (linked && !listContains(self->_newloaders, loader))
+                PyList_Append(self->_newloaders, loader);
+            Py_DECREF(loader);
+        }
+        Py_DECREF(iter);
+        if (PyErr_Occurred())
+            goto error;
     }
-    CALLMETHOD(self, "loadFileProvides", NULL);
+
+    /*
+       if linked:
+           self._loadNewFileProvides(oldrequires)
+       else:
+           self.loadFileProvides()
+    */
+    if (linked)
+        LOADCALL(self, "_loadNewFileProvides", "O", oldrequires);
+    else
+        LOADCALL(self, "loadFileProvides", NULL);
+
+    /* self._byname.clear() */
+    PyDict_Clear(self->_byname);
+
     hooks = getHooks();
-    CALLMETHOD(hooks, "call", "sO", "cache-loaded-pre-link", self);
+    LOADCALL(hooks, "call", "sO", "cache-loaded-pre-link", self);
     PyDict_Clear(self->_objmap);
-    CALLMETHOD(self, "linkDeps", NULL);
-    CALLMETHOD(prog, "setDone", NULL);
-    CALLMETHOD(prog, "show", NULL);
-    CALLMETHOD(prog, "stop", NULL);
+
+    /*
+       if linked:
+           self._relinkDeps(oldprovides, oldrequires, oldrecommends,
+                            oldupgrades, oldconflicts)
+       else:
+           self.linkDeps()
+       self._upgindex = None
+       del self._newloaders[:]
+    */
+    if (linked)
+        LOADCALL(self, "_relinkDeps", "OOOOO", oldprovides, oldrequires,
+                 oldrecommends, oldupgrades, oldconflicts);
+    else
+        LOADCALL(self, "linkDeps", NULL);
+    SET_NONE(self->_upgindex);
+    LIST_CLEAR(self->_newloaders);
+
+    LOADCALL(prog, "setDone", NULL);
+    LOADCALL(prog, "show", NULL);
+    LOADCALL(prog, "stop", NULL);
     Py_DECREF(prog);
-    CALLMETHOD(hooks, "call", "sO", "cache-loaded", self);
+    prog = NULL;
+    LOADCALL(hooks, "call", "sO", "cache-loaded", self);
+
+    Py_XDECREF(oldprovides);
+    Py_XDECREF(oldrequires);
+    Py_XDECREF(oldrecommends);
+    Py_XDECREF(oldupgrades);
+    Py_XDECREF(oldconflicts);
     Py_RETURN_NONE;
+
+error:
+    Py_XDECREF(prog);
+    Py_XDECREF(oldprovides);
+    Py_XDECREF(oldrequires);
+    Py_XDECREF(oldrecommends);
+    Py_XDECREF(oldupgrades);
+    Py_XDECREF(oldconflicts);
+    return NULL;
+
+#undef LOADCALL
 }
 
 PyObject *
@@ -3135,6 +3400,8 @@ Cache_loadFileProvides(CacheObject *self, PyObject *args)
     Py_RETURN_NONE;
 }
 
+PyObject *Cache__buildProvidesIndex(CacheObject *self, PyObject *args);
+
 PyObject *
 Cache_linkDeps(CacheObject *self, PyObject *args)
 {
@@ -3607,150 +3874,762 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
         }
     }
 
-    Py_DECREF(reqnames);
-    Py_DECREF(recnames);
-    Py_DECREF(upgnames);
-    Py_DECREF(cnfnames);
+    /*
+       self._prvnames = self._buildProvidesIndex()
+       self._reqnames = reqnames
+       self._recnames = recnames
+       self._upgnames = upgnames
+       self._cnfnames = cnfnames
+       self._upgindex = None
+    */
+    lst = Cache__buildProvidesIndex(self, NULL);
+    if (!lst) return NULL;
+    Py_DECREF(self->_prvnames);
+    self->_prvnames = lst;
+    Py_DECREF(self->_reqnames);
+    self->_reqnames = reqnames;
+    Py_DECREF(self->_recnames);
+    self->_recnames = recnames;
+    Py_DECREF(self->_upgnames);
+    self->_upgnames = upgnames;
+    Py_DECREF(self->_cnfnames);
+    self->_cnfnames = cnfnames;
+    SET_NONE(self->_upgindex);
 
     Py_RETURN_NONE;
 }
 
+static int
+linkDependency(PyObject *dep, PyObject *prv, size_t byoffset)
+{
+    /*
+       if dep.providedby:
+           dep.providedby.append(prv)
+       else:
+           dep.providedby = [prv]
+       by = getattr(prv, attr)
+       if by:
+           by.append(dep)
+       else:
+           setattr(prv, attr, [dep])
+    */
+    DependsObject *depobj = (DependsObject *)dep;
+    PyObject **by = (PyObject **)((char *)prv + byoffset);
+    PyObject *_lst;
+    if (PyList_Check(depobj->providedby)) {
+        if (PyList_Append(depobj->providedby, prv) == -1)
+            return -1;
+    } else {
+        _lst = PyList_New(1);
+        if (!_lst) return -1;
+        Py_INCREF(prv);
+        PyList_SET_ITEM(_lst, 0, prv);
+        Py_DECREF(depobj->providedby);
+        depobj->providedby = _lst;
+    }
+    if (PyList_Check(*by)) {
+        if (PyList_Append(*by, dep) == -1)
+            return -1;
+    } else {
+        _lst = PyList_New(1);
+        if (!_lst) return -1;
+        Py_INCREF(dep);
+        PyList_SET_ITEM(_lst, 0, dep);
+        Py_DECREF(*by);
+        *by = _lst;
+    }
+    return 0;
+}
+
+static int
+addToIndex(PyObject *index, PyObject *name, PyObject *obj)
+{
+    /*
+       lst = index.get(name)
+       if lst:
+           lst.append(obj)
+       else:
+           index[name] = [obj]
+    */
+    PyObject *lst = PyDict_GetItem(index, name);
+    int ret;
+    if (lst)
+        return PyList_Append(lst, obj);
+    lst = PyList_New(1);
+    if (!lst) return -1;
+    Py_INCREF(obj);
+    PyList_SET_ITEM(lst, 0, obj);
+    ret = PyDict_SetItem(index, name, lst);
+    Py_DECREF(lst);
+    return ret;
+}
+
+static int
+removeFromIndex(PyObject *index, PyObject *name, PyObject *obj)
+{
+    /*
+       lst = index[name]
+       _removeIdentical(lst, obj)
+       if not lst:
+           del index[name]
+    */
+    PyObject *lst = PyDict_GetItem(index, name);
+    if (!lst) {
+        PyErr_SetObject(PyExc_KeyError, name);
+        return -1;
+    }
+    if (listRemoveIdentical(lst, obj) == -1)
+        return -1;
+    if (PyList_GET_SIZE(lst) == 0)
+        return PyDict_DelItem(index, name);
+    return 0;
+}
+
+PyObject *
+Cache__buildProvidesIndex(CacheObject *self, PyObject *args)
+{
+    /*
+       prvnames = {}
+       for prv in self._provides:
+           lst = prvnames.get(prv.name)
+           if lst:
+               lst.append(prv)
+           else:
+               prvnames[prv.name] = [prv]
+       return prvnames
+    */
+    PyObject *prvnames = PyDict_New();
+    int i, len;
+    if (!prvnames) return NULL;
+    len = PyList_GET_SIZE(self->_provides);
+    for (i = 0; i != len; i++) {
+        PyObject *prv = PyList_GET_ITEM(self->_provides, i);
+        if (addToIndex(prvnames, ((ProvidesObject *)prv)->name, prv) == -1) {
+            Py_DECREF(prvnames);
+            return NULL;
+        }
+    }
+    return prvnames;
+}
+
+PyObject *
+Cache__buildDependsIndex(CacheObject *self, PyObject *deps)
+{
+    /*
+       names = {}
+       for dep in deps:
+           for name in dep.getMatchNames():
+               lst = names.get(name)
+               if lst:
+                   lst.append(dep)
+               else:
+                   names[name] = [dep]
+       return names
+    */
+    PyObject *names = PyDict_New();
+    int i, j, len;
+    if (!names) return NULL;
+    if (!PyList_Check(deps)) {
+        PyErr_SetString(PyExc_TypeError, "list expected");
+        goto error;
+    }
+    len = PyList_GET_SIZE(deps);
+    for (i = 0; i != len; i++) {
+        PyObject *dep = PyList_GET_ITEM(deps, i);
+        PyObject *matchnames, *seq;
+        int seqlen;
+        matchnames = PyObject_CallMethod(dep, "getMatchNames", NULL);
+        if (!matchnames) goto error;
+        seq = PySequence_Fast(matchnames, "getMatchNames() returned "
+                                          "non-sequence object");
+        Py_DECREF(matchnames);
+        if (!seq) goto error;
+        seqlen = PySequence_Fast_GET_SIZE(seq);
+        for (j = 0; j != seqlen; j++) {
+            if (addToIndex(names, PySequence_Fast_GET_ITEM(seq, j),
+                           dep) == -1) {
+                Py_DECREF(seq);
+                goto error;
+            }
+        }
+        Py_DECREF(seq);
+    }
+    return names;
+
+error:
+    Py_DECREF(names);
+    return NULL;
+}
+
+PyObject *
+Cache__loadNewFileProvides(CacheObject *self, PyObject *oldrequires)
+{
+    /*
+       oldfndict = {}
+       for req in oldrequires:
+           name = req.name
+           if name[0] == "/":
+               oldfndict[name] = name
+       fndict = {}
+       newfndict = {}
+       for req in self._requires:
+           name = req.name
+           if name[0] == "/":
+               fndict[name] = name
+               if name not in oldfndict:
+                   newfndict[name] = name
+       for loader in self._loaders:
+           if loader in self._newloaders:
+               loader.loadFileProvides(fndict)
+           elif newfndict:
+               loader.loadFileProvides(newfndict)
+    */
+    PyObject *oldfndict = PyDict_New();
+    PyObject *fndict = PyDict_New();
+    PyObject *newfndict = PyDict_New();
+    PyObject *req, *value, *ret;
+    Py_ssize_t pos = 0;
+    int i, len;
+    if (!oldfndict || !fndict || !newfndict)
+        goto error;
+    if (!PyDict_Check(oldrequires)) {
+        PyErr_SetString(PyExc_TypeError, "dict expected");
+        goto error;
+    }
+    while (PyDict_Next(oldrequires, &pos, &req, &value)) {
+        PyObject *name = ((DependsObject *)req)->name;
+        if (STR(name)[0] == '/')
+            PyDict_SetItem(oldfndict, name, name);
+    }
+    len = PyList_GET_SIZE(self->_requires);
+    for (i = 0; i != len; i++) {
+        PyObject *name;
+        req = PyList_GET_ITEM(self->_requires, i);
+        name = ((DependsObject *)req)->name;
+        if (STR(name)[0] == '/') {
+            PyDict_SetItem(fndict, name, name);
+            if (!PyDict_GetItem(oldfndict, name))
+                PyDict_SetItem(newfndict, name, name);
+        }
+    }
+    len = PyList_GET_SIZE(self->_loaders);
+    for (i = 0; i != len; i++) {
+        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
+        if (listContains(self->_newloaders, loader))
+            ret = PyObject_CallMethod(loader, "loadFileProvides",
+                                      "O", fndict);
+        else if (PyDict_Size(newfndict) != 0)
+            ret = PyObject_CallMethod(loader, "loadFileProvides",
+                                      "O", newfndict);
+        else
+            continue;
+        if (!ret) goto error;
+        Py_DECREF(ret);
+    }
+    Py_DECREF(oldfndict);
+    Py_DECREF(fndict);
+    Py_DECREF(newfndict);
+    Py_RETURN_NONE;
+
+error:
+    Py_XDECREF(oldfndict);
+    Py_XDECREF(fndict);
+    Py_XDECREF(newfndict);
+    return NULL;
+}
+
+PyObject *
+Cache__relinkDeps(CacheObject *self, PyObject *args)
+{
+    PyObject *oldprovides, *olddeps[4];
+    PyObject *deps[4], *names[4], *newdeps[4] = {NULL, NULL, NULL, NULL};
+    size_t byoffsets[4] = {offsetof(ProvidesObject, requiredby),
+                           offsetof(ProvidesObject, recommendedby),
+                           offsetof(ProvidesObject, upgradedby),
+                           offsetof(ProvidesObject, conflictedby)};
+    PyObject *prvnames = self->_prvnames;
+    PyObject *provides = NULL;
+    PyObject *prv, *dep, *value;
+    Py_ssize_t pos;
+    int i, j, k, len, kind;
+
+    if (!PyArg_ParseTuple(args, "O!O!O!O!O!",
+                          &PyDict_Type, &oldprovides,
+                          &PyDict_Type, &olddeps[0],
+                          &PyDict_Type, &olddeps[1],
+                          &PyDict_Type, &olddeps[2],
+                          &PyDict_Type, &olddeps[3]))
+        return NULL;
+
+    if (!PyDict_Check(prvnames) || !PyDict_Check(self->_reqnames) ||
+        !PyDict_Check(self->_recnames) || !PyDict_Check(self->_upgnames) ||
+        !PyDict_Check(self->_cnfnames)) {
+        PyErr_SetString(PyExc_TypeError, "cache is not linked");
+        return NULL;
+    }
+
+    deps[0] = self->_requires;
+    deps[1] = self->_recommends;
+    deps[2] = self->_upgrades;
+    deps[3] = self->_conflicts;
+    names[0] = self->_reqnames;
+    names[1] = self->_recnames;
+    names[2] = self->_upgnames;
+    names[3] = self->_cnfnames;
+
+    /*
+       provides = dict.fromkeys(self._provides, True)
+       for prv in oldprovides:
+           if prv not in provides:
+               lst = prvnames[prv.name]
+               _removeIdentical(lst, prv)
+               if not lst:
+                   del prvnames[prv.name]
+               for _, _, _, attr in kinds:
+                   lst = getattr(prv, attr)
+                   if lst:
+                       for dep in lst:
+                           _removeIdentical(dep.providedby, prv)
+                       del lst[:]
+    */
+    provides = listToDict(self->_provides);
+    if (!provides) goto error;
+    pos = 0;
+    while (PyDict_Next(oldprovides, &pos, &prv, &value)) {
+        if (PyDict_GetItem(provides, prv))
+            continue;
+        if (removeFromIndex(prvnames, ((ProvidesObject *)prv)->name,
+                            prv) == -1)
+            goto error;
+        for (kind = 0; kind != 4; kind++) {
+            PyObject *lst = *(PyObject **)((char *)prv + byoffsets[kind]);
+            if (!PyList_Check(lst))
+                continue;
+            len = PyList_GET_SIZE(lst);
+            for (i = 0; i != len; i++) {
+                DependsObject *depobj =
+                    (DependsObject *)PyList_GET_ITEM(lst, i);
+                if (PyList_Check(depobj->providedby) &&
+                    listRemoveIdentical(depobj->providedby, prv) == -1)
+                    goto error;
+            }
+            LIST_CLEAR(lst);
+        }
+    }
+
+    /*
+       newdeps = []
+       for deps, olddeps, names, attr in kinds:
+           current = dict.fromkeys(deps, True)
+           for dep in olddeps:
+               if dep not in current:
+                   for name in dep.getMatchNames():
+                       lst = names[name]
+                       _removeIdentical(lst, dep)
+                       if not lst:
+                           del names[name]
+                   if dep.providedby:
+                       for prv in dict.fromkeys(dep.providedby):
+                           lst = getattr(prv, attr)
+                           while lst and _removeIdentical(lst, dep):
+                               _removeIdentical(dep.providedby, prv)
+           newdeps.append([dep for dep in deps if dep not in olddeps])
+    */
+    for (kind = 0; kind != 4; kind++) {
+        PyObject *current = listToDict(deps[kind]);
+        if (!current) goto error;
+        pos = 0;
+        while (PyDict_Next(olddeps[kind], &pos, &dep, &value)) {
+            DependsObject *depobj = (DependsObject *)dep;
+            PyObject *matchnames, *seq;
+            if (PyDict_GetItem(current, dep))
+                continue;
+            matchnames = PyObject_CallMethod(dep, "getMatchNames", NULL);
+            if (!matchnames) {
+                Py_DECREF(current);
+                goto error;
+            }
+            seq = PySequence_Fast(matchnames, "getMatchNames() returned "
+                                              "non-sequence object");
+            Py_DECREF(matchnames);
+            if (!seq) {
+                Py_DECREF(current);
+                goto error;
+            }
+            len = PySequence_Fast_GET_SIZE(seq);
+            for (i = 0; i != len; i++) {
+                if (removeFromIndex(names[kind],
+                                    PySequence_Fast_GET_ITEM(seq, i),
+                                    dep) == -1) {
+                    Py_DECREF(seq);
+                    Py_DECREF(current);
+                    goto error;
+                }
+            }
+            Py_DECREF(seq);
+            if (PyList_Check(depobj->providedby)) {
+                PyObject *prvs = listToDict(depobj->providedby);
+                PyObject *prvvalue;
+                Py_ssize_t prvpos = 0;
+                if (!prvs) {
+                    Py_DECREF(current);
+                    goto error;
+                }
+                while (PyDict_Next(prvs, &prvpos, &prv, &prvvalue)) {
+                    PyObject *lst =
+                        *(PyObject **)((char *)prv + byoffsets[kind]);
+                    if (!PyList_Check(lst))
+                        continue;
+                    while (listRemoveIdentical(lst, dep) == 1)
+                        listRemoveIdentical(depobj->providedby, prv);
+                }
+                Py_DECREF(prvs);
+            }
+        }
+        Py_DECREF(current);
+        newdeps[kind] = PyList_New(0);
+        if (!newdeps[kind]) goto error;
+        len = PyList_GET_SIZE(deps[kind]);
+        for (i = 0; i != len; i++) {
+            dep = PyList_GET_ITEM(deps[kind], i);
+            if (!PyDict_GetItem(olddeps[kind], dep))
+                PyList_Append(newdeps[kind], dep);
+        }
+    }
+
+    /*
+       for prv in self._provides:
+           if prv in oldprovides:
+               continue
+           lst = prvnames.get(prv.name)
+           if lst:
+               lst.append(prv)
+           else:
+               prvnames[prv.name] = [prv]
+           for _, _, names, attr in kinds:
+               lst = names.get(prv.name)
+               if lst:
+                   for dep in lst:
+                       if dep.matches(prv):
+                           (link dep and prv)
+    */
+    len = PyList_GET_SIZE(self->_provides);
+    for (i = 0; i != len; i++) {
+        PyObject *name;
+        prv = PyList_GET_ITEM(self->_provides, i);
+        if (PyDict_GetItem(oldprovides, prv))
+            continue;
+        name = ((ProvidesObject *)prv)->name;
+        if (addToIndex(prvnames, name, prv) == -1)
+            goto error;
+        for (kind = 0; kind != 4; kind++) {
+            PyObject *lst = PyDict_GetItem(names[kind], name);
+            int lstlen;
+            if (!lst)
+                continue;
+            lstlen = PyList_GET_SIZE(lst);
+            for (j = 0; j != lstlen; j++) {
+                PyObject *ret;
+                dep = PyList_GET_ITEM(lst, j);
+                ret = PyObject_CallMethod(dep, "matches", "O", prv);
+                if (!ret) goto error;
+                if (PyObject_IsTrue(ret) &&
+                    linkDependency(dep, prv, byoffsets[kind]) == -1) {
+                    Py_DECREF(ret);
+                    goto error;
+                }
+                Py_DECREF(ret);
+            }
+        }
+    }
+
+    /*
+       for (_, _, names, attr), deps in zip(kinds, newdeps):
+           for dep in deps:
+               for name in dep.getMatchNames():
+                   lst = names.get(name)
+                   if lst:
+                       lst.append(dep)
+                   else:
+                       names[name] = [dep]
+                   lst = prvnames.get(name)
+                   if lst:
+                       for prv in lst:
+                           if dep.matches(prv):
+                               (link dep and prv)
+    */
+    for (kind = 0; kind != 4; kind++) {
+        len = PyList_GET_SIZE(newdeps[kind]);
+        for (i = 0; i != len; i++) {
+            PyObject *matchnames, *seq;
+            int seqlen;
+            dep = PyList_GET_ITEM(newdeps[kind], i);
+            matchnames = PyObject_CallMethod(dep, "getMatchNames", NULL);
+            if (!matchnames) goto error;
+            seq = PySequence_Fast(matchnames, "getMatchNames() returned "
+                                              "non-sequence object");
+            Py_DECREF(matchnames);
+            if (!seq) goto error;
+            seqlen = PySequence_Fast_GET_SIZE(seq);
+            for (j = 0; j != seqlen; j++) {
+                PyObject *name = PySequence_Fast_GET_ITEM(seq, j);
+                PyObject *lst;
+                int lstlen;
+                if (addToIndex(names[kind], name, dep) == -1) {
+                    Py_DECREF(seq);
+                    goto error;
+                }
+                lst = PyDict_GetItem(prvnames, name);
+                if (!lst)
+                    continue;
+                lstlen = PyList_GET_SIZE(lst);
+                for (k = 0; k != lstlen; k++) {
+                    PyObject *ret;
+                    prv = PyList_GET_ITEM(lst, k);
+                    ret = PyObject_CallMethod(dep, "matches", "O", prv);
+                    if (!ret) {
+                        Py_DECREF(seq);
+                        goto error;
+                    }
+                    if (PyObject_IsTrue(ret) &&
+                        linkDependency(dep, prv, byoffsets[kind]) == -1) {
+                        Py_DECREF(ret);
+                        Py_DECREF(seq);
+                        goto error;
+                    }
+                    Py_DECREF(ret);
+                }
+            }
+            Py_DECREF(seq);
+        }
+    }
+
+    Py_DECREF(provides);
+    for (kind = 0; kind != 4; kind++)
+        Py_DECREF(newdeps[kind]);
+    Py_RETURN_NONE;
+
+error:
+    Py_XDECREF(provides);
+    for (kind = 0; kind != 4; kind++)
+        Py_XDECREF(newdeps[kind]);
+    return NULL;
+}
+
+static PyObject *
+getByName(CacheObject *self, PyObject *lst, size_t nameoffset,
+          const char *name)
+{
+    /*
+       index = self._byname.get(id(lst))
+       if index is None:
+           index = self._byname[id(lst)] = {}
+           for obj in lst:
+               objs = index.get(obj.name)
+               if objs:
+                   objs.append(obj)
+               else:
+                   index[obj.name] = [obj]
+       return index.get(name, [])[:]
+    */
+    PyObject *key, *index, *objs;
+    int i, len;
+    key = PyLong_FromVoidPtr(lst);
+    if (!key) return NULL;
+    index = PyDict_GetItem(self->_byname, key);
+    if (!index) {
+        index = PyDict_New();
+        if (!index || PyDict_SetItem(self->_byname, key, index) == -1) {
+            Py_XDECREF(index);
+            Py_DECREF(key);
+            return NULL;
+        }
+        Py_DECREF(index);
+        len = PyList_GET_SIZE(lst);
+        for (i = 0; i != len; i++) {
+            PyObject *obj = PyList_GET_ITEM(lst, i);
+            PyObject *objname = *(PyObject **)((char *)obj + nameoffset);
+            if (addToIndex(index, objname, obj) == -1) {
+                PyDict_DelItem(self->_byname, key);
+                Py_DECREF(key);
+                return NULL;
+            }
+        }
+    }
+    Py_DECREF(key);
+    key = PyString_FromString(name);
+    if (!key) return NULL;
+    objs = PyDict_GetItem(index, key);
+    Py_DECREF(key);
+    if (!objs)
+        return PyList_New(0);
+    return PyList_GetSlice(objs, 0, PyList_GET_SIZE(objs));
+}
+
 PyObject *
 Cache_getPackages(CacheObject *self, PyObject *args)
 {
     const char *name = NULL;
-    PyObject *lst;
-    int i, len;
     if (!PyArg_ParseTuple(args, "|s", &name))
         return NULL;
     if (!name) {
         Py_INCREF(self->_packages);
         return self->_packages;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_packages);
-    for (i = 0; i != len; i++) {
-        PackageObject *pkg =
-            (PackageObject*)PyList_GET_ITEM(self->_packages, i);
-        if (strcmp(STR(pkg->name), name) == 0)
-            PyList_Append(lst, (PyObject *)pkg);
-    }
-    return lst;
+    return getByName(self, self->_packages, offsetof(PackageObject, name), name);
 }
 
 PyObject *
 Cache_getProvides(CacheObject *self, PyObject *args)
 {
     const char *name = NULL;
-    PyObject *lst;
-    int i, len;
     if (!PyArg_ParseTuple(args, "|s", &name))
         return NULL;
     if (!name) {
         Py_INCREF(self->_provides);
         return self->_provides;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_provides);
-    for (i = 0; i != len; i++) {
-        ProvidesObject *prv =
-            (ProvidesObject*)PyList_GET_ITEM(self->_provides, i);
-        if (strcmp(STR(prv->name), name) == 0)
-            PyList_Append(lst, (PyObject *)prv);
-    }
-    return lst;
+    return getByName(self, self->_provides, offsetof(ProvidesObject, name), name);
 }
 
 PyObject *
 Cache_getRequires(CacheObject *self, PyObject *args)
 {
     const char *name = NULL;
-    PyObject *lst;
-    int i, len;
     if (!PyArg_ParseTuple(args, "|s", &name))
         return NULL;
     if (!name) {
         Py_INCREF(self->_requires);
         return self->_requires;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_requires);
-    for (i = 0; i != len; i++) {
-        DependsObject *req =
-            (DependsObject*)PyList_GET_ITEM(self->_requires, i);
-        if (strcmp(STR(req->name), name) == 0)
-            PyList_Append(lst, (PyObject *)req);
-    }
-    return lst;
+    return getByName(self, self->_requires, offsetof(DependsObject, name), name);
 }
 
 PyObject *
 Cache_getRecommends(CacheObject *self, PyObject *args)
 {
     const char *name = NULL;
-    PyObject *lst;
-    int i, len;
     if (!PyArg_ParseTuple(args, "|s", &name))
         return NULL;
     if (!name) {
         Py_INCREF(self->_recommends);
         return self->_recommends;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_recommends);
-    for (i = 0; i != len; i++) {
-        DependsObject *rec =
-            (DependsObject*)PyList_GET_ITEM(self->_recommends, i);
-        if (strcmp(STR(rec->name), name) == 0)
-            PyList_Append(lst, (PyObject *)rec);
-    }
-    return lst;
+    return getByName(self, self->_recommends, offsetof(DependsObject, name), name);
 }
 
 PyObject *
 Cache_getUpgrades(CacheObject *self, PyObject *args)
 {
     const char *name = NULL;
-    PyObject *lst;
-    int i, len;
     if (!PyArg_ParseTuple(args, "|s", &name))
         return NULL;
     if (!name) {
         Py_INCREF(self->_upgrades);
         return self->_upgrades;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_upgrades);
-    for (i = 0; i != len; i++) {
-        DependsObject *upg =
-            (DependsObject*)PyList_GET_ITEM(self->_upgrades, i);
-        if (strcmp(STR(upg->name), name) == 0)
-            PyList_Append(lst, (PyObject *)upg);
-    }
-    return lst;
+    return getByName(self, self->_upgrades, offsetof(DependsObject, name), name);
 }
 
 PyObject *
 Cache_getConflicts(CacheObject *self, PyObject *args)
 {
     const char *name = NULL;
-    PyObject *lst;
-    int i, len;
     if (!PyArg_ParseTuple(args, "|s", &name))
         return NULL;
     if (!name) {
         Py_INCREF(self->_conflicts);
         return self->_conflicts;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_conflicts);
-    for (i = 0; i != len; i++) {
-        DependsObject *cnf =
-            (DependsObject*)PyList_GET_ITEM(self->_conflicts, i);
-        if (strcmp(STR(cnf->name), name) == 0)
-            PyList_Append(lst, (PyObject *)cnf);
+    return getByName(self, self->_conflicts, offsetof(DependsObject, name), name);
+}
+
+PyObject *
+Cache_getUpgradeIndex(CacheObject *self, PyObject *args)
+{
+    /*
+       if self._upgindex is None:
+           upgrades = {}
+           upgradedby = {}
+           for pkg in self._packages:
+               for upg in pkg.upgrades:
+                   for prv in upg.providedby:
+                       for prvpkg in prv.packages:
+                           lst = upgrades.get(pkg)
+                           if lst is None:
+                               upgrades[pkg] = [prvpkg]
+                           elif prvpkg in lst:
+                               continue
+                           else:
+                               lst.append(prvpkg)
+                           lst = upgradedby.get(prvpkg)
+                           if lst is None:
+                               upgradedby[prvpkg] = [pkg]
+                           else:
+                               lst.append(pkg)
+           self._upgindex = (upgrades, upgradedby)
+       return self._upgindex
+    */
+    PyObject *upgrades, *upgradedby;
+    int i, ilen, j, jlen, k, klen, l, llen;
+    if (self->_upgindex != Py_None) {
+        Py_INCREF(self->_upgindex);
+        return self->_upgindex;
     }
-    return lst;
+    upgrades = PyDict_New();
+    upgradedby = PyDict_New();
+    if (!upgrades || !upgradedby)
+        goto error;
+    ilen = PyList_GET_SIZE(self->_packages);
+    for (i = 0; i != ilen; i++) {
+        PyObject *pkg = PyList_GET_ITEM(self->_packages, i);
+        PyObject *pkgupgrades = ((PackageObject *)pkg)->upgrades;
+        jlen = PySequence_Fast_GET_SIZE(pkgupgrades);
+        for (j = 0; j != jlen; j++) {
+            DependsObject *upg =
+                (DependsObject *)PySequence_Fast_GET_ITEM(pkgupgrades, j);
+            klen = PySequence_Fast_GET_SIZE(upg->providedby);
+            for (k = 0; k != klen; k++) {
+                ProvidesObject *prv = (ProvidesObject *)
+                    PySequence_Fast_GET_ITEM(upg->providedby, k);
+                llen = PyList_GET_SIZE(prv->packages);
+                for (l = 0; l != llen; l++) {
+                    PyObject *prvpkg = PyList_GET_ITEM(prv->packages, l);
+                    PyObject *lst = PyDict_GetItem(upgrades, pkg);
+                    if (!lst) {
+                        if (addToIndex(upgrades, pkg, prvpkg) == -1)
+                            goto error;
+                    } else {
+                        int contains = PySequence_Contains(lst, prvpkg);
+                        if (contains == -1)
+                            goto error;
+                        if (contains)
+                            continue;
+                        if (PyList_Append(lst, prvpkg) == -1)
+                            goto error;
+                    }
+                    if (addToIndex(upgradedby, prvpkg, pkg) == -1)
+                        goto error;
+                }
+            }
+        }
+    }
+    Py_DECREF(self->_upgindex);
+    self->_upgindex = PyTuple_Pack(2, upgrades, upgradedby);
+    Py_DECREF(upgrades);
+    Py_DECREF(upgradedby);
+    if (!self->_upgindex) {
+        Py_INCREF(Py_None);
+        self->_upgindex = Py_None;
+        return NULL;
+    }
+    Py_INCREF(self->_upgindex);
+    return self->_upgindex;
+
+error:
+    Py_XDECREF(upgrades);
+    Py_XDECREF(upgradedby);
+    return NULL;
 }
 
 PyObject *
@@ -3765,10 +4644,21 @@ Cache_search(CacheObject *self, PyObject *searcher)
         return NULL;
     }
     if (PyList_GET_SIZE(lst) != 0) {
-        for (i = 0; i != PyList_GET_SIZE(self->_packages); i++) {
-            PyObject *pkg = PyList_GET_ITEM(self->_packages, i);
+        PyObject *seq;
+        res = PyObject_CallMethod(searcher, "getNameVersionCandidates",
+                                  "O", self);
+        if (res == NULL)
+            return NULL;
+        seq = PySequence_Fast(res, "getNameVersionCandidates() returned "
+                                   "non-sequence object");
+        Py_DECREF(res);
+        if (seq == NULL)
+            return NULL;
+        for (i = 0; i != PySequence_Fast_GET_SIZE(seq); i++) {
+            PyObject *pkg = PySequence_Fast_GET_ITEM(seq, i);
             CALLMETHOD(pkg, "search", "O", searcher);
         }
+        Py_DECREF(seq);
     }
     Py_DECREF(lst);
 
@@ -3778,10 +4668,21 @@ Cache_search(CacheObject *self, PyObject *searcher)
         return NULL;
     }
     if (PyList_GET_SIZE(lst) != 0) {
-        for (i = 0; i != PyList_GET_SIZE(self->_provides); i++) {
-            PyObject *prv = PyList_GET_ITEM(self->_provides, i);
+        PyObject *seq;
+        res = PyObject_CallMethod(searcher, "getProvidesCandidates",
+                                  "O", self);
+        if (res == NULL)
+            return NULL;
+        seq = PySequence_Fast(res, "getProvidesCandidates() returned "
+                                   "non-sequence object");
+        Py_DECREF(res);
+        if (seq == NULL)
+            return NULL;
+        for (i = 0; i != PySequence_Fast_GET_SIZE(seq); i++) {
+            PyObject *prv = PySequence_Fast_GET_ITEM(seq, i);
             CALLMETHOD(prv, "search", "O", searcher);
         }
+        Py_DECREF(seq);
     }
     Py_DECREF(lst);
 
@@ -3918,8 +4819,8 @@ Cache_search(CacheObject *self, PyObject *searcher)
         return NULL;
     if (PyObject_IsTrue(res)) {    
         for (i = 0; i != PyList_GET_SIZE(self->_loaders); i++)
-            CALLMETHOD(PyList_GET_ITEM(self->_loaders, i),
-                       "search", "O", searcher);
+            CALLMETHOD(searcher, "searchLoader", "O",
+                       PyList_GET_ITEM(self->_loaders, i));
     }
     Py_DECREF(res);
 
@@ -3928,17 +4829,59 @@ Cache_search(CacheObject *self, PyObject *searcher)
 }
 
 
-#define Cache__stateversion__ 1
+#define Cache__stateversion__ 2
 
 static PyObject *
 Cache__getstate__(CacheObject *self, PyObject *args)
 {
     PyObject *state = PyDict_New();
+    PyObject *o;
     if (!state) return NULL;
-    PyDict_SetItemString(state, "__stateversion__",
-                         PyInt_FromLong(Cache__stateversion__));
+    o = PyInt_FromLong(Cache__stateversion__);
+    PyDict_SetItemString(state, "__stateversion__", o);
+    Py_DECREF(o);
     PyDict_SetItemString(state, "_loaders", self->_loaders);
     PyDict_SetItemString(state, "_packages", self->_packages);
+    /*
+       if self._prvnames is not None:
+           links = []
+           for prv in self._provides:
+               if (prv.requiredby or prv.recommendedby or
+                   prv.upgradedby or prv.conflictedby):
+                   links.append((prv, prv.requiredby, prv.recommendedby,
+                                 prv.upgradedby, prv.conflictedby))
+           state["_links"] = links
+    */
+    if (self->_prvnames != Py_None) {
+        PyObject *links = PyList_New(0);
+        int i, len;
+        if (!links) {
+            Py_DECREF(state);
+            return NULL;
+        }
+        len = PyList_GET_SIZE(self->_provides);
+        for (i = 0; i != len; i++) {
+            ProvidesObject *prv =
+                (ProvidesObject *)PyList_GET_ITEM(self->_provides, i);
+            if (PyObject_IsTrue(prv->requiredby) ||
+                PyObject_IsTrue(prv->recommendedby) ||
+                PyObject_IsTrue(prv->upgradedby) ||
+                PyObject_IsTrue(prv->conflictedby)) {
+                o = PyTuple_Pack(5, prv, prv->requiredby,
+                                 prv->recommendedby, prv->upgradedby,
+                                 prv->conflictedby);
+                if (!o || PyList_Append(links, o) == -1) {
+                    Py_XDECREF(o);
+                    Py_DECREF(links);
+                    Py_DECREF(state);
+                    return NULL;
+                }
+                Py_DECREF(o);
+            }
+        }
+        PyDict_SetItemString(state, "_links", links);
+        Py_DECREF(links);
+    }
     return state;
 }
 
@@ -3946,6 +4889,11 @@ static PyObject *
 Cache__setstate__(CacheObject *self, PyObject *state)
 {
     PyObject *provides, *requires, *recommends, *upgrades, *conflicts;
+    PyObject *links;
+    size_t byoffsets[4] = {offsetof(ProvidesObject, requiredby),
+                           offsetof(ProvidesObject, recommendedby),
+                           offsetof(ProvidesObject, upgradedby),
+                           offsetof(ProvidesObject, conflictedby)};
     int i, ilen;
     int j, jlen;
     
@@ -4107,9 +5055,107 @@ Cache__setstate__(CacheObject *self, PyObject *state)
 
     /* self._objmap = {} */
     self->_objmap = PyDict_New();
-    
-    Py_INCREF(Py_None);
-    return Py_None;
+
+    /* self._newloaders = [] */
+    self->_newloaders = PyList_New(0);
+
+    /* self._byname = {} */
+    self->_byname = PyDict_New();
+
+    /* self._upgindex = None */
+    SET_NONE(self->_upgindex);
+
+    /*
+       links = state.get("_links")
+       if links is None:
+           self._prvnames = None
+           self._reqnames = None
+           self._recnames = None
+           self._upgnames = None
+           self._cnfnames = None
+           return
+    */
+    links = PyDict_GetItemString(state, "_links");
+    if (!links || !PyList_Check(links)) {
+        SET_NONE(self->_prvnames);
+        SET_NONE(self->_reqnames);
+        SET_NONE(self->_recnames);
+        SET_NONE(self->_upgnames);
+        SET_NONE(self->_cnfnames);
+        Py_RETURN_NONE;
+    }
+
+    /*
+       for prv, requiredby, recommendedby, upgradedby, conflictedby \
+               in links:
+           for attr, deps in (("requiredby", requiredby), ...):
+               if deps:
+                   setattr(prv, attr, deps)
+                   for dep in deps:
+                       if dep.providedby:
+                           dep.providedby.append(prv)
+                       else:
+                           dep.providedby = [prv]
+    */
+    ilen = PyList_GET_SIZE(links);
+    for (i = 0; i != ilen; i++) {
+        PyObject *link = PyList_GET_ITEM(links, i);
+        PyObject *prv;
+        int kind;
+        if (!PyTuple_Check(link) || PyTuple_GET_SIZE(link) != 5 ||
+            !PyObject_IsInstance(prv = PyTuple_GET_ITEM(link, 0),
+                                 (PyObject *)&Provides_Type)) {
+            PyErr_SetString(StateVersionError, "");
+            return NULL;
+        }
+        for (kind = 0; kind != 4; kind++) {
+            PyObject *deps = PyTuple_GET_ITEM(link, kind+1);
+            PyObject **by = (PyObject **)((char *)prv + byoffsets[kind]);
+            if (!PyList_Check(deps) || PyList_GET_SIZE(deps) == 0)
+                continue;
+            Py_INCREF(deps);
+            Py_DECREF(*by);
+            *by = deps;
+            jlen = PyList_GET_SIZE(deps);
+            for (j = 0; j != jlen; j++) {
+                DependsObject *dep =
+                    (DependsObject *)PyList_GET_ITEM(deps, j);
+                if (PyList_Check(dep->providedby)) {
+                    PyList_Append(dep->providedby, prv);
+                } else {
+                    PyObject *_lst = PyList_New(1);
+                    Py_INCREF(prv);
+                    PyList_SET_ITEM(_lst, 0, prv);
+                    Py_DECREF(dep->providedby);
+                    dep->providedby = _lst;
+                }
+            }
+        }
+    }
+
+    /*
+       self._prvnames = self._buildProvidesIndex()
+       self._reqnames = self._buildDependsIndex(self._requires)
+       self._recnames = self._buildDependsIndex(self._recommends)
+       self._upgnames = self._buildDependsIndex(self._upgrades)
+       self._cnfnames = self._buildDependsIndex(self._conflicts)
+    */
+    self->_prvnames = Cache__buildProvidesIndex(self, NULL);
+    self->_reqnames = Cache__buildDependsIndex(self, self->_requires);
+    self->_recnames = Cache__buildDependsIndex(self, self->_recommends);
+    self->_upgnames = Cache__buildDependsIndex(self, self->_upgrades);
+    self->_cnfnames = Cache__buildDependsIndex(self, self->_conflicts);
+    if (!self->_prvnames || !self->_reqnames || !self->_recnames ||
+        !self->_upgnames || !self->_cnfnames) {
+        SET_NONE(self->_prvnames);
+        SET_NONE(self->_reqnames);
+        SET_NONE(self->_recnames);
+        SET_NONE(self->_upgnames);
+        SET_NONE(self->_cnfnames);
+        return NULL;
+    }
+
+    Py_RETURN_NONE;
 }
 
 static PyMethodDef Cache_methods[] = {
@@ -4121,12 +5167,21 @@ static PyMethodDef Cache_methods[] = {
     {"unload", (PyCFunction)Cache_unload, METH_NOARGS, NULL},
     {"loadFileProvides", (PyCFunction)Cache_loadFileProvides, METH_NOARGS, NULL},
     {"linkDeps", (PyCFunction)Cache_linkDeps, METH_VARARGS, NULL},
+    {"_loadNewFileProvides", (PyCFunction)Cache__loadNewFileProvides,
+      METH_O, NULL},
+    {"_relinkDeps", (PyCFunction)Cache__relinkDeps, METH_VARARGS, NULL},
+    {"_buildProvidesIndex", (PyCFunction)Cache__buildProvidesIndex,
+      METH_NOARGS, NULL},
+    {"_buildDependsIndex", (PyCFunction)Cache__buildDependsIndex,
+      METH_O, NULL},
     {"getPackages", (PyCFunction)Cache_getPackages, METH_VARARGS, NULL},
     {"getProvides", (PyCFunction)Cache_getProvides, METH_VARARGS, NULL},
     {"getRequires", (PyCFunction)Cache_getRequires, METH_VARARGS, NULL},
     {"getRecommends", (PyCFunction)Cache_getRecommends, METH_VARARGS, NULL},
     {"getUpgrades", (PyCFunction)Cache_getUpgrades, METH_VARARGS, NULL},
     {"getConflicts", (PyCFunction)Cache_getConflicts, METH_VARARGS, NULL},
+    {"getUpgradeIndex", (PyCFunction)Cache_getUpgradeIndex, METH_NOARGS,
+      NULL},
     {"search", (PyCFunction)Cache_search, METH_O, NULL},
     {"__getstate__", (PyCFunction)Cache__getstate__, METH_NOARGS, NULL},
     {"__setstate__", (PyCFunction)Cache__setstate__, METH_O, NULL},
@@ -4143,6 +5198,14 @@ static PyMemberDef Cache_members[] = {
     {"_upgrades", T_OBJECT, OFF(_upgrades), RO, 0},
     {"_conflicts", T_OBJECT, OFF(_conflicts), RO, 0},
     {"_objmap", T_OBJECT, OFF(_objmap), RO, 0},
+    {"_prvnames", T_OBJECT, OFF(_prvnames), RO, 0},
+    {"_reqnames", T_OBJECT, OFF(_reqnames), RO, 0},
+    {"_recnames", T_OBJECT, OFF(_recnames), RO, 0},
+    {"_upgnames", T_OBJECT, OFF(_upgnames), RO, 0},
+    {"_cnfnames", T_OBJECT, OFF(_cnfnames), RO, 0},
+    {"_newloaders", T_OBJECT, OFF(_newloaders), RO, 0},
+    {"_byname", T_OBJECT, OFF(_byname), RO, 0},
+    {"_upgindex", T_OBJECT, OFF(_upgindex), RO, 0},
     {NULL}
 };
 #undef OFF
@@ -4210,8 +5273,9 @@ initccache(void)
     o = PyInt_FromLong(Loader__stateversion__);
     PyDict_SetItemString(Loader_Type.tp_dict, "__stateversion__", o);
     Py_DECREF(o);
+    PyDict_SetItemString(Loader_Type.tp_dict, "_loadattrs", Py_None);
     PyType_Ready(&Cache_Type);
-    o = PyInt_FromLong(Loader__stateversion__);
+    o = PyInt_FromLong(Cache__stateversion__);
     PyDict_SetItemString(Cache_Type.tp_dict, "__stateversion__", o);
     Py_DECREF(o);
 
@@ -125,10 +125,15 @@ class MirrorsChannel(Channel):
         super(MirrorsChannel, self).__init__(type, alias, name,
                                              manualupdate, removable)
         self._mirrors = {}
+        self._preferences = {}
 
     def getMirrors(self):
         return self._mirrors
 
+    def getMirrorPreferences(self):
+        # Channels pickled before preferences existed don't have them.
+        return self.__dict__.get("_preferences", {})
+
 # (key, label, needed, type, description)
 DEFAULTFIELDS = [("alias", _("Alias"), str, None,
                   _("Unique identification for the channel.")),
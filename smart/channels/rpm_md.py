@@ -78,6 +78,7 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
 
     def loadMetalink(self, metalinkfile):
         self._mirrors.clear()
+        self._preferences = {}
 
         try:
             root = ElementTree.parse(metalinkfile).getroot()
@@ -111,9 +112,12 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
                             self._mirrors[self._baseurl].append(mirror)
                     else:
                         self._mirrors[self._baseurl] = [mirror]
+                    if preference and preference.isdigit():
+                        self._preferences[mirror] = int(preference)
 
     def loadMirrors(self, mirrorlistfile):
         self._mirrors.clear()
+        self._preferences = {}
 
         try:
             file = open(mirrorlistfile, 'r')
@@ -134,6 +138,11 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
                     else:
                         self._mirrors[self._baseurl] = [mirror]
 
+        # Mirror lists come with the closest mirrors first.
+        mirrors = self._mirrors.get(self._baseurl, [])
+        for i, mirror in enumerate(mirrors):
+            self._preferences[mirror] = 100-(i*100)/len(mirrors)
+
     def loadMetadata(self, metadatafile):
         info = {}
 
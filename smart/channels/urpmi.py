@@ -96,6 +96,7 @@ class URPMIChannel(PackageChannel, MirrorsChannel):
                     iface.warning(_("Could not load mirror list. Continuing with base URL only."))
             else:
                 self._mirrors.clear()
+                self._preferences = {}
                 mirrorurls = []
                 mirrors = self.loadMirrors(item.getTargetPath())
                 for mirror in mirrors:
@@ -107,6 +108,9 @@ class URPMIChannel(PackageChannel, MirrorsChannel):
                     mirrorurls.append(mirror["url"])
                 if mirrorurls:
                     self._mirrors[self._baseurl] = mirrorurls
+                # Mirrors come closest first.
+                for i, url in enumerate(mirrorurls):
+                    self._preferences[url] = 100-(i*100)/len(mirrorurls)
 
             fetcher.reset()
         else:
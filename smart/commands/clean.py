@@ -29,7 +29,9 @@ USAGE=_("smart clean [options]")
 DESCRIPTION=_("""
 This command cleans the package cache. You can use it to
 delete old unused files that were left behind because of
-an incomplete transaction.
+an incomplete transaction. Files in the package store
+which were used longest ago are removed as well, until
+it's no larger than the package-store-size option.
 """)
 
 def option_parser():
@@ -78,4 +80,9 @@ def main(ctrl, opts):
                 iface.error(_("Can't remove cached package %s: %s") \
                             % (cached_pkg, str(e)))
 
+    store = ctrl.getPackageStore()
+    if store:
+        iface.info(_("Removing files from package store..."))
+        store.evict(sysconf.get("package-store-size", 0), block=True)
+
 # vim:ts=4:sw=4:et
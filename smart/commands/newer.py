@@ -93,17 +93,10 @@ def main(ctrl, opts, reloadchannels=True):
         upgrades = [pkg for (pkg, op) in changeset.items() if op == INSTALL]
         upgrades.sort()
         report = []
+        upgindex = cache.getUpgradeIndex()[0]
         for pkg in upgrades:
-            upgraded = []
-            for upg in pkg.upgrades:
-                for prv in upg.providedby:
-                    for prvpkg in prv.packages:
-                        if prvpkg.installed:
-                            upgraded.append(prvpkg)
-                            pass
-                        pass
-                    pass
-                pass
+            upgraded = [prvpkg for prvpkg in upgindex.get(pkg, ())
+                        if prvpkg.installed]
 
             for loader in pkg.loaders:
                 if not loader.getInstalled():
@@ -20,6 +20,7 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 from smart.util.strtools import isGlob
+from smart.searchindex import getCandidates
 from smart.option import OptionParser
 from smart.cache import Provides, PreRequires, Package
 from smart import *
@@ -357,12 +358,17 @@ def main(ctrl, opts, reloadchannels=True):
     if hasname or hasgroup or hassummary or hasdescription or haspath or hasurl:
         newpackages = {}
         needsinfo = hasgroup or hassummary or hasdescription or haspath or hasurl
+        candidates = None
+        if needsinfo:
+            # Url patterns are matched against paths as well.
+            candidates = getCandidates(cache, opts.group, opts.summary,
+                                       opts.description, opts.path+opts.url)
         for pkg in cache.getPackages():
             if hasname:
                 for pattern in hasname:
                     if pattern.search(pkg.name):
                         newpackages[pkg] = True
-            if needsinfo:
+            if needsinfo and (candidates is None or pkg in candidates):
                 info = pkg.loaders.keys()[0].getInfo(pkg)
                 if hasgroup:
                     for pattern in hasgroup:
@@ -19,8 +19,8 @@
 # along with Smart Package Manager; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
-import cPickle
 import sys, os
+import threading
 import copy
 import time
 import tempfile
@@ -28,14 +28,19 @@ import tarfile
 
 from smart.transaction import ChangeSet, ChangeSetSplitter, INSTALL, REMOVE
 from smart.util.filetools import compareFiles, setCloseOnExecAll
+from smart.util.cachefile import dumpCacheFile, loadCacheFile
 from smart.util.objdigest import getObjectDigest
 from smart.util.pathlocks import PathLocks
 from smart.util.strtools import strToBool
 from smart.util.metalink import Metalink, Metafile
+from smart.util.mainthread import MainThreadCalls
+from smart.cachesegment import SegmentSplicer
+from smart.cachesegment import getSegmentPath, dumpSegment
 from smart.searcher import Searcher
 from smart.media import MediaSet
 from smart.progress import Progress
-from smart.fetcher import Fetcher
+from smart.fetcher import Fetcher, DigestCache
+from smart.pkgstore import PackageStore
 from smart.report import Report
 from smart.channel import *
 from smart.cache import *
@@ -60,6 +65,13 @@ class Control(object):
         self.loadSysConf(confpath)
 
         self._fetcher = Fetcher()
+        if sysconf.get("digest-cache", True):
+            digestpath = os.path.join(sysconf.get("data-dir"), "digests")
+            self._fetcher.setDigestCache(DigestCache(digestpath))
+        self._pkgstore = None
+        storepath = sysconf.get("package-store")
+        if storepath:
+            self._pkgstore = PackageStore(os.path.expanduser(storepath))
         self._mediaset = self._fetcher.getMediaSet()
         self._achanset = AvailableChannelSet(self._fetcher)
         self._cachechanged = False
@@ -151,13 +163,16 @@ class Control(object):
     def getFetcher(self):
         return self._fetcher
 
+    def getPackageStore(self):
+        return self._pkgstore
+
     def getMediaSet(self):
         return self._mediaset
 
     def restoreMediaState(self):
         self._mediaset.restoreState()
 
-    __stateversion__ = 2
+    __stateversion__ = 3
 
     def loadSysConf(self, confpath=None):
         datadir = sysconf.get("data-dir")
@@ -190,6 +205,8 @@ class Control(object):
         msys = self._fetcher.getMirrorSystem()
         if msys.getHistoryChanged() and not sysconf.getReadOnly():
             sysconf.set("mirrors-history", msys.getHistory())
+        if not sysconf.getReadOnly():
+            self._fetcher.getDigestCache().save()
         if confpath:
             confpath = os.path.expanduser(confpath)
         else:
@@ -200,14 +217,10 @@ class Control(object):
                 cachepath = os.path.join(sysconf.get("data-dir"), "cache")
                 if sysconf.get("disk-cache", True):
                     iface.showStatus(_("Saving cache..."))
-                    cachefile = open(cachepath+".new", "w")
-                    state = (self.__stateversion__,
-                             self._cache,
+                    state = (self._cache,
                              self._channels,
                              self._sysconfchannels)
-                    cPickle.dump(state, cachefile, 2)
-                    cachefile.close()
-                    os.rename(cachepath+".new", cachepath)
+                    dumpCacheFile(cachepath, state, self.__stateversion__)
                     iface.hideStatus()
                 elif os.path.isfile(cachepath):
                     os.unlink(cachepath)
@@ -222,6 +235,7 @@ class Control(object):
 
     def reloadMirrors(self):
         mirrors = sysconf.get("mirrors", {})
+        preferences = {}
         for channel in self._channels.values():
             if isinstance(channel, MirrorsChannel):
                 cmirrors = channel.getMirrors()
@@ -230,8 +244,10 @@ class Control(object):
                         set = dict.fromkeys(cmirrors[origin])
                         set.update(dict.fromkeys(mirrors.get(origin, [])))
                         mirrors[origin] = set.keys()
+                preferences.update(channel.getMirrorPreferences())
         msys = self._fetcher.getMirrorSystem()
         msys.setMirrors(mirrors)
+        msys.setPreferences(preferences)
         if not msys.getHistory():
             msys.setHistory(sysconf.get("mirrors-history", []))
 
@@ -252,11 +268,8 @@ class Control(object):
             cachepath = os.path.join(sysconf.get("data-dir"), "cache")
             if os.path.isfile(cachepath) and sysconf.get("disk-cache", True):
                 iface.showStatus(_("Loading cache..."))
-                cachefile = open(cachepath)
                 try:
-                    state = cPickle.load(cachefile)
-                    if state[0] != self.__stateversion__:
-                        raise StateVersionError
+                    state = loadCacheFile(cachepath, self.__stateversion__)
                 except:
                     if sysconf.get("log-level") == DEBUG:
                         import traceback
@@ -264,15 +277,13 @@ class Control(object):
                     if os.access(os.path.dirname(cachepath), os.W_OK):
                         os.unlink(cachepath)
                 else:
-                    (__stateversion__,
-                     self._cache,
+                    (self._cache,
                      self._channels,
                      self._sysconfchannels) = state
                     for alias in self._channels.keys():
                         if (alias not in channels or
                             not isEnabled(alias, channels[alias])):
                             self.removeChannel(alias)
-                cachefile.close()
                 iface.hideStatus()
 
         for alias in channels:
@@ -313,6 +324,27 @@ class Control(object):
         self._channels.update(newchannels)
         self._dynamicchannels.update(newchannels)
 
+    def _fetchChannel(self, channel, fetcher, caching, manual, progress):
+        if not manual and channel.hasManualUpdate():
+            fetcher.setCaching(ALWAYS)
+        else:
+            fetcher.setCaching(caching)
+            if channel.getFetchSteps() > 0:
+                progress.setTopic(_("Fetching information for '%s'...") %
+                              (channel.getName() or channel.getAlias()))
+                progress.show()
+        fetcher.setForceCopy(channel.isRemovable())
+        fetcher.setLocalPathPrefix(channel.getAlias()+"%%")
+        try:
+            if not channel.fetch(fetcher, progress):
+                iface.debug(_("Failed fetching channel '%s'") % channel)
+                return False
+        except Error, e:
+            iface.error(unicode(e))
+            iface.debug(_("Failed fetching channel '%s'") % channel)
+            return False
+        return True
+
     def reloadChannels(self, channels=None, caching=ALWAYS):
 
         if channels is None:
@@ -368,33 +400,93 @@ class Control(object):
 
         self._fetcher.setForceMountedCopy(True)
 
-        self._cache.reset()
-
-        # Do the real work.
-        result = True
+        # Channels whose information changed may still have a cache
+        # segment saved from an earlier run with the same digest.
+        segments = sysconf.get("disk-cache", True)
+        restorable = []
+        parsed = []
+
+        # Do the real work. When updating, channels which don't need
+        # the user may be fetched at once, by as many threads as
+        # update-jobs allows, each one with its own fetcher.
+        digests = {}
+        serial = []
+        parallel = []
+        jobs = sysconf.get("update-jobs", 1)
         for channel in channels:
-            digest = channel.getDigest()
-            if not manual and channel.hasManualUpdate():
-                self._fetcher.setCaching(ALWAYS)
+            digests[channel] = channel.getDigest()
+            if (caching is ALWAYS or jobs < 2 or channel.isRemovable() or
+                not manual and channel.hasManualUpdate()):
+                serial.append(channel)
             else:
-                self._fetcher.setCaching(caching)
-                if channel.getFetchSteps() > 0:
-                    progress.setTopic(_("Fetching information for '%s'...") %
-                                  (channel.getName() or channel.getAlias()))
-                    progress.show()
-            self._fetcher.setForceCopy(channel.isRemovable())
-            self._fetcher.setLocalPathPrefix(channel.getAlias()+"%%")
-            try:
-                if not channel.fetch(self._fetcher, progress):
-                    iface.debug(_("Failed fetching channel '%s'") % channel)
-                    result = False
-            except Error, e:
-                iface.error(unicode(e))
-                iface.debug(_("Failed fetching channel '%s'") % channel)
+                parallel.append(channel)
+        if len(parallel) < 2:
+            serial = channels
+            parallel = []
+        fetched = {}
+        # Worker processes uncompressing files, if asked for, are
+        # shared by every channel, and must be started before threads.
+        if caching is not ALWAYS:
+            self._fetcher.startUncompressPool()
+        try:
+            for channel in serial:
+                fetched[channel] = self._fetchChannel(channel,
+                                                      self._fetcher,
+                                                      caching, manual,
+                                                      progress)
+            if parallel:
+                # The interface and the progress are used by the main
+                # thread only, which runs the calls of the workers
+                # while waiting for them. That includes progresses
+                # the interface hands to them, as for fetched items.
+                calls = MainThreadCalls()
+                shared = calls.wrap(progress)
+                lock = threading.Lock()
+                def worker(fetcher):
+                    while True:
+                        lock.acquire()
+                        try:
+                            if not parallel:
+                                break
+                            channel = parallel.pop(0)
+                        finally:
+                            lock.release()
+                        fetched[channel] = self._fetchChannel(channel,
+                                                              fetcher,
+                                                              caching,
+                                                              manual,
+                                                              shared)
+                interface = iface.object
+                iface.object = calls.wrap(interface, Progress)
+                try:
+                    threads = []
+                    for i in range(min(jobs, len(parallel))):
+                        fetcher = self._fetcher.copy()
+                        thread = threading.Thread(target=worker,
+                                                  args=(fetcher,))
+                        # Don't keep the process around if it's
+                        # interrupted.
+                        thread.setDaemon(True)
+                        thread.start()
+                        threads.append(thread)
+                    calls.join(threads)
+                finally:
+                    iface.object = interface
+        finally:
+            self._fetcher.stopUncompressPool()
+        result = True
+        for channel in channels:
+            if not fetched.get(channel):
                 result = False
+            digest = digests[channel]
             if (channel.getDigest() != digest and
                 isinstance(channel, PackageChannel)):
-                channel.addLoaders(self._cache)
+                if (segments and
+                    os.path.isfile(getSegmentPath(channelsdir, channel))):
+                    restorable.append(channel)
+                else:
+                    channel.addLoaders(self._cache)
+                    parsed.append(channel)
                 if channel.getAlias() in self._sysconfchannels:
                     self._cachechanged = True
         if result and caching is not ALWAYS:
@@ -407,10 +499,33 @@ class Control(object):
         progress.setStopped()
         progress.show()
         progress.stop()
+
+        # Bring back unchanged channels from their segments, and
+        # parse the ones which couldn't be restored.
+        if restorable:
+            splicer = SegmentSplicer(self._cache)
+            for channel in restorable:
+                path = getSegmentPath(channelsdir, channel)
+                if not splicer.restore(path, channel):
+                    channel.addLoaders(self._cache)
+                    parsed.append(channel)
  
         # Build cache with the new information.
         self._cache.load()
 
+        # Save segments for channels which had to be parsed.
+        if (segments and parsed and not sysconf.getReadOnly() and
+            os.access(channelsdir, os.W_OK)):
+            for channel in parsed:
+                path = getSegmentPath(channelsdir, channel)
+                try:
+                    if not dumpSegment(path, channel) and \
+                       os.path.isfile(path):
+                        os.unlink(path)
+                except Exception, e:
+                    iface.debug(_("Failed saving cache segment for "
+                                  "'%s': %s") % (channel, e))
+
         # Compare new packages with what we had available, and mark
         # new packages.
         if caching is not ALWAYS:
@@ -829,6 +944,7 @@ class Control(object):
             fetcher.setLocalDir(targetdir, mangle=False)
         pkgitems = {}
         pkgchannels = {}
+        pkginfos = {}
         for pkg in packages:
             for loader in pkg.loaders:
                 if loader.getInstalled():
@@ -839,21 +955,46 @@ class Control(object):
             else:
                 raise Error, _("No channel available for package %s") % pkg
             pkgchannels[pkg] = channel
-            info = loader.getInfo(pkg)
+            pkginfos[pkg] = loader.getInfo(pkg)
+        if sysconf.get("probe-mirrors", False):
+            urls = []
+            for pkg in packages:
+                urls.extend(pkginfos[pkg].getURLs())
+            fetcher.getMirrorSystem().probe(urls)
+        store = self._pkgstore
+        storekeys = {}
+        for pkg in packages:
+            channel = pkgchannels[pkg]
+            info = pkginfos[pkg]
             urls = info.getURLs()
             pkgitems[pkg] = []
             for url in urls:
                 media = self._achanset.getMedia(channel)
-                pkgitems[pkg].append(fetcher.enqueue(url, media=media,
-                                                     md5=info.getMD5(url),
-                                                     sha=info.getSHA(url),
-                                                     sha256=info.getSHA256(url),
-                                                     size=info.getSize(url),
-                                                     validate=info.validate))
+                item = fetcher.enqueue(url, media=media,
+                                       md5=info.getMD5(url),
+                                       sha=info.getSHA(url),
+                                       sha256=info.getSHA256(url),
+                                       size=info.getSize(url),
+                                       validate=info.validate)
+                pkgitems[pkg].append(item)
+                key = store and store.getKey(info, url)
+                if (key and item.getURL().scheme not in
+                             fetcher.getLocalSchemes()):
+                    storekeys[item] = key
+                    # Files already in the store are put where the
+                    # fetcher will find them.
+                    localpath = fetcher.getLocalPath(item)
+                    if not os.path.isfile(localpath):
+                        store.get(key, localpath)
         if targetdir:
             fetcher.setForceCopy(True)
         fetcher.run(what=_("packages"))
         fetcher.setForceCopy(False)
+        for item in storekeys:
+            if item.getStatus() is SUCCEEDED:
+                store.add(storekeys[item], item.getTargetPath())
+        if storekeys and sysconf.get("package-store-size"):
+            store.evict(sysconf.get("package-store-size"))
         failed = fetcher.getFailedSet()
         if failed:
             raise Error, _("Failed to download packages:\n") + \
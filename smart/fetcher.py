@@ -22,15 +22,20 @@
 #
 from smart.util.strtools import sizeToStr, speedToStr, secondsToStr
 from smart.media import MediaSet, DeviceMedia
-from smart.uncompress import Uncompressor
+from smart.uncompress import Uncompressor, uncompressFile
 from smart.mirror import MirrorSystem
+from smart.util.cachefile import dumpCacheFile, loadCacheFile
 from smart.const import *
 from smart import *
+from collections import deque
 import tempfile
 import socket
+import select
 import urllib
 import string
 import thread
+import errno
+import fcntl
 import time
 import os
 import re
@@ -42,6 +47,11 @@ SPEEDDELAY = 1
 CANCELDELAY = 2
 MAXACTIVEDOWNLOADS = 10
 SOCKETTIMEOUT = 600
+TICKDELAY = 1
+MINSEGMENTSIZE = 1024*1024
+MAXHOSTDOWNLOADS = 5
+INITIALHOSTDOWNLOADS = 2
+DIGESTCACHEVERSION = 1
 
 class FetcherCancelled(Error): pass
 
@@ -70,13 +80,43 @@ class Fetcher(object):
         self._maxactivedownloads = 0
         self.time = 0
         self._eta = 0
+        self._events = None
+        self._wakeup = None
+        self._wakeuplock = thread.allocate_lock()
+        self._uncompresspool = None
+        self._digestcache = DigestCache()
+        self._hostscheduler = HostScheduler(mirrorsystem=self._mirrorsystem)
+        self._ratelimiter = RateLimiter()
 
     def reset(self):
         self._items.clear()
         self._uncompressing = 0
 
+    def copy(self):
+        """
+        Return a fetcher with the same settings, sharing the mirror
+        system, the media set, the digest cache and the limits on
+        hosts and bandwidth, which may run at the same time as this
+        one.
+        """
+        fetcher = Fetcher()
+        fetcher._mediaset = self._mediaset
+        fetcher._mirrorsystem = self._mirrorsystem
+        fetcher._digestcache = self._digestcache
+        fetcher._hostscheduler = self._hostscheduler
+        fetcher._ratelimiter = self._ratelimiter
+        fetcher._localdir = self._localdir
+        fetcher._mangle = self._mangle
+        fetcher._caching = self._caching
+        fetcher._forcecopy = self._forcecopy
+        fetcher._forcemountedcopy = self._forcemountedcopy
+        fetcher._localpathprefix = self._localpathprefix
+        fetcher._uncompresspool = self._uncompresspool
+        return fetcher
+
     def cancel(self):
         self._cancel = True
+        self.wakeUp()
 
     def getItem(self, url):
         return self._items.get(url)
@@ -107,6 +147,18 @@ class Fetcher(object):
     def getMirrorSystem(self):
         return self._mirrorsystem
 
+    def getDigestCache(self):
+        return self._digestcache
+
+    def setDigestCache(self, digestcache):
+        self._digestcache = digestcache
+
+    def getHostScheduler(self):
+        return self._hostscheduler
+
+    def getRateLimiter(self):
+        return self._ratelimiter
+
     def getCaching(self):
         return self._caching
 
@@ -168,8 +220,56 @@ class Fetcher(object):
             self._activedownloads += value
             result = True
         self._activedownloadslock.release()
+        if value < 0:
+            # Some handler may now start another download.
+            self.wakeUp()
         return result
 
+    def notifyItem(self, item):
+        """Tell the running loop that the status of item has changed."""
+        events = self._events
+        if events is not None:
+            events.append(item)
+            self.wakeUp()
+
+    def wakeUp(self):
+        """Make the running loop tick handlers and check events now."""
+        # The lock keeps other threads from writing to the pipe while
+        # run() is closing it.
+        self._wakeuplock.acquire()
+        try:
+            if self._wakeup:
+                try:
+                    os.write(self._wakeup[1], "x")
+                except OSError:
+                    # The pipe is full, so the loop is waking up anyway.
+                    pass
+        finally:
+            self._wakeuplock.release()
+
+    def _closeWakeUp(self):
+        self._wakeuplock.acquire()
+        try:
+            if self._wakeup:
+                os.close(self._wakeup[0])
+                os.close(self._wakeup[1])
+                self._wakeup = None
+        finally:
+            self._wakeuplock.release()
+
+    def _wait(self, timeout):
+        try:
+            ready = select.select([self._wakeup[0]], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            try:
+                os.read(self._wakeup[0], 4096)
+            except OSError:
+                pass
+
     def getActiveDownloads(self):
         return self._activedownloads
 
@@ -203,6 +303,9 @@ class Fetcher(object):
         self._maxactivedownloads = sysconf.get("max-active-downloads",
                                                MAXACTIVEDOWNLOADS)
         self._maxdownloadrate = sysconf.get("max-download-rate", 0)
+        self._ratelimiter.setRate(self._maxdownloadrate)
+        self._hostscheduler.setMaximum(sysconf.get("max-host-connections",
+                                                   MAXHOSTDOWNLOADS))
         self.time = time.time()
         handlers = self._handlers.values()
         total = len(self._items)
@@ -229,93 +332,195 @@ class Fetcher(object):
                 topic = _("Fetching information...")
             prog.setTopic(topic)
             prog.show()
-        for handler in handlers:
-            handler.start()
-        active = handlers[:]
-        uncomp = self._uncompressor
-        uncompchecked = {}
-        self._speedupdated = self.time
-        cancelledtime = None
-        while active or self._uncompressing:
-            self.time = time.time()
-            if self._cancel:
-                if not cancelledtime:
-                    cancelledtime = self.time
+        # Items and handlers report changes through notifyItem() and
+        # wakeUp(), so the loop only runs when something happened, when
+        # speeds are due for an update, or when a handler which must
+        # be polled asks for it.
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags|os.O_NONBLOCK)
+        try:
+            self._events = events = deque(self._items.values())
+            running = {}
+            pool = self._uncompresspool
+            ownpool = None
+            if not pool:
+                pool = ownpool = self._startUncompressPool()
+            for handler in handlers:
+                handler.start()
+            active = handlers[:]
+            uncomp = self._uncompressor
+            uncompchecked = {}
+            self._speedupdated = self.time
+            cancelledtime = None
+            while active or self._uncompressing:
+                self.time = time.time()
+                if self._cancel:
+                    if not cancelledtime:
+                        cancelledtime = self.time
+                    for handler in active[:]:
+                        if not handler.wasCancelled():
+                            handler.cancel()
+                        if not handler.tick():
+                            active.remove(handler)
+                    # We won't wait for handlers which are not being nice.
+                    if time.time() > cancelledtime+CANCELDELAY:
+                        for item in self._items.values():
+                            if item.getStatus() != SUCCEEDED:
+                                item.setCancelled()
+                        # Remove handlers, since we don't know their state.
+                        self._handlers.clear()
+                        prog.show()
+                        break
+                    prog.show()
+                    self._wait(0.1)
+                    continue
                 for handler in active[:]:
-                    if not handler.wasCancelled():
-                        handler.cancel()
                     if not handler.tick():
                         active.remove(handler)
-                # We won't wait for handlers which are not being nice.
-                if time.time() > cancelledtime+CANCELDELAY:
-                    for item in self._items.values():
-                        if item.getStatus() != SUCCEEDED:
-                            item.setCancelled()
-                    # Remove handlers, since we don't know their state.
-                    self._handlers.clear()
-                    prog.show()
-                    break
-                prog.show()
-                continue
-            for handler in active[:]:
-                if not handler.tick():
-                    active.remove(handler)
-            if self._speedupdated+SPEEDDELAY < self.time:
-                self._speedupdated = self.time
-                updatespeed = True
-            else:
-                updatespeed = False
-            for url in self._items:
-                item = self._items[url]
-                if item.getStatus() == FAILED:
-                    if (item.getRetries() < MAXRETRIES and
-                        item.setNextURL()):
-                        item.reset()
-                        handler = self.getHandlerInstance(item)
-                        handler.enqueue(item)
-                        if handler not in active:
-                            active.append(handler)
-                    continue
-                elif (item.getStatus() != SUCCEEDED or
-                      not item.getInfo("uncomp")):
-                    if updatespeed:
+                while events:
+                    item = events.popleft()
+                    status = item.getStatus()
+                    if status is RUNNING:
+                        running[item] = True
+                        continue
+                    if item in running:
+                        del running[item]
+                    if status == FAILED:
+                        if (item.getRetries() < MAXRETRIES and
+                            item.setNextURL()):
+                            item.reset()
+                            handler = self.getHandlerInstance(item)
+                            handler.enqueue(item)
+                            if handler not in active:
+                                active.append(handler)
+                        continue
+                    elif status != SUCCEEDED or not item.getInfo("uncomp"):
+                        continue
+                    localpath = item.getTargetPath()
+                    if localpath in uncompchecked:
+                        continue
+                    uncompchecked[localpath] = True
+                    uncomphandler = uncomp.getHandler(localpath)
+                    if not uncomphandler:
+                        continue
+                    uncomppath = uncomphandler.getTargetPath(localpath)
+                    if (not self.hasStrongValidate(item, uncomp=True) or
+                        not self.validate(item, uncomppath, uncomp=True)):
+                        self._uncompressing += 1
+                        if pool:
+                            def uncompressed(error, item=item,
+                                             uncomppath=uncomppath):
+                                self._uncompressed(item, uncomppath, error)
+                            pool.apply_async(uncompressFile, (localpath,),
+                                             callback=uncompressed)
+                        else:
+                            thread.start_new_thread(self._uncompress,
+                                                    (item, localpath,
+                                                     uncomphandler))
+                    else:
+                        item.setSucceeded(uncomppath)
+                if self._speedupdated+SPEEDDELAY < self.time:
+                    self._speedupdated = self.time
+                    for item in running:
                         item.updateSpeed()
                         item.updateETA()
+                prog.show()
+                if events or not (active or self._uncompressing):
                     continue
-                localpath = item.getTargetPath()
-                if localpath in uncompchecked:
-                    continue
-                uncompchecked[localpath] = True
-                uncomphandler = uncomp.getHandler(localpath)
-                if not uncomphandler:
-                    continue
-                uncomppath = uncomphandler.getTargetPath(localpath)
-                if (not self.hasStrongValidate(item, uncomp=True) or
-                    not self.validate(item, uncomppath, uncomp=True)):
-                    self._uncompressing += 1
-                    thread.start_new_thread(self._uncompress,
-                                            (item, localpath, uncomphandler))
+                timeout = TICKDELAY
+                for handler in active:
+                    if handler.TICKDELAY and handler.TICKDELAY < timeout:
+                        timeout = handler.TICKDELAY
+                if running:
+                    timeout = min(timeout, max(0, self._speedupdated+SPEEDDELAY
+                                                  -time.time()))
+                self._wait(timeout)
+            if ownpool:
+                if self._cancel:
+                    ownpool.terminate()
                 else:
-                    item.setSucceeded(uncomppath)
-            prog.show()
-            time.sleep(0.1)
-        for handler in handlers:
-            handler.stop()
-        if not progress:
-            prog.stop()
+                    ownpool.close()
+                ownpool.join()
+            for handler in handlers:
+                handler.stop()
+            if not progress:
+                prog.stop()
+        finally:
+            # The pipe is closed here rather than when the fetcher goes
+            # away, so that fetchers don't hold descriptors meanwhile.
+            self._events = None
+            self._closeWakeUp()
         if thread_name == "MainThread":
             signal.signal(signal.SIGQUIT, old_quit_handler)
             signal.signal(signal.SIGINT, old_int_handler)
         if self._cancel:
             raise FetcherCancelled, _("Cancelled")
 
+    def startUncompressPool(self):
+        """
+        Start the worker processes asked for with uncompress-jobs, to
+        be used by every run of this fetcher and of its copies until
+        stopUncompressPool() is called. This must be done in the main
+        thread, before the copies run in other threads.
+        """
+        if (self._uncompresspool or
+            threading.currentThread().getName() != "MainThread"):
+            return
+        jobs = sysconf.get("uncompress-jobs", 1)
+        self._uncompresspool = self._newUncompressPool(jobs)
+
+    def stopUncompressPool(self):
+        pool = self._uncompresspool
+        if pool:
+            self._uncompresspool = None
+            pool.close()
+            pool.join()
+
+    def _startUncompressPool(self):
+        # Uncompressing is mostly CPU bound, so when several files may
+        # need it and uncompress-jobs allows, it's done by worker
+        # processes. These must be forked now, before handlers start
+        # their threads, and not at all when fetchers are running in
+        # other threads.
+        if threading.currentThread().getName() != "MainThread":
+            return None
+        jobs = sysconf.get("uncompress-jobs", 1)
+        if jobs < 2:
+            return None
+        uncomp = self._uncompressor
+        pending = [x for x in self._items.values()
+                   if x.getInfo("uncomp") and
+                      (x.getStatus() is WAITING or
+                       x.getStatus() is SUCCEEDED and
+                       uncomp.getHandler(x.getTargetPath()))]
+        return self._newUncompressPool(min(jobs, len(pending)))
+
+    def _newUncompressPool(self, jobs):
+        if jobs < 2:
+            return None
+        try:
+            import multiprocessing
+            return multiprocessing.Pool(jobs)
+        except (ImportError, OSError), e:
+            iface.debug(_("Uncompressing in threads: %s") % e)
+            return None
+
     def _uncompress(self, item, localpath, uncomphandler):
         try:
             uncomphandler.uncompress(localpath)
         except Error, e:
-            item.setFailed(unicode(e))
+            error = unicode(e)
+        else:
+            error = None
+        self._uncompressed(item, uncomphandler.getTargetPath(localpath),
+                           error)
+
+    def _uncompressed(self, item, uncomppath, error):
+        if error:
+            item.setFailed(error)
         else:
-            uncomppath = uncomphandler.getTargetPath(localpath)
             valid, reason = self.validate(item, uncomppath,
                                           withreason=True, uncomp=True)
             if not valid:
@@ -323,6 +528,7 @@ class Fetcher(object):
             else:
                 item.setSucceeded(uncomppath)
         self._uncompressing -= 1
+        self.wakeUp()
 
     def getLocalSchemes(self):
         return self._localschemes
@@ -364,7 +570,57 @@ class Fetcher(object):
                     item.getInfo(prefix+"sha") or
                     item.getInfo(prefix+"sha256"))
 
-    def validate(self, item, localpath, withreason=False, uncomp=False):
+    def getDigestKinds(self, item, uncomp=False):
+        """Return the kinds of digests item is validated with."""
+        if uncomp:
+            prefix = "uncomp_"
+        else:
+            prefix = ""
+        kinds = []
+        if item.getInfo(prefix+"md5"):
+            kinds.append("md5")
+        if item.getInfo(prefix+"sha256"):
+            kinds.append("sha256")
+        elif item.getInfo(prefix+"sha"):
+            kinds.append("sha")
+        return kinds
+
+    def getDigester(self, item, uncomp=False):
+        """
+        Return a Digester for what item is validated with, or None if
+        it has no digests to be checked against.
+        """
+        kinds = self.getDigestKinds(item, uncomp)
+        if kinds:
+            return Digester(kinds)
+        return None
+
+    def getDigests(self, localpath, kinds, digests=None):
+        """
+        Return a dictionary with the given kinds of digests of localpath,
+        taking them from digests computed while it was written, or from
+        the digest cache, and reading the file at most once for the
+        missing ones.
+        """
+        result = {}
+        if not digests:
+            digests = self._digestcache.get(localpath)
+        for kind in kinds:
+            if kind in digests:
+                result[kind] = digests[kind]
+        missing = [kind for kind in kinds if kind not in result]
+        if missing:
+            digester = Digester(missing)
+            digester.updateFromFile(localpath)
+            computed = digester.getDigests()
+            self._digestcache.set(localpath, computed)
+            result.update(computed)
+        return result
+
+    def validate(self, item, localpath, withreason=False, uncomp=False,
+                 digests=None):
+        # When given, digests were computed while localpath was being
+        # written, and are used instead of reading it again.
         try:
             if not os.path.isfile(localpath):
                 raise Error, _("File not found for validation")
@@ -391,53 +647,27 @@ class Fetcher(object):
                     raise Error, _("Unexpected size (expected %d, got %d)") % \
                                  (size, lsize)
 
+            kinds = self.getDigestKinds(item, uncomp)
+            if kinds:
+                ldigests = self.getDigests(localpath, kinds, digests)
+
             filemd5 = item.getInfo(uncompprefix+"md5")
             if filemd5:
-                try:
-                    from hashlib import md5
-                except ImportError:
-                    from md5 import md5
-                digest = md5()
-                file = open(localpath)
-                data = file.read(BLOCKSIZE)
-                while data:
-                    digest.update(data)
-                    data = file.read(BLOCKSIZE)
-                lfilemd5 = digest.hexdigest()
+                lfilemd5 = ldigests["md5"]
                 if lfilemd5 != filemd5:
                     raise Error, _("Invalid MD5 (expected %s, got %s)") % \
                                  (filemd5, lfilemd5)
 
             filesha256 = item.getInfo(uncompprefix+"sha256")
             if filesha256:
-                try:
-                    from hashlib import sha256
-                except ImportError:
-                    from smart.util.sha256 import sha256
-                digest = sha256()
-                file = open(localpath)
-                data = file.read(BLOCKSIZE)
-                while data:
-                    digest.update(data)
-                    data = file.read(BLOCKSIZE)
-                lfilesha256 = digest.hexdigest()
+                lfilesha256 = ldigests["sha256"]
                 if lfilesha256 != filesha256:
                    raise Error, _("Invalid SHA256 (expected %s, got %s)") % \
                                  (filesha256, lfilesha256)
             else:
                 filesha = item.getInfo(uncompprefix+"sha")
                 if filesha:
-                    try:
-                        from hashlib import sha1 as sha
-                    except ImportError:
-                        from sha import sha
-                    digest = sha()
-                    file = open(localpath)
-                    data = file.read(BLOCKSIZE)
-                    while data:
-                        digest.update(data)
-                        data = file.read(BLOCKSIZE)
-                    lfilesha = digest.hexdigest()
+                    lfilesha = ldigests["sha"]
                     if lfilesha != filesha:
                         raise Error, _("Invalid SHA (expected %s, got %s)") % \
                                      (filesha, lfilesha)
@@ -450,6 +680,302 @@ class Fetcher(object):
                 return True, None
             return True
 
+def newDigest(kind):
+    if kind == "md5":
+        try:
+            from hashlib import md5
+        except ImportError:
+            from md5 import md5
+        return md5()
+    elif kind == "sha256":
+        try:
+            from hashlib import sha256
+        except ImportError:
+            from smart.util.sha256 import sha256
+        return sha256()
+    elif kind == "sha":
+        try:
+            from hashlib import sha1 as sha
+        except ImportError:
+            from sha import sha
+        return sha()
+    raise Error, _("Unknown digest: %s") % kind
+
+class Digester(object):
+    """
+    Compute several kinds of digests at once, while data goes by.
+    """
+
+    def __init__(self, kinds):
+        self._digests = [(kind, newDigest(kind)) for kind in kinds]
+
+    def update(self, data):
+        for kind, digest in self._digests:
+            digest.update(data)
+
+    def updateFromFile(self, path):
+        file = open(path)
+        try:
+            data = file.read(BLOCKSIZE)
+            while data:
+                self.update(data)
+                data = file.read(BLOCKSIZE)
+        finally:
+            file.close()
+
+    def getDigests(self):
+        digests = {}
+        for kind, digest in self._digests:
+            digests[kind] = digest.hexdigest()
+        return digests
+
+class DigestCache(object):
+    """
+    Digests of files which were checked before, trusted while the
+    size and modification time of the file stay the same. When a path
+    is given, they're kept there across runs.
+
+    Besides digest kinds, entries may hold the "etag" and
+    "last-modified" validators sent by the server the file came from.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._digests = None
+        self._changed = False
+        self._lock = thread.allocate_lock()
+
+    def _load(self):
+        self._digests = {}
+        if self._path and os.path.isfile(self._path):
+            try:
+                self._digests = loadCacheFile(self._path,
+                                              DIGESTCACHEVERSION)
+            except Exception, e:
+                iface.debug(_("Ignoring digest cache %s: %s") %
+                            (self._path, e))
+
+    def get(self, path):
+        """Return a {kind: hexdigest} dictionary for path."""
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {}
+        self._lock.acquire()
+        try:
+            if self._digests is None:
+                self._load()
+            entry = self._digests.get(path)
+        finally:
+            self._lock.release()
+        if entry and entry[:2] == (st.st_size, st.st_mtime):
+            return entry[2].copy()
+        return {}
+
+    def set(self, path, digests):
+        """Remember digests of path, as it is right now."""
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        self._lock.acquire()
+        try:
+            if self._digests is None:
+                self._load()
+            entry = self._digests.get(path)
+            if entry and entry[:2] == (st.st_size, st.st_mtime):
+                entry[2].update(digests)
+            else:
+                self._digests[path] = (st.st_size, st.st_mtime,
+                                       digests.copy())
+            self._changed = True
+        finally:
+            self._lock.release()
+
+    def save(self):
+        """Write digests to disk, forgetting files which are gone."""
+        if not self._changed or not self._path:
+            return
+        self._lock.acquire()
+        try:
+            for path in self._digests.keys():
+                if not os.path.isfile(path):
+                    del self._digests[path]
+            dumpCacheFile(self._path, self._digests, DIGESTCACHEVERSION)
+            self._changed = False
+        finally:
+            self._lock.release()
+
+class HostScheduler(object):
+    """
+    Decide how many downloads may run at once from each host. It
+    starts with a few, adds one more while the throughput seen from
+    the host keeps growing with them, and halves them when the host
+    fails, so that slow or overloaded hosts get fewer connections and
+    fast ones more, up to the given maximum. Hosts which failed last
+    time the mirror system heard of them start with fewer.
+    """
+
+    def __init__(self, maximum=MAXHOSTDOWNLOADS, mirrorsystem=None):
+        self._maximum = maximum
+        self._mirrorsystem = mirrorsystem
+        self._hosts = {} # host -> HostState
+        self._lock = thread.allocate_lock()
+
+    def setMaximum(self, maximum):
+        self._lock.acquire()
+        try:
+            self._maximum = max(1, maximum)
+            for state in self._hosts.values():
+                state.limit = min(state.limit, self._maximum)
+        finally:
+            self._lock.release()
+
+    def getMaximum(self):
+        return self._maximum
+
+    def _getState(self, host):
+        state = self._hosts.get(host)
+        if not state:
+            limit = min(INITIALHOSTDOWNLOADS, self._maximum)
+            # Failures kept in the mirror history since the host last
+            # transferred something halve the limit, as they would
+            # have if they happened now.
+            for i in range(self._getHistoryFailures(host)):
+                limit = max(1, limit/2)
+            state = self._hosts[host] = HostState(limit)
+        return state
+
+    def _getHistoryFailures(self, host):
+        if not self._mirrorsystem:
+            return 0
+        failures = 0
+        for mirror, info in self._mirrorsystem.getHistory()[:]:
+            try:
+                if URL(mirror).host != host:
+                    continue
+            except Error:
+                continue
+            if info.get("size"):
+                break
+            if info.get("failed"):
+                failures += 1
+        return failures
+
+    def getLimit(self, host):
+        self._lock.acquire()
+        try:
+            return self._getState(host).limit
+        finally:
+            self._lock.release()
+
+    def getActive(self, host):
+        self._lock.acquire()
+        try:
+            return self._getState(host).active
+        finally:
+            self._lock.release()
+
+    def start(self, host):
+        """
+        Account for a download starting from host, and return True,
+        or return False if the host has as many running as it may.
+        """
+        self._lock.acquire()
+        try:
+            state = self._getState(host)
+            if state.active >= state.limit:
+                return False
+            if not state.active:
+                # Time while the host was idle says nothing about it.
+                state.newRound(time.time())
+            state.active += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def finish(self, host, size=None, failed=False):
+        """
+        Account for a download from host being over. The size fetched
+        tells the download succeeded, failed tells the host couldn't
+        cope with it, and with neither the download just gave its
+        place away, as when it's cancelled or the file isn't there.
+        """
+        self._lock.acquire()
+        try:
+            state = self._getState(host)
+            state.active -= 1
+            now = time.time()
+            if failed:
+                state.limit = max(1, state.limit/2)
+                state.rate = None
+                state.newRound(now)
+            elif size is not None:
+                state.size += size
+                state.done += 1
+                if state.done >= state.limit:
+                    # A round is over, with as many downloads finished
+                    # as are allowed to run at once.
+                    elapsed = now-state.start
+                    if elapsed > 0:
+                        rate = state.size/elapsed
+                        if state.rate is None or rate > state.rate*1.1:
+                            state.limit = min(state.limit+1,
+                                              self._maximum)
+                        elif rate < state.rate*0.5 and state.limit > 1:
+                            state.limit -= 1
+                        state.rate = rate
+                    state.newRound(now)
+        finally:
+            self._lock.release()
+
+class HostState(object):
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.rate = None
+        self.newRound(time.time())
+
+    def newRound(self, now):
+        self.start = now
+        self.size = 0
+        self.done = 0
+
+class RateLimiter(object):
+    """
+    Keep data coming at no more than the given rate, in bytes per
+    second, across every download sharing the limiter. Each block
+    received waits for its turn, so downloads running at the same time
+    get fair shares of the bandwidth, however many of them there are.
+    """
+
+    def __init__(self, rate=0):
+        self._rate = rate
+        self._next = 0
+        self._lock = thread.allocate_lock()
+
+    def setRate(self, rate):
+        self._rate = rate
+
+    def getRate(self):
+        return self._rate
+
+    def consume(self, size):
+        """Wait until size more bytes may have come through."""
+        rate = self._rate
+        if not rate:
+            return
+        self._lock.acquire()
+        now = time.time()
+        start = max(self._next, now)
+        self._next = end = start+float(size)/rate
+        self._lock.release()
+        if end > now:
+            time.sleep(end-now)
+
 class FetchItem(object):
 
     def __init__(self, fetcher, url, mirror):
@@ -506,6 +1032,9 @@ class FetchItem(object):
     def getOriginalURL(self):
         return self._url
 
+    def getAlternativeURLs(self):
+        return self._mirror.getAlternatives()
+
     def getURL(self):
         return self._urlobj
 
@@ -547,7 +1076,8 @@ class FetchItem(object):
     def start(self):
         if self._status is WAITING:
             self._status = RUNNING
-            self._starttime = self._fetcher.time
+            self._starttime = time.time()
+            self._fetcher.notifyItem(self)
             prog = self._progress
             url = self._urlobj.original
             prog.setSubTopic(url, url)
@@ -593,13 +1123,16 @@ class FetchItem(object):
             else:
                 self._eta = None
 
-    def setSucceeded(self, targetpath, fetchedsize=0):
+    def setSucceeded(self, targetpath, fetchedsize=0, digests=None):
         if self._status is not FAILED:
             self._status = SUCCEEDED
             self._targetpath = targetpath
+            if digests:
+                self._fetcher.getDigestCache().set(targetpath, digests)
+            self._fetcher.notifyItem(self)
             if self._starttime:
                 if fetchedsize:
-                    now = self._fetcher.time
+                    now = time.time()
                     timedelta = now-self._starttime
                     if timedelta < 1:
                         timedelta = 1
@@ -611,6 +1144,7 @@ class FetchItem(object):
     def setFailed(self, reason):
         self._status = FAILED
         self._failedreason = reason
+        self._fetcher.notifyItem(self)
         if self._starttime:
             self._mirror.addInfo(failed=1)
             self._progress.setSubStopped(self._urlobj.original)
@@ -619,6 +1153,10 @@ class FetchItem(object):
     def setCancelled(self):
         self.setFailed(_("Cancelled"))
 
+def getItemOrder(item):
+    """Return a key sorting items in the order they should be fetched."""
+    return item.getInfo("size") or 0
+
 class URL(object):
     def __init__(self, url=None):
         if url:
@@ -692,6 +1230,12 @@ class URL(object):
         return url
 
 class FetcherHandler(object):
+
+    # Handlers which only make progress when ticked should be ticked
+    # this often. Handlers whose threads report every change through
+    # the items and changeActiveDownloads() may set it to None.
+    TICKDELAY = 0.1
+
     def __init__(self, fetcher):
         self._fetcher = fetcher
         self._queue = []
@@ -710,8 +1254,9 @@ class FetcherHandler(object):
         self._queue.remove(item)
 
     def start(self):
-        # Fetcher is starting.
-        self._queue.sort()
+        # Fetcher is starting. Items are taken from the end of the
+        # queue, so the smallest ones are put there.
+        self._queue.sort(key=getItemOrder, reverse=True)
         self._cancel = False
 
     def stop(self):
@@ -777,6 +1322,7 @@ class FetcherHandler(object):
 class FileHandler(FetcherHandler):
 
     RETRIES = 3
+    TICKDELAY = None
 
     def __init__(self, *args):
         FetcherHandler.__init__(self, *args)
@@ -865,7 +1411,7 @@ class FileHandler(FetcherHandler):
 
     def copy(self):
         while self._queue:
-            item = self._queue.pop(0)
+            item = self._queue.pop()
             item.start()
             retries = 0
             filepath = item.getURL().path
@@ -880,6 +1426,10 @@ class FileHandler(FetcherHandler):
                         if not data:
                             break
                         output.write(data)
+                    # The file may be uncompressed by another process
+                    # as soon as the item succeeds.
+                    output.close()
+                    input.close()
                 except (IOError, OSError), e:
                     error = unicode(e)
                     retries += 1
@@ -889,6 +1439,7 @@ class FileHandler(FetcherHandler):
             else:
                 item.setFailed(error)
         self._active = False
+        self._fetcher.wakeUp()
 
 Fetcher.setHandler("file", FileHandler, local=True)
 
@@ -935,6 +1486,7 @@ class FTPHandler(FetcherHandler):
     MAXPERHOST = 2
 
     TIMEOUT = 60
+    TICKDELAY = None
 
     def __init__(self, *args):
         FetcherHandler.__init__(self, *args)
@@ -1071,12 +1623,21 @@ class FTPHandler(FetcherHandler):
                 except (IOError, OSError), e:
                     raise Error, "%s: %s" % (localpathpart, e)
 
+                digester = fetcher.getDigester(item)
+                if digester and rest:
+                    digester.updateFromFile(localpathpart)
+
+                limiter = fetcher.getRateLimiter()
+
                 def write(data):
                     if self._cancel:
                         raise FetcherCancelled
                     local.write(data)
+                    if digester:
+                        digester.update(data)
                     item.current += len(data)
                     item.progress(item.current, total)
+                    limiter.consume(len(data))
 
                 try:
                     try:
@@ -1085,6 +1646,7 @@ class FTPHandler(FetcherHandler):
                     except ftplib.error_perm:
                         iface.debug("Server does not support resume. \
                                     Restarting...")
+                        digester = None
                 finally:
                     local.close()
 
@@ -1093,8 +1655,10 @@ class FTPHandler(FetcherHandler):
 
                 os.rename(localpathpart, localpath)
 
+                digests = digester and digester.getDigests()
                 valid, reason = fetcher.validate(item, localpath,
-                                                 withreason=True)
+                                                 withreason=True,
+                                                 digests=digests)
                 if not valid:
                     if openmode == "a":
                         # Try again, from the very start.
@@ -1111,7 +1675,7 @@ class FTPHandler(FetcherHandler):
                         fetchedsize = os.path.getsize(localpath)
                     else:
                         fetchedsize = None
-                    item.setSucceeded(localpath, fetchedsize)
+                    item.setSucceeded(localpath, fetchedsize, digests)
             else:
                 item.setSucceeded(localpath)
 
@@ -1142,25 +1706,326 @@ Fetcher.setHandler("ftp", FTPHandler)
 class URLLIBHandler(FetcherHandler):
 
     MAXACTIVE = 5
+    TICKDELAY = None
 
     def __init__(self, *args):
         FetcherHandler.__init__(self, *args)
         self._active = 0
         self._lock = thread.allocate_lock()
+        self._pool = None
+
+    def start(self):
+        FetcherHandler.start(self)
+        if sysconf.get("http-keep-alive", True):
+            from smart.util.httppool import HTTPConnectionPool
+            self._pool = HTTPConnectionPool(
+                sysconf.get("max-host-connections", self.MAXACTIVE))
+
+    def stop(self):
+        FetcherHandler.stop(self)
+        if self._pool:
+            self._pool.closeIdle()
+            self._pool = None
+
+    def usesPool(self, url):
+        # Connections are kept open and reused, unless a proxy is
+        # in use, which the opener knows how to deal with.
+        return (self._pool and url.scheme in ("http", "https") and
+                url.scheme not in urllib.getproxies())
+
+    def open(self, opener, url):
+        if self.usesPool(url):
+            return self._pool.open(url.original, opener.addheaders,
+                                   url.user, url.passwd)
+        return opener.open(url.original)
+
+    def getStreamUncompressor(self, item, localpath):
+        # Files which may be validated once uncompressed, as most
+        # metadata, are uncompressed while they arrive.
+        fetcher = self._fetcher
+        if (not item.getInfo("uncomp") or
+            not fetcher.hasStrongValidate(item, uncomp=True) or
+            not sysconf.get("stream-uncompress", True)):
+            return None
+        handler = fetcher.getUncompressor().getHandler(localpath)
+        if not handler:
+            return None
+        return handler.getStreamUncompressor(
+                    localpath, fetcher.getDigester(item, uncomp=True))
+
+    def setValidators(self, localpath, info):
+        # The modification time is set before validators and digests
+        # are cached, since they're kept along with it.
+        import rfc822, calendar
+        validators = {}
+        if "last-modified" in info:
+            mtimes = info["last-modified"]
+            mtimet = rfc822.parsedate(mtimes)
+            if mtimet:
+                mtime = calendar.timegm(mtimet)
+                os.utime(localpath, (mtime, mtime))
+                validators["last-modified"] = mtimes
+        if "etag" in info:
+            validators["etag"] = info["etag"]
+        if validators:
+            self._fetcher.getDigestCache().set(localpath, validators)
+
+    def setSucceeded(self, item, localpath, fetchedsize, digests,
+                     stream=None):
+        fetcher = self._fetcher
+        if stream:
+            uncomppath = stream.close()
+            if uncomppath:
+                uncompdigests = stream.getDigests()
+                if fetcher.validate(item, uncomppath, uncomp=True,
+                                    digests=uncompdigests):
+                    if digests:
+                        fetcher.getDigestCache().set(localpath, digests)
+                    item.setSucceeded(uncomppath, fetchedsize,
+                                      uncompdigests)
+                    return
+                os.unlink(uncomppath)
+        item.setSucceeded(localpath, fetchedsize, digests)
+
+    def getSegmentRanges(self, item, localpath, size):
+        """
+        Return the (start, end) byte ranges in which item should be
+        fetched in parallel, or None if it should come in a single
+        stream.
+        """
+        segments = sysconf.get("download-segments", 1)
+        minsize = sysconf.get("download-segment-size", MINSEGMENTSIZE)
+        if (segments < 2 or not size or minsize < 1 or
+            not self.usesPool(item.getURL()) or
+            os.path.isfile(localpath+".part")):
+            return None
+        segments = min(segments, size/minsize)
+        if segments < 2:
+            return None
+        length = size/segments
+        ranges = []
+        for i in range(segments):
+            ranges.append((i*length, (i+1)*length-1))
+        ranges[-1] = (ranges[-1][0], size-1)
+        return ranges
+
+    def openRange(self, url, start, end):
+        headers = [("User-Agent", "smart/" + VERSION),
+                   ("Range", "bytes=%d-%d" % (start, end))]
+        remote = self._pool.open(url.original, headers,
+                                 url.user, url.passwd)
+        if hasattr(remote, "errcode"):
+            return remote
+        contentrange = remote.info().get("content-range", "")
+        if (remote.code != 206 or
+            not contentrange.startswith("bytes %d-" % start)):
+            # The server doesn't know about ranges, and is sending
+            # the whole file.
+            remote.close()
+            return None
+        return remote
+
+    def fetchSegments(self, item, localpath, ranges):
+        """
+        Fetch the given byte ranges of item at once, each one into its
+        own part file, possibly from different mirrors, and join them
+        into localpath. Part files are kept when something fails, so
+        that the next try resumes them. Return False, without having
+        fetched anything, if the server doesn't support ranges.
+        """
+        fetcher = self._fetcher
+        urls = [item.getURL()]
+        for url in item.getAlternativeURLs():
+            url = URL(url)
+            if self.usesPool(url):
+                urls.append(url)
+        size = ranges[-1][1]+1
+        paths = []
+        done = []
+        pending = []
+        for i, (start, end) in enumerate(ranges):
+            path = "%s.part.%d" % (localpath, start)
+            partsize = 0
+            if os.path.isfile(path):
+                partsize = os.path.getsize(path)
+                if partsize > end-start+1:
+                    os.unlink(path)
+                    partsize = 0
+            paths.append(path)
+            done.append(partsize)
+            if start+partsize <= end:
+                pending.append(i)
+        fetched = [0]
+        errors = []
+        info = None
+        lock = thread.allocate_lock()
+        limiter = self._fetcher.getRateLimiter()
+
+        def read(i, remote):
+            try:
+                local = open(paths[i], "a")
+            except (IOError, OSError), e:
+                remote.close()
+                raise IOError, "%s: %s" % (paths[i], e)
+            try:
+                data = remote.read(BLOCKSIZE)
+                while data:
+                    if self._cancel:
+                        raise FetcherCancelled
+                    local.write(data)
+                    lock.acquire()
+                    done[i] += len(data)
+                    fetched[0] += len(data)
+                    current = sum(done)
+                    lock.release()
+                    item.progress(current, size)
+                    limiter.consume(len(data))
+                    data = remote.read(BLOCKSIZE)
+            finally:
+                local.close()
+                remote.close()
+            start, end = ranges[i]
+            if start+done[i] <= end:
+                raise Error, _("Connection closed before the download "
+                               "was complete")
+
+        def segment(i):
+            # Segments are spread over the known mirrors, and whatever
+            # fails there is resumed from the item's own URL.
+            url = urls[i%len(urls)]
+            while True:
+                try:
+                    start, end = ranges[i]
+                    remote = self.openRange(url, start+done[i], end)
+                    if remote is None or hasattr(remote, "errcode"):
+                        if remote:
+                            remote.close()
+                        raise Error, _("Mirror doesn't support ranges")
+                    read(i, remote)
+                except FetcherCancelled:
+                    errors.append(FetcherCancelled())
+                except (IOError, OSError, Error, socket.error), e:
+                    if url is not urls[0]:
+                        url = urls[0]
+                        continue
+                    errors.append(e)
+                break
+
+        if pending:
+            # Ask for the first segment before anything else, to find
+            # out whether the server is able to send ranges at all.
+            i = pending.pop(0)
+            start, end = ranges[i]
+            remote = self.openRange(urls[0], start+done[i], end)
+            if remote is None:
+                return False
+            if hasattr(remote, "errcode"):
+                raise remote
+            info = remote.info()
+            threads = []
+            for j in pending:
+                t = threading.Thread(target=segment, args=(j,))
+                t.start()
+                threads.append(t)
+            try:
+                read(i, remote)
+            finally:
+                for t in threads:
+                    t.join()
+            for e in errors:
+                raise e
+
+        # Parts arrive out of order, so digests are computed, and the
+        # file uncompressed, while they're joined, since they must be
+        # read anyway.
+        localpathpart = localpath+".part"
+        try:
+            local = open(localpathpart, "w")
+        except (IOError, OSError), e:
+            raise IOError, "%s: %s" % (localpathpart, e)
+        digester = fetcher.getDigester(item)
+        stream = self.getStreamUncompressor(item, localpath)
+        try:
+            try:
+                for path in paths:
+                    part = open(path)
+                    data = part.read(BLOCKSIZE)
+                    while data:
+                        local.write(data)
+                        if digester:
+                            digester.update(data)
+                        if stream:
+                            stream.write(data)
+                        data = part.read(BLOCKSIZE)
+                    part.close()
+            except:
+                if stream:
+                    stream.abort()
+                raise
+        finally:
+            local.close()
+        os.rename(localpathpart, localpath)
+        for path in paths:
+            os.unlink(path)
+
+        digests = digester and digester.getDigests()
+        valid, reason = fetcher.validate(item, localpath, withreason=True,
+                                         digests=digests)
+        if not valid:
+            if stream:
+                stream.abort()
+            os.unlink(localpath)
+            raise Error, reason
+        if info:
+            self.setValidators(localpath, info)
+        self.setSucceeded(item, localpath, fetched[0], digests, stream)
+        return True
+
+    def popItem(self):
+        # Must be called with the lock held. Takes the smallest item
+        # queued whose host may have one more download.
+        scheduler = self._fetcher.getHostScheduler()
+        for i in range(len(self._queue)-1,-1,-1):
+            item = self._queue[i]
+            if scheduler.start(item.getURL().host):
+                del self._queue[i]
+                return item
+        return None
+
+    def nextItem(self, item, size=None, failed=False):
+        # Tells the host scheduler how fetching item went, and returns
+        # the next item the calling thread should fetch, if any.
+        self._fetcher.getHostScheduler().finish(item.getURL().host,
+                                                size, failed)
+        if self._cancel:
+            return None
+        self._lock.acquire()
+        try:
+            return self.popItem()
+        finally:
+            self._lock.release()
 
     def tick(self):
+        # Threads are started while hosts with queued items may have
+        # more downloads running. Each one keeps fetching until none
+        # of them may, and whenever a download is over the fetcher is
+        # woken up and ticks again.
         self._lock.acquire()
-        if self._queue:
-            while (self._active < self.MAXACTIVE and
-                   self.changeActiveDownloads(+1)):
-                self._active += 1
-                thread.start_new_thread(self.fetch, ())
+        while self._queue:
+            item = self.popItem()
+            if not item:
+                break
+            if not self.changeActiveDownloads(+1):
+                self._fetcher.getHostScheduler().finish(item.getURL().host)
+                self._queue.append(item)
+                break
+            self._active += 1
+            thread.start_new_thread(self.fetch, (item,))
         self._lock.release()
         return bool(self._queue or self._active)
 
-    def fetch(self):
-        import urllib, rfc822, calendar
-        from time import time, sleep
+    def fetch(self, item):
+        import urllib, rfc822
 
         class Opener(urllib.FancyURLopener):
             user = None
@@ -1186,18 +2051,20 @@ class URLLIBHandler(FetcherHandler):
         opener = Opener()
         
         fetcher = self._fetcher
+        limiter = fetcher.getRateLimiter()
 
-        while not self._cancel:
+        while item:
 
-            self._lock.acquire()
-            if not self._queue:
-                self._lock.release()
-                break
-            item = self._queue.pop()
-            self._lock.release()
+            if self._cancel:
+                item.setCancelled()
+                item = self.nextItem(item)
+                continue
 
             url = item.getURL()
 
+            fetchedsize = None
+            failed = False
+
             opener.user = url.user
             opener.passwd = url.passwd
 
@@ -1217,9 +2084,23 @@ class URLLIBHandler(FetcherHandler):
 
                 if (os.path.isfile(localpath) and
                     fetcher.validate(item, localpath)):
-                    mtime = os.path.getmtime(localpath)
-                    opener.addheader("if-modified-since",
-                                     rfc822.formatdate(mtime))
+                    # Ask for it only if it changed since it was
+                    # fetched, using what the server said back then.
+                    validators = fetcher.getDigestCache().get(localpath)
+                    lastmodified = validators.get("last-modified")
+                    if not lastmodified:
+                        mtime = os.path.getmtime(localpath)
+                        lastmodified = rfc822.formatdate(mtime)
+                    opener.addheader("if-modified-since", lastmodified)
+                    if validators.get("etag"):
+                        opener.addheader("if-none-match",
+                                         validators["etag"])
+                else:
+                    ranges = self.getSegmentRanges(item, localpath, size)
+                    if (ranges and
+                        self.fetchSegments(item, localpath, ranges)):
+                        item = self.nextItem(item, size)
+                        continue
 
                 localpathpart = localpath+".part"
                 if os.path.isfile(localpathpart):
@@ -1229,16 +2110,18 @@ class URLLIBHandler(FetcherHandler):
                 else:
                     partsize = 0
 
-                remote = opener.open(url.original)
+                remote = self.open(opener, url)
 
                 if hasattr(remote, "errcode") and remote.errcode == 416:
                     # Range not satisfiable, try again without it.
+                    remote.close()
                     opener.addheaders = [x for x in opener.addheaders
                                          if x[0] != "range"]
-                    remote = opener.open(url.original)
+                    remote = self.open(opener, url)
 
                 if hasattr(remote, "errcode") and remote.errcode != 206:
                     # 206 = Partial Content
+                    remote.close()
                     raise remote
 
                 info = remote.info()
@@ -1257,45 +2140,64 @@ class URLLIBHandler(FetcherHandler):
                     partsize = 0
                     openmode = "w"
 
+                digester = fetcher.getDigester(item)
+                if digester and partsize:
+                    digester.updateFromFile(localpathpart)
+
                 if size and total and size != total:
+                    remote.close()
                     raise Error, _("Server reports unexpected size")
 
                 try:
                     local = open(localpathpart, openmode)
                 except (IOError, OSError), e:
+                    remote.close()
                     raise IOError, "%s: %s" % (localpathpart, e)
 
-                rate_limit = self._fetcher._maxdownloadrate
-                if rate_limit:
-                    rate_limit /= self._active
-                    start = time()
+                stream = None
+                if not partsize:
+                    stream = self.getStreamUncompressor(item, localpath)
 
                 try:
-                    data = remote.read(BLOCKSIZE)
-                    while data:
-                        if self._cancel:
-                            raise FetcherCancelled
-                        local.write(data)
-                        current += len(data)
-                        item.progress(current, total)
-                        if rate_limit:
-                            elapsed_time = time() - start
-                            if elapsed_time != 0:
-                                rate = current / elapsed_time
-                                expected_time = current / rate_limit
-                                sleep_time = expected_time - elapsed_time
-                                if sleep_time > 0:
-                                    sleep(sleep_time)
+                    try:
                         data = remote.read(BLOCKSIZE)
+                        while data:
+                            if self._cancel:
+                                raise FetcherCancelled
+                            local.write(data)
+                            if digester:
+                                digester.update(data)
+                            if stream:
+                                stream.write(data)
+                            current += len(data)
+                            item.progress(current, total)
+                            limiter.consume(len(data))
+                            data = remote.read(BLOCKSIZE)
+                    except:
+                        if stream:
+                            stream.abort()
+                        raise
                 finally:
                     local.close()
                     remote.close()
 
+                if total and current < total:
+                    # Keep the part file, so that the next try
+                    # resumes from where this one stopped.
+                    if stream:
+                        stream.abort()
+                    raise Error, _("Connection closed before the download "
+                                   "was complete")
+
                 os.rename(localpathpart, localpath)
 
+                digests = digester and digester.getDigests()
                 valid, reason = fetcher.validate(item, localpath,
-                                                 withreason=True)
+                                                 withreason=True,
+                                                 digests=digests)
                 if not valid:
+                    if stream:
+                        stream.abort()
                     if openmode == "a":
                         # Try again, from the very start.
                         item.reset()
@@ -1311,23 +2213,24 @@ class URLLIBHandler(FetcherHandler):
                         fetchedsize = os.path.getsize(localpath)
                     else:
                         fetchedsize = None
-                    item.setSucceeded(localpath, fetchedsize)
 
-                    if "last-modified" in info:
-                        mtimes = info["last-modified"]
-                        mtimet = rfc822.parsedate(mtimes)
-                        if mtimet:
-                            mtime = calendar.timegm(mtimet)
-                            os.utime(localpath, (mtime, mtime))
+                    self.setValidators(localpath, info)
+                    self.setSucceeded(item, localpath, fetchedsize, digests,
+                                      stream)
+                    fetchedsize = fetchedsize or 0
 
             except urllib.addinfourl, remote:
                 if remote.errcode == 304: # Not modified
                     item.setSucceeded(localpath)
+                    fetchedsize = 0
                 elif remote.errcode == 404:
                     # Use a standard translatable error message.
                     item.setFailed(_("File not found"))
                 else:
                     item.setFailed(remote.errmsg)
+                    # Only errors telling the server is busy or broken
+                    # count against it.
+                    failed = remote.errcode >= 500 or remote.errcode == 429
 
             except (IOError, OSError, Error, socket.error), e:
                 try:
@@ -1335,10 +2238,13 @@ class URLLIBHandler(FetcherHandler):
                 except IndexError:
                     errmsg = unicode(e)
                 item.setFailed(errmsg)
+                failed = True
 
             except FetcherCancelled:
                 item.setCancelled()
 
+            item = self.nextItem(item, fetchedsize, failed)
+
         self._lock.acquire()
         self._active -= 1
         self._lock.release()
@@ -1359,6 +2265,7 @@ class URLLIB2Handler(FetcherHandler):
 
     MAXACTIVE = 1
     USECACHEDFTP = True
+    TICKDELAY = None
 
     _openerinstalled = False
 
@@ -1523,7 +2430,6 @@ class PyCurlHandler(FetcherHandler):
 
     MAXACTIVE = 5
     MAXINACTIVE = 5
-    MAXPERHOST = 2
 
     def __init__(self, *args):
         import pycurl
@@ -1543,6 +2449,7 @@ class PyCurlHandler(FetcherHandler):
             thread.start_new_thread(self.perform, ())
 
         fetcher = self._fetcher
+        scheduler = fetcher.getHostScheduler()
         multi = self._multi
 
         if self._cancel:
@@ -1553,6 +2460,7 @@ class PyCurlHandler(FetcherHandler):
                 url = item.getURL()
                 multi.remove_handle(handle)
                 userhost = (url.user, url.host, url.port)
+                scheduler.finish(url.host)
             self._active.clear()
             self._lock.release()
 
@@ -1599,12 +2507,19 @@ class PyCurlHandler(FetcherHandler):
 
                 if http_code == 404:
                     item.setFailed(_("File not found"))
+                    scheduler.finish(url.host)
                 else:
+                    scheduler.finish(url.host,
+                                     handle.getinfo(pycurl.SIZE_DOWNLOAD))
+                    digests = None
+                    if handle.digester and not handle.partsize:
+                        digests = handle.digester.getDigests()
                     valid, reason = fetcher.validate(item, localpath,
-                                                     withreason=True)
+                                                     withreason=True,
+                                                     digests=digests)
                     if valid:
                         fetchedsize = handle.getinfo(pycurl.SIZE_DOWNLOAD)
-                        item.setSucceeded(localpath, fetchedsize)
+                        item.setSucceeded(localpath, fetchedsize, digests)
                     elif handle.partsize:
                         self._queue.append(item)
                     else:
@@ -1634,16 +2549,20 @@ class PyCurlHandler(FetcherHandler):
                     os.unlink(localpath+".part")
                     item.reset()
                     self._queue.append(item)
+                    scheduler.finish(url.host)
                 elif handle.active and "password" in errmsg:
                     item.reset()
                     self._queue.append(item)
                     self._activelimit[item.getURL().host] = handle.active
                     del self._inactive[handle]
+                    scheduler.finish(url.host, failed=True)
                 elif http_code == 404:
                     # Use a standard translatable error message.
                     item.setFailed(_("File not found"))
+                    scheduler.finish(url.host)
                 else:
                     item.setFailed(errmsg)
+                    scheduler.finish(url.host, failed=True)
 
 
         if self._queue:
@@ -1654,10 +2573,12 @@ class PyCurlHandler(FetcherHandler):
                     schemehost = (url.scheme, url.host)
                     hostactive = [x for x in self._active
                                      if self._active[x] == schemehost]
-                    maxactive = self._activelimit.get(url.host,
-                                                      self.MAXPERHOST)
-                    if (len(hostactive) < maxactive and
-                        self.changeActiveDownloads(+1)):
+                    maxactive = self._activelimit.get(url.host)
+                    if ((not maxactive or len(hostactive) < maxactive) and
+                        scheduler.start(url.host)):
+                        if not self.changeActiveDownloads(+1):
+                            scheduler.finish(url.host)
+                            break
 
                         del self._queue[i]
 
@@ -1697,6 +2618,7 @@ class PyCurlHandler(FetcherHandler):
                             item.setFailed("%s: %s" % (localpathpart, e))
                             del self._active[handle]
                             self.changeActiveDownloads(-1)
+                            scheduler.finish(url.host)
                             continue
 
                         handle.item = item
@@ -1704,6 +2626,21 @@ class PyCurlHandler(FetcherHandler):
                         handle.localpath = localpath
                         handle.active = len(hostactive)
 
+                        # Digests are only computed for downloads
+                        # starting from scratch, since a resumed one
+                        # may restart if the server refuses ranges.
+                        digester = None
+                        if not partsize:
+                            digester = fetcher.getDigester(item)
+                        handle.digester = digester
+                        if digester:
+                            def write(data, local=local,
+                                      digester=digester):
+                                local.write(data)
+                                digester.update(data)
+                        else:
+                            write = local.write
+
                         item.start()
 
                         def progress(downtotal, downcurrent,
@@ -1722,7 +2659,7 @@ class PyCurlHandler(FetcherHandler):
                         handle.setopt(pycurl.LOW_SPEED_TIME, SOCKETTIMEOUT)
                         handle.setopt(pycurl.NOPROGRESS, 1)
                         handle.setopt(pycurl.PROGRESSFUNCTION, progress)
-                        handle.setopt(pycurl.WRITEDATA, local)
+                        handle.setopt(pycurl.WRITEFUNCTION, write)
                         handle.setopt(pycurl.FOLLOWLOCATION, 1)
                         handle.setopt(pycurl.MAXREDIRS, 5)
                         handle.setopt(pycurl.HTTPHEADER, ["Pragma:"])
@@ -1742,10 +2679,14 @@ class PyCurlHandler(FetcherHandler):
                             handle.setopt(pycurl.TIMECONDITION,
                                           pycurl.TIMECONDITION_NONE)
                                           
+                        # Handles can't wait for the shared rate limiter
+                        # without stalling the others, so each one gets
+                        # a share of the rate instead.
                         rate_limit = self._fetcher._maxdownloadrate
                         if rate_limit:
-                            rate_limit /= self._active
-                            handle.setopt(pycurl.MAX_RECV_SPEED_LARGE, rate_limit)
+                            rate_limit /= len(self._active)+1
+                            handle.setopt(pycurl.MAX_RECV_SPEED_LARGE,
+                                          long(rate_limit))
 
                         self._active[handle] = schemehost
                         self._lock.acquire()
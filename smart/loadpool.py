@@ -0,0 +1,178 @@
+#
+# Copyright (c) 2005 Conectiva, Inc.
+#
+# Written by Gustavo Niemeyer <niemeyer@conectiva.com>
+#
+# This file is part of Smart Package Manager.
+#
+# Smart Package Manager is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# Smart Package Manager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Smart Package Manager; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+from smart.cache import Package, Provides, Depends
+from smart.interface import Interface
+from smart import *
+from cStringIO import StringIO
+import threading
+import cPickle
+import sys
+
+#
+# Loaders which tell the attributes their load() method fills in, with
+# _loadattrs, may be loaded by worker processes. Workers are forked, so
+# they get the loaders without pickling them, and run load() with
+# buildPackage() recording its arguments. These are sent back with the
+# per-package loader data and the told attributes, which refer to the
+# packages by their position, and the packages are then built again
+# in the main process, in the same order loading would have built them.
+#
+
+_loaders = None
+
+class WorkerInterface(Interface):
+    """Interface of worker processes, keeping the messages shown."""
+
+    def __init__(self):
+        Interface.__init__(self, None)
+        self._messages = []
+
+    def getMessages(self):
+        return self._messages
+
+    def message(self, level, msg):
+        self._messages.append((level, msg))
+
+def loadLoaders(loaders):
+    """
+    Load the given loaders in order, yielding each one once it's done.
+    The ones which allow it are parsed by up to load-jobs worker
+    processes at once, and only have their packages built here.
+    """
+    global _loaders
+    parallel = [x for x in loaders if x._loadattrs is not None]
+    jobs = min(sysconf.get("load-jobs", 1), len(parallel))
+    pool = None
+    # Forking isn't safe once other threads are running.
+    if jobs > 1 and threading.currentThread().getName() == "MainThread":
+        _loaders = parallel
+        try:
+            try:
+                import multiprocessing
+                pool = multiprocessing.Pool(jobs)
+            except (ImportError, OSError), e:
+                iface.debug(_("Loading channels serially: %s") % e)
+        finally:
+            _loaders = None
+    if pool is None:
+        parallel = []
+    else:
+        results = pool.imap(_parseLoader, range(len(parallel)))
+    try:
+        for loader in loaders:
+            data = None
+            if loader in parallel:
+                try:
+                    data = results.next()
+                except Exception, e:
+                    iface.debug(_("Loading %s serially: %s") % (loader, e))
+            if data is None:
+                loader.load()
+            else:
+                buildLoader(loader, data)
+            yield loader
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def _parseLoader(index):
+    if _loaders is None:
+        return None
+    loader = _loaders[index]
+    iface.object = interface = WorkerInterface()
+    prog = interface.getProgress(None)
+    prog.set(0, sys.maxint)
+    built = []
+    buildPackage = loader.buildPackage
+    def recordPackage(*args):
+        pkg = buildPackage(*args)
+        built.append((args, pkg))
+        return pkg
+    loader.buildPackage = recordPackage
+    try:
+        loader.load()
+    finally:
+        del loader.buildPackage
+    positions = {}
+    records = []
+    for i, (args, pkg) in enumerate(built):
+        positions.setdefault(id(pkg), i)
+        if loader in pkg.loaders:
+            records.append((args, (pkg.loaders[loader],)))
+        else:
+            records.append((args, ()))
+    state = {}
+    for attr in loader._loadattrs:
+        state[attr] = getattr(loader, attr)
+    return (interface.getMessages(), prog.get()[0],
+            _dumps(records, {}), _dumps(state, positions))
+
+def buildLoader(loader, data):
+    """
+    Build the packages of loader from what a worker process parsed.
+    Strings the worker shared, as interned relation names, are still
+    shared once unpickled, and package names are interned here.
+    """
+    messages, steps, records, state = data
+    for level, msg in messages:
+        iface.message(level, msg)
+    buildPackage = loader.buildPackage
+    packages = []
+    for args, value in _loads(records, None):
+        pkgargs = args[0]
+        if type(pkgargs[1]) is str:
+            pkgargs = (pkgargs[0], intern(pkgargs[1]))+pkgargs[2:]
+        pkg = buildPackage(pkgargs, *args[1:])
+        if value:
+            pkg.loaders[loader] = value[0]
+        packages.append(pkg)
+    for attr, value in _loads(state, packages.__getitem__).items():
+        setattr(loader, attr, value)
+    prog = iface.getProgress(loader.getCache())
+    prog.add(steps)
+    prog.show()
+
+def _dumps(obj, positions):
+    # Packages are sent as their positions in the built ones, and
+    # no other cache object may be sent, as it'd arrive as a copy.
+    def persistentId(obj):
+        if isinstance(obj, (Package, Provides, Depends)):
+            i = positions.get(id(obj))
+            if i is None:
+                raise Error, _("Can't send %s from worker process") % obj
+            return i
+        return None
+    file = StringIO()
+    pickler = cPickle.Pickler(file, 2)
+    # Only called for objects which aren't of builtin types.
+    pickler.inst_persistent_id = persistentId
+    pickler.dump(obj)
+    return file.getvalue()
+
+def _loads(data, persistentLoad):
+    unpickler = cPickle.Unpickler(StringIO(data))
+    if persistentLoad:
+        unpickler.persistent_load = persistentLoad
+    return unpickler.load()
+
+# vim:ts=4:sw=4:et
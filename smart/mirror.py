@@ -20,17 +20,26 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 from smart import *
+import threading
+import urllib
 import random
+import socket
 import time
 
 HISTORYPERMIRROR = 20
 HISTORYCUTDELAY = 60
+HISTORYHALFLIFE = 7*24*60*60
 GRANULARITY = 100
+ROUNDTRIPS = 3
+PROBEDELAY = 24*60*60
+PROBETIMEOUT = 5
+PROBEPORTS = {"http": 80, "https": 443, "ftp": 21}
 
 class MirrorSystem(object):
 
     def __init__(self):
         self._mirrors = {}
+        self._preferences = {}
         self._history = []
         self._penality = {}
         self._changed = False
@@ -44,6 +53,17 @@ class MirrorSystem(object):
         self._changed = True
         self._mirrors = mirrors
 
+    def getPreferences(self):
+        return self._preferences
+
+    def setPreferences(self, preferences):
+        """
+        Set how much mirrors are preferred before anything is known
+        about them, from 0 to 100, as told by metalinks or by how close
+        they are.
+        """
+        self._preferences = preferences
+
     def getHistory(self):
         return self._history
 
@@ -57,6 +77,7 @@ class MirrorSystem(object):
 
     def addInfo(self, mirror, **info):
         if mirror:
+            info.setdefault("date", time.time())
             self._changed = True
             self._history.insert(0, (mirror, info))
             self._historychanged = True
@@ -69,17 +90,68 @@ class MirrorSystem(object):
                 del self._history[count*HISTORYPERMIRROR:]
 
     def get(self, url): 
+        elements = self._getElements(url)
+        if elements:
+            elements = elements.values()
+        else:
+            elements = [MirrorElement(self, "", "")]
+        return MirrorItem(self, url, elements)
+
+    def _getElements(self, url):
         elements = {}
         for origin in self._mirrors:
             if url.startswith(origin):
                 elements[origin] = MirrorElement(self, origin, origin)
                 for mirror in self._mirrors[origin]:
                     elements[mirror] = MirrorElement(self, origin, mirror)
-        if elements:
-            elements = elements.values()
-        else:
-            elements = [MirrorElement(self, "", "")]
-        return MirrorItem(self, url, elements)
+        return elements
+
+    def probe(self, urls, timeout=PROBETIMEOUT):
+        """
+        Measure how long connecting to the mirrors of the given urls
+        takes, all at once, for mirrors which weren't measured lately.
+        Mirrors which can't be reached at all are taken as failing.
+        """
+        now = time.time()
+        probed = {}
+        for mirror, info in self._history:
+            if "probed" in info and now-info.get("date", 0) < PROBEDELAY:
+                probed[mirror] = True
+        addresses = {}
+        for url in urls:
+            for elem in self._getElements(url).values():
+                mirror = elem.mirror
+                if mirror in probed or mirror in addresses:
+                    continue
+                scheme, rest = urllib.splittype(mirror)
+                if scheme not in PROBEPORTS:
+                    continue
+                host, rest = urllib.splithost(rest)
+                user, host = urllib.splituser(host)
+                host, port = urllib.splitport(host)
+                if host:
+                    addresses[mirror] = (host.strip("[]"),
+                                         int(port or PROBEPORTS[scheme]))
+        if not addresses:
+            return
+        results = {}
+        def connect(mirror, address):
+            results[mirror] = getLatency(address, timeout)
+        threads = []
+        for mirror in addresses:
+            thread = threading.Thread(target=connect,
+                                      args=(mirror, addresses[mirror]))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(timeout*2)
+        for mirror in addresses:
+            latency = results.get(mirror)
+            if latency is None:
+                self.addInfo(mirror, probed=1, failed=1)
+            else:
+                self.addInfo(mirror, probed=1, latency=latency)
 
     def getPenalities(self):
         self.updatePenality()
@@ -90,22 +162,45 @@ class MirrorSystem(object):
             return
         self._changed = False
         self._penality.clear()
+        now = time.time()
         data = {}
         for mirror, info in self._history:
             if mirror not in data:
                 mirrordata = data.setdefault(mirror, {"size": 0, "time": 0,
-                                                      "failed": 0})
+                                                      "failed": 0,
+                                                      "latency": 0,
+                                                      "probes": 0})
             else:
                 mirrordata = data[mirror]
-            mirrordata["size"] += info.get("size", 0)
-            mirrordata["time"] += info.get("time", 0)
-            mirrordata["failed"] += info.get("failed", 0)
+            # Information loses half of its weight every half-life.
+            weight = 1.0
+            if "date" in info:
+                weight = 0.5**(max(0, now-info["date"])/HISTORYHALFLIFE)
+            mirrordata["size"] += info.get("size", 0)*weight
+            mirrordata["time"] += info.get("time", 0)*weight
+            mirrordata["failed"] += info.get("failed", 0)*weight
+            if "latency" in info:
+                mirrordata["latency"] += info["latency"]*weight
+                mirrordata["probes"] += weight
+        # Mirrors which were only probed are expected to transfer as
+        # fast as the average mirror, once connected.
+        transfers = [(x["time"]*1000000)/x["size"]
+                     for x in data.values() if x["size"]]
+        if transfers:
+            avgtransfer = sum(transfers)/len(transfers)
+        else:
+            avgtransfer = 0
         maxpenality = 1
         justerrors = []
         for mirror in data:
             mirrordata = data[mirror]
-            if mirrordata["size"]:
-                penality = (mirrordata["time"]*1000000)/mirrordata["size"]
+            if mirrordata["size"] or mirrordata["probes"]:
+                if mirrordata["size"]:
+                    penality = ((mirrordata["time"]*1000000)/
+                                mirrordata["size"])
+                else:
+                    latency = mirrordata["latency"]/mirrordata["probes"]
+                    penality = avgtransfer+latency*ROUNDTRIPS
                 penality += mirrordata["failed"]*(penality*0.1)
                 # Integer division by granularity ensures that mirrors
                 # which are close enough will be considered equal to
@@ -126,6 +221,7 @@ class MirrorElement(object):
         self._system = system
         self.origin = origin
         self.mirror = mirror
+        self.preference = system.getPreferences().get(mirror, 0)
 
         if origin and mirror and origin[-1] == "/" and mirror[-1] != "/":
             self.mirror += "/"
@@ -138,8 +234,34 @@ class MirrorElement(object):
             # Otherwise, check penality.
             pen = self._system._penality
             rc = cmp(pen.get(self.mirror, 0), pen.get(other.mirror, 0))
+        if rc == 0:
+            # And then, what is preferred without knowing better.
+            rc = -cmp(self.preference, other.preference)
         return rc
 
+def getLatency(address, timeout=PROBETIMEOUT):
+    """
+    Return how many seconds connecting to the given (host, port) took,
+    or None if it couldn't be done.
+    """
+    try:
+        family, socktype, proto, name, sockaddr = \
+            socket.getaddrinfo(address[0], address[1], 0,
+                               socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, socktype, proto)
+    except socket.error:
+        return None
+    sock.settimeout(timeout)
+    try:
+        try:
+            start = time.time()
+            sock.connect(sockaddr)
+            return time.time()-start
+        except socket.error:
+            return None
+    finally:
+        sock.close()
+
 class MirrorItem(object):
 
     def __init__(self, system, url, elements):
@@ -166,4 +288,16 @@ class MirrorItem(object):
             self._current = None
             return None
 
+    def getAlternatives(self):
+        """
+        Return the URLs of mirrors which weren't tried yet, best ones
+        first, without changing the order getNext() will use.
+        """
+        self._system.updatePenality()
+        elements = self._elements[:]
+        random.shuffle(elements)
+        elements.sort()
+        return [elem.mirror+self._url[len(elem.origin):]
+                for elem in elements]
+
 # vim:ts=4:sw=4:et
@@ -0,0 +1,242 @@
+#
+# Copyright (c) 2004 Conectiva, Inc.
+#
+# Written by Gustavo Niemeyer <niemeyer@conectiva.com>
+#
+# This file is part of Smart Package Manager.
+#
+# Smart Package Manager is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# Smart Package Manager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Smart Package Manager; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+from smart.util.pathlocks import PathLocks
+from smart.const import BLOCKSIZE
+from smart import *
+import tempfile
+import random
+import shutil
+import fcntl
+import errno
+import time
+import os
+
+#
+# The package store keeps downloaded package files named after their
+# digests, so that a file is downloaded once whatever channel, mirror,
+# or target directory it's wanted from, and may be shared by several
+# systems over a network filesystem. Files are hardlinked, cloned, or
+# copied in and out of it, and are only ever replaced by renaming, so
+# readers never see partial files. Processes hold a shared lock on the
+# store directory while using it, and an exclusive one to remove files.
+#
+
+DIGESTKINDS = ["sha256", "sha", "md5"]
+
+# ioctl(2) cloning a file into another on filesystems which support it.
+FICLONE = 0x40049409
+
+class PackageStore(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._locks = PathLocks(False)
+
+    def getPath(self):
+        return self._path
+
+    def getKey(self, info, url):
+        """
+        Return the (kind, digest) the file of url is stored under, from
+        the given PackageInfo, or None if it has no digest.
+        """
+        for kind in DIGESTKINDS:
+            if kind == "sha256":
+                digest = info.getSHA256(url)
+            elif kind == "sha":
+                digest = info.getSHA(url)
+            else:
+                digest = info.getMD5(url)
+            if digest:
+                return kind, digest.lower()
+        return None
+
+    def getStorePath(self, key):
+        kind, digest = key
+        return os.path.join(self._path, kind, digest[:2], digest)
+
+    def _lock(self, exclusive=False, block=True):
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+        return self._locks.lock(self._path, exclusive, block)
+
+    def _unlock(self):
+        self._locks.unlock(self._path)
+
+    def has(self, key):
+        return os.path.isfile(self.getStorePath(key))
+
+    def get(self, key, targetpath):
+        """
+        Put the file stored under key at targetpath, returning whether
+        it was there.
+        """
+        try:
+            self._lock()
+        except (IOError, OSError), e:
+            iface.debug(_("Can't use package store %s: %s") %
+                        (self._path, e))
+            return False
+        try:
+            storepath = self.getStorePath(key)
+            if not os.path.isfile(storepath):
+                return False
+            try:
+                putFile(storepath, targetpath)
+                # Files used last are the last ones removed.
+                st = os.stat(storepath)
+                os.utime(storepath, (time.time(), st.st_mtime))
+            except (IOError, OSError), e:
+                iface.debug(_("Can't take %s from package store: %s") %
+                            (targetpath, e))
+                return False
+            return True
+        finally:
+            self._unlock()
+
+    def add(self, key, path):
+        """Keep the file at path in the store under key."""
+        try:
+            self._lock()
+        except (IOError, OSError), e:
+            iface.debug(_("Can't use package store %s: %s") %
+                        (self._path, e))
+            return
+        try:
+            storepath = self.getStorePath(key)
+            try:
+                dirname = os.path.dirname(storepath)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                putFile(path, storepath)
+            except (IOError, OSError), e:
+                iface.debug(_("Can't put %s in package store: %s") %
+                            (path, e))
+        finally:
+            self._unlock()
+
+    def getFiles(self):
+        """Return (path, size, lastused) tuples for every stored file."""
+        files = []
+        for kind in DIGESTKINDS:
+            for root, dirs, names in os.walk(os.path.join(self._path, kind)):
+                for name in names:
+                    if ".new." in name:
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((path, st.st_size, st.st_atime))
+        return files
+
+    def getSize(self):
+        return sum([size for path, size, lastused in self.getFiles()])
+
+    def evict(self, maxsize=0, block=False):
+        """
+        Remove the files used longest ago until the store holds at
+        most maxsize bytes, returning how many were removed. Nothing
+        is removed if other processes are using the store and block
+        is false.
+        """
+        if not os.path.isdir(self._path):
+            return 0
+        try:
+            if not self._lock(exclusive=True, block=block):
+                return 0
+        except (IOError, OSError), e:
+            iface.debug(_("Can't use package store %s: %s") %
+                        (self._path, e))
+            return 0
+        try:
+            files = [(lastused, path, size)
+                     for path, size, lastused in self.getFiles()]
+            files.sort()
+            total = sum([size for lastused, path, size in files])
+            removed = 0
+            for lastused, path, size in files:
+                if total <= maxsize:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError, e:
+                    iface.error(_("Can't remove %s: %s") % (path, e))
+                else:
+                    iface.debug(_("Removed %s") % path)
+                    total -= size
+                    removed += 1
+            return removed
+        finally:
+            self._unlock()
+
+def putFile(path, targetpath):
+    """
+    Make targetpath have the contents of path, by hardlinking it,
+    cloning it, or copying it, and replacing any previous targetpath
+    at once.
+    """
+    if os.path.isfile(targetpath) and os.path.samefile(path, targetpath):
+        return
+    # The store may be shared by several hosts, so temporary names are
+    # never reused, but taken only when nobody else has them.
+    newpath = None
+    for i in range(100):
+        candidate = "%s.new.%08x" % (targetpath, random.getrandbits(32))
+        try:
+            os.link(path, candidate)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                break
+        else:
+            newpath = candidate
+            break
+    if not newpath:
+        dirname, basename = os.path.split(targetpath)
+        fd, newpath = tempfile.mkstemp(prefix=basename+".new.",
+                                       dir=dirname or ".")
+        os.close(fd)
+        try:
+            cloneFile(path, newpath)
+        except:
+            os.unlink(newpath)
+            raise
+    os.rename(newpath, targetpath)
+
+def cloneFile(path, targetpath):
+    input = open(path)
+    try:
+        output = open(targetpath, "w")
+        try:
+            try:
+                fcntl.ioctl(output.fileno(), FICLONE, input.fileno())
+            except (IOError, OSError):
+                shutil.copyfileobj(input, output, BLOCKSIZE)
+        finally:
+            output.close()
+    finally:
+        input.close()
+    st = os.stat(path)
+    os.utime(targetpath, (st.st_atime, st.st_mtime))
+
+# vim:ts=4:sw=4:et
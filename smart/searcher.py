@@ -20,6 +20,9 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 from smart.util.strtools import globdistance
+from smart.searchindex import getSearchIndex, getPackageCandidates
+from smart.searchindex import isIndexable
+from smart.searchindex import getProvidesCandidates
 from smart.cache import Provides
 from smart import *
 import fnmatch
@@ -45,6 +48,9 @@ class Searcher(object):
 
     - provides is matched in Provides.search(), for the same reason.
 
+    - for both of the above, only packages and provides which name
+      indexes of loaders tell may be close enough are looked at.
+
     - requires, recommends, upgrades, and conflicts don't have special
       searching methods. Instead, their usual match() method is given
       an instance of the Provides type.
@@ -54,7 +60,9 @@ class Searcher(object):
       the overloaded methods in Loader's subclasses. This ensures
       that Loaders are able to speedup the searching process, since
       many times it's necessary to access huge sequential files for
-      looking up information.
+      looking up information. If loaders have an up to date search
+      index, only packages it tells may match are looked up, unless
+      there are url or inexact path searches.
     """
 
     def __init__(self):
@@ -71,6 +79,7 @@ class Searcher(object):
         self.summary = []
         self.description = []
         self.ignorecase = True
+        self._sources = {}
 
     def reset(self):
         self._results.clear()
@@ -85,6 +94,7 @@ class Searcher(object):
         del self.group[:]
         del self.summary[:]
         del self.description[:]
+        self._sources.clear()
 
     def addResult(self, obj, ratio=1.0):
         results = self._results
@@ -113,11 +123,78 @@ class Searcher(object):
 
     def searchCache(self, cache):
         for loader in cache.getLoaders():
-            loader.search(self)
+            self.searchLoader(loader)
+
+    def getNameVersionCandidates(self, cache):
+        """Return the packages of cache nameversion may find."""
+        packages = getPackageCandidates(cache, self.nameversion)
+        if packages is None:
+            return cache.getPackages()
+        return packages
+
+    def getProvidesCandidates(self, cache):
+        """Return the provides of cache provides may find."""
+        provides = getProvidesCandidates(cache, self.provides)
+        if provides is None:
+            return cache.getProvides()
+        return provides
+
+    def searchLoader(self, loader):
+        sources = self._sources
+        group = [sources.get(p) for p in self.group]
+        summary = [sources.get(p) for p in self.summary]
+        description = [sources.get(p) for p in self.description]
+        paths = [s for s, cutoff in self.path if cutoff >= 1.0]
+        if (not self.url and None not in group+summary+description and
+            len(paths) == len(self.path) and
+            isIndexable(group, summary, description, paths)):
+            index = getSearchIndex(loader, build=True)
+            if index is not None:
+                packages = index.getPackages(group, summary, description,
+                                             paths)
+                if packages is not None:
+                    for pkg in packages:
+                        ratio = self.getInfoRatio(loader.getInfo(pkg))
+                        if ratio:
+                            self.addResult(pkg, ratio)
+                    return
+        loader.search(self)
 
     def searchPackage(self, pkg):
         pkg.search(self)
 
+    def getInfoRatio(self, info):
+        """
+        Return how well the given PackageInfo matches the url, path,
+        group, summary, and description searches.
+        """
+        ic = self.ignorecase
+        ratio = 0
+        for url, cutoff in self.url:
+            for refurl in info.getReferenceURLs():
+                _, newratio = globdistance(url, refurl, cutoff, ic)
+                if newratio > ratio:
+                    ratio = newratio
+                    if ratio == 1:
+                        return ratio
+        for spath, cutoff in self.path:
+            for path in info.getPathList():
+                _, newratio = globdistance(spath, path, cutoff, ic)
+                if newratio > ratio:
+                    ratio = newratio
+                    if ratio == 1:
+                        return ratio
+        for pat in self.group:
+            if pat.search(info.getGroup()):
+                return 1
+        for pat in self.summary:
+            if pat.search(info.getSummary()):
+                return 1
+        for pat in self.description:
+            if pat.search(info.getDescription()):
+                return 1
+        return ratio
+
     def addAuto(self, s, cutoff=1.0):
         if not s: return
         if s.startswith("provides:"):
@@ -207,16 +284,22 @@ class Searcher(object):
         self.url.append((s, cutoff))
 
     def addGroup(self, s):
+        pattern = s
         s = _stripeol(fnmatch.translate(s)).replace("\ ", " ")
         p = re.compile("\s+".join(s.split()), self.ignorecase and re.I or 0)
         self.group.append(p)
+        self._sources[p] = pattern
 
     def addSummary(self, s):
+        pattern = s
         s = _stripeol(fnmatch.translate(s)).replace("\ ", " ")
         p = re.compile("\s+".join(s.split()), self.ignorecase and re.I or 0)
         self.summary.append(p)
+        self._sources[p] = pattern
 
     def addDescription(self, s):
+        pattern = s
         s = _stripeol(fnmatch.translate(s)).replace("\ ", " ")
         p = re.compile("\s+".join(s.split()), self.ignorecase and re.I or 0)
         self.description.append(p)
+        self._sources[p] = pattern
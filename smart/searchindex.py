@@ -0,0 +1,502 @@
+#
+# Copyright (c) 2005 Conectiva, Inc.
+#
+# Written by Gustavo Niemeyer <niemeyer@conectiva.com>
+#
+# This file is part of Smart Package Manager.
+#
+# Smart Package Manager is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# Smart Package Manager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Smart Package Manager; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+from smart.util.cachefile import dumpCacheFile, loadCacheFile
+from smart.util.objdigest import getObjectDigest
+from smart import *
+from array import array
+import weakref
+import os
+import re
+
+#
+# Search indexes tell which packages of a loader may match shell-style
+# patterns on their group, summary, description, or paths, so that
+# only these have their information looked up and matched for real.
+# Texts are indexed by their words, and a pattern word may be a part
+# of a text word, since patterns are searched anywhere in the text.
+# Paths are kept in a trie with one node per path component.
+#
+# Name indexes tell which packages and provides have names close enough
+# to patterns for their search() methods to find them. Names are mapped
+# from their n-grams, the strings of GRAMSIZE characters in them, with
+# the name start marked by a space. Names searched for are compared to
+# strings starting with them, as name-version, and if such a string is
+# at most k edits away from a pattern, at least len(name)-GRAMSIZE*k
+# n-grams of the name are in the pattern, since an edit can only break
+# GRAMSIZE of them. The edits allowed for a cutoff ratio also limit
+# the length of names which may be found.
+#
+# Indexes are built the first time a loader is searched, and saved in
+# the channels directory, apart from the cache, so that loading
+# channels doesn't pay for them. Saved indexes refer to packages by
+# their position in the loader, and are only used while the names and
+# versions of its packages stay the same.
+#
+
+TOKENRE = re.compile("[a-z0-9]+")
+GLOBCHARS = "*?["
+GRAMSIZE = 2
+INDEXVERSION = 1
+
+def getTokens(text):
+    return TOKENRE.findall(text.lower())
+
+def getPatternTokens(pattern):
+    """
+    Return the words which must be part of words in any text with
+    something matching the given pattern, or None if there are none
+    to tell.
+    """
+    if "[" in pattern:
+        return None
+    return getTokens(pattern) or None
+
+def getPathPrefix(pattern):
+    """Return the part of a path pattern before any wildcards."""
+    for i in range(len(pattern)):
+        if pattern[i] in GLOBCHARS:
+            return pattern[:i]
+    return pattern
+
+def isIndexable(group=(), summary=(), description=(), path=()):
+    """Tell if search indexes may find packages for the given patterns."""
+    for pattern in list(group)+list(summary)+list(description):
+        if getPatternTokens(pattern) is None:
+            return False
+    for pattern in path:
+        if not getPathPrefix(pattern):
+            return False
+    return True
+
+class SearchIndex(object):
+
+    def __init__(self, loader):
+        self._packages = loader.getPackages()[:]
+        self._tokens = {"group": {}, "summary": {}, "description": {}}
+        self._paths = {}
+        for i, pkg in enumerate(self._packages):
+            info = loader.getInfo(pkg)
+            if info is None:
+                continue
+            self._addText("group", i, info.getGroup())
+            self._addText("summary", i, info.getSummary())
+            self._addText("description", i, info.getDescription())
+            for path in info.getPathList():
+                node = self._paths
+                for component in path.lower().split("/"):
+                    child = node.get(component)
+                    if child is None:
+                        child = node[component] = {}
+                    node = child
+                positions = node.get(None)
+                if positions is None:
+                    node[None] = [i]
+                elif positions[-1] != i:
+                    positions.append(i)
+        for tokens in self._tokens.values():
+            for token in tokens:
+                tokens[token] = array("i", tokens[token])
+
+    def _addText(self, kind, i, text):
+        if not text:
+            return
+        tokens = self._tokens[kind]
+        for token in getTokens(text):
+            positions = tokens.get(token)
+            if positions is None:
+                tokens[token] = [i]
+            elif positions[-1] != i:
+                positions.append(i)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_packages"]
+        return state
+
+    def setPackages(self, packages):
+        """Give an unpickled index the packages it refers to."""
+        self._packages = packages
+
+    def isValid(self, loader):
+        return self._packages == loader.getPackages()
+
+    def _getTextPositions(self, kind, pattern):
+        patterntokens = getPatternTokens(pattern)
+        if patterntokens is None:
+            return None
+        tokens = self._tokens[kind]
+        result = None
+        for patterntoken in patterntokens:
+            found = {}
+            for token in tokens:
+                if patterntoken in token:
+                    found.update(dict.fromkeys(tokens[token]))
+            if result is None:
+                result = found
+            else:
+                for i in result.keys():
+                    if i not in found:
+                        del result[i]
+            if not result:
+                break
+        return result
+
+    def _getPathPositions(self, pattern):
+        pattern = pattern.lower()
+        prefix = getPathPrefix(pattern)
+        if not prefix:
+            return None
+        components = prefix.split("/")
+        last = components.pop()
+        node = self._paths
+        for component in components:
+            node = node.get(component)
+            if node is None:
+                return {}
+        result = {}
+        if prefix == pattern:
+            node = node.get(last)
+            if node and None in node:
+                result.update(dict.fromkeys(node[None]))
+            return result
+        queue = [child for component, child in node.items()
+                 if component is not None and component.startswith(last)]
+        while queue:
+            node = queue.pop()
+            for component, child in node.iteritems():
+                if component is None:
+                    result.update(dict.fromkeys(child))
+                else:
+                    queue.append(child)
+        return result
+
+    def getPackages(self, group=(), summary=(), description=(), path=()):
+        """
+        Return the packages which may match any of the given patterns,
+        or None if the index can't tell them.
+        """
+        result = {}
+        for kind, patterns in (("group", group),
+                               ("summary", summary),
+                               ("description", description)):
+            for pattern in patterns:
+                positions = self._getTextPositions(kind, pattern)
+                if positions is None:
+                    return None
+                result.update(positions)
+        for pattern in path:
+            positions = self._getPathPositions(pattern)
+            if positions is None:
+                return None
+            result.update(positions)
+        positions = result.keys()
+        positions.sort()
+        return [self._packages[i] for i in positions]
+
+def isNameIndexable(patterns):
+    """Tell if name indexes may find names for the given patterns."""
+    for pattern, cutoff in patterns:
+        if "*" in pattern:
+            return False
+        if type(cutoff) is float:
+            if cutoff <= 0:
+                return False
+        elif type(cutoff) is not int or cutoff < 0:
+            return False
+    return True
+
+def getGrams(name):
+    name = " "*(GRAMSIZE-1)+name.lower()
+    return [name[i:i+GRAMSIZE] for i in range(len(name)-GRAMSIZE+1)]
+
+class NameGrams(object):
+
+    def __init__(self):
+        self._names = []
+        self._objects = {}
+        self._grams = {}
+        self._lengths = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_objects"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._objects = {}
+
+    def add(self, name, obj):
+        if name not in self._objects:
+            i = len(self._names)
+            self._names.append(name)
+            self._lengths.setdefault(len(name), []).append(i)
+            # Repeated n-grams are kept repeated, as they're counted
+            # once for each time they appear in the name.
+            for gram in getGrams(name):
+                self._grams.setdefault(gram, []).append(i)
+        self.addObject(name, obj)
+
+    def addObject(self, name, obj):
+        """Add obj under a name which is already indexed."""
+        objects = self._objects.get(name)
+        if objects is None:
+            objects = self._objects[name] = []
+        objects.append(obj)
+
+    def finish(self):
+        for table in self._grams, self._lengths:
+            for key in table:
+                table[key] = array("i", table[key])
+
+    def getObjects(self, patterns):
+        """
+        Return the objects with names which may be as close to any of
+        the given (pattern, cutoff) tuples as globdistance() is told to
+        accept, or None if the index can't tell them.
+        """
+        if not isNameIndexable(patterns):
+            return None
+        found = {}
+        for pattern, cutoff in patterns:
+            if type(cutoff) is float:
+                # Name strings may be up to len(pattern)/cutoff long,
+                # and thus be that many times 1-cutoff edits away.
+                edits = int(len(pattern)*(1-cutoff)/cutoff+0.01)
+                maxlength = int(len(pattern)/cutoff+0.01)
+            else:
+                edits = cutoff
+                maxlength = len(pattern)+cutoff
+            # Wildcards match any character, as an edit would.
+            edits += pattern.count("?")
+            broken = GRAMSIZE*edits
+            # Short names may have no n-grams left after the edits,
+            # and looking them all up isn't worth using the index.
+            short = []
+            for length in range(min(broken, maxlength)+1):
+                short.extend(self._lengths.get(length, ()))
+            if len(short)*2 > len(self._names):
+                return None
+            found.update(dict.fromkeys(short))
+            counts = {}
+            for gram in dict.fromkeys(getGrams(pattern)):
+                if "?" in gram:
+                    continue
+                for i in self._grams.get(gram, ()):
+                    counts[i] = counts.get(i, 0)+1
+            names = self._names
+            for i, count in counts.iteritems():
+                length = len(names[i])
+                if count+broken >= length and length <= maxlength:
+                    found[i] = True
+        objects = []
+        for i in found:
+            objects.extend(self._objects[self._names[i]])
+        return objects
+
+class NameIndex(object):
+
+    def __init__(self, loader):
+        self._pkgnames = NameGrams()
+        self._prvnames = NameGrams()
+        self._setPackages(loader.getPackages()[:],
+                          self._pkgnames.add, self._prvnames.add)
+        self._pkgnames.finish()
+        self._prvnames.finish()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_packages"]
+        return state
+
+    def setPackages(self, packages):
+        """Give an unpickled index the packages it refers to."""
+        self._setPackages(packages, self._pkgnames.addObject,
+                          self._prvnames.addObject)
+
+    def _setPackages(self, packages, addpkg, addprv):
+        self._packages = packages
+        self._provides = countProvides(packages)
+        for pkg in packages:
+            addpkg(pkg.name, pkg)
+            for prv in pkg.provides:
+                addprv(prv.name, prv)
+
+    def isValid(self, loader):
+        # File provides may be added to packages after they're loaded.
+        packages = loader.getPackages()
+        return (self._packages == packages and
+                self._provides == countProvides(packages))
+
+    def getPackages(self, patterns):
+        return self._pkgnames.getObjects(patterns)
+
+    def getProvides(self, patterns):
+        return self._prvnames.getObjects(patterns)
+
+def countProvides(packages):
+    return sum([len(pkg.provides) for pkg in packages])
+
+_searchindexes = weakref.WeakKeyDictionary()
+_nameindexes = weakref.WeakKeyDictionary()
+
+def getSearchIndex(loader, build=False):
+    """
+    Return the search index of loader, if it's up to date. With build,
+    when search-index allows, the index saved for the loader is loaded,
+    or a new one is built and saved.
+    """
+    return _getIndex(loader, SearchIndex, _searchindexes, "searchindex",
+                     build)
+
+def buildSearchIndex(loader):
+    """Index the packages of loader, saving the index if possible."""
+    return _buildIndex(loader, SearchIndex, _searchindexes, "searchindex")
+
+def getNameIndex(loader, build=False):
+    """
+    Return the name index of loader, if it's up to date. With build,
+    it's loaded or built as getSearchIndex() does.
+    """
+    return _getIndex(loader, NameIndex, _nameindexes, "nameindex", build)
+
+def buildNameIndex(loader):
+    """Index the names of packages and provides of loader."""
+    return _buildIndex(loader, NameIndex, _nameindexes, "nameindex")
+
+def getIndexPath(loader, kind):
+    """
+    Return where the index of the given kind is saved for loader, or
+    None if it belongs to no channel.
+    """
+    channel = loader.getChannel()
+    datadir = sysconf.get("data-dir")
+    if channel is None or not datadir:
+        return None
+    try:
+        i = channel.getLoaders().index(loader)
+    except (AttributeError, ValueError):
+        return None
+    return os.path.join(datadir, "channels",
+                        "%s%%%%%s%d" % (channel.getAlias(), kind, i))
+
+def getPackagesKey(packages):
+    return (getObjectDigest([(pkg.name, pkg.version) for pkg in packages]),
+            countProvides(packages))
+
+def _getIndex(loader, cls, indexes, kind, build):
+    index = indexes.get(loader)
+    if index is not None and index.isValid(loader):
+        return index
+    if not build or not sysconf.get("search-index", True):
+        return None
+    index = _loadIndex(loader, kind)
+    if index is None:
+        return _buildIndex(loader, cls, indexes, kind)
+    indexes[loader] = index
+    return index
+
+def _loadIndex(loader, kind):
+    path = getIndexPath(loader, kind)
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        key, index = loadCacheFile(path, INDEXVERSION)
+    except Exception, e:
+        iface.debug(_("Can't load index %s: %s") % (path, e))
+        return None
+    packages = loader.getPackages()[:]
+    if key != getPackagesKey(packages):
+        return None
+    index.setPackages(packages)
+    return index
+
+def _buildIndex(loader, cls, indexes, kind):
+    iface.showStatus(_("Indexing packages..."))
+    try:
+        index = indexes[loader] = cls(loader)
+    finally:
+        iface.hideStatus()
+    path = getIndexPath(loader, kind)
+    if (path and not sysconf.getReadOnly() and
+        os.access(os.path.dirname(path), os.W_OK)):
+        try:
+            dumpCacheFile(path, (getPackagesKey(index._packages), index),
+                          INDEXVERSION)
+        except (IOError, OSError), e:
+            iface.debug(_("Can't save index %s: %s") % (path, e))
+    return index
+
+def getPackageCandidates(cache, patterns):
+    """
+    Return the packages in the cache which may be found by the given
+    nameversion searches, or None if they can't be told from the name
+    indexes of its loaders.
+    """
+    return _getNameCandidates(cache, patterns, "getPackages")
+
+def getProvidesCandidates(cache, patterns):
+    """
+    Return the provides in the cache which may be found by the given
+    provides searches, or None if they can't be told from the name
+    indexes of its loaders.
+    """
+    return _getNameCandidates(cache, patterns, "getProvides")
+
+def _getNameCandidates(cache, patterns, method):
+    if not isNameIndexable(patterns):
+        return None
+    candidates = {}
+    for loader in cache._loaders:
+        if not loader.getPackages():
+            continue
+        index = getNameIndex(loader, build=True)
+        if index is None:
+            return None
+        found = getattr(index, method)(patterns)
+        if found is None:
+            return None
+        candidates.update(dict.fromkeys(found))
+    return candidates.keys()
+
+def getCandidates(cache, group=(), summary=(), description=(), path=()):
+    """
+    Return a dictionary with the packages in the cache which may match
+    any of the given patterns, or None if they can't be told from the
+    search indexes of its loaders.
+    """
+    if not isIndexable(group, summary, description, path):
+        return None
+    candidates = {}
+    for loader in cache._loaders:
+        if not loader.getPackages():
+            continue
+        index = getSearchIndex(loader, build=True)
+        if index is None:
+            return None
+        packages = index.getPackages(group, summary, description, path)
+        if packages is None:
+            return None
+        candidates.update(dict.fromkeys(packages))
+    return candidates
+
+# vim:ts=4:sw=4:et
@@ -0,0 +1,190 @@
+#
+# Copyright (c) 2004 Conectiva, Inc.
+#
+# Written by Gustavo Niemeyer <niemeyer@conectiva.com>
+#
+# This file is part of Smart Package Manager.
+#
+# Smart Package Manager is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# Smart Package Manager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Smart Package Manager; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+from smart.transaction import ChangeSet, Failed
+from smart import *
+import time
+import os
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+#
+# The solver profile is only attached to a transaction when asked for
+# with the profile-solver option. Solver methods are then replaced by
+# wrappers in the transaction instance itself, so that the class and
+# any other transaction stay untouched, and nothing is paid when the
+# profile isn't being used.
+#
+
+SOLVERMETHODS = ["_attempt", "_install", "_remove", "_updown",
+                 "_pending", "_upgrade", "_fix"]
+POLICYMETHODS = ["runStarting", "getWeight"]
+
+class SolverProfile(object):
+
+    def __init__(self):
+        self._methods = {}
+        self._phases = {}
+        self._depths = {}
+        self._depth = 0
+        self._copies = 0
+        self._results = 0
+        self._adopted = 0
+        self._start = None
+        self._time = 0.0
+        self._trans = None
+        self._policy = None
+        self._copy = None
+        self._setstate = None
+
+    def _wrap(self, name, method, nested, check=None):
+        stats = self._methods[name] = {"calls": 0, "failures": 0,
+                                       "time": 0.0}
+        phases = self._phases
+        depths = self._depths
+        def wrapper(*args, **kwargs):
+            depth = self._depth
+            if nested:
+                depths[depth] = depths.get(depth, 0)+1
+                self._depth = depth+1
+            stats["calls"] += 1
+            start = time.time()
+            try:
+                try:
+                    result = method(*args, **kwargs)
+                    if check:
+                        check(result)
+                    return result
+                except Failed:
+                    stats["failures"] += 1
+                    raise
+            finally:
+                elapsed = time.time()-start
+                stats["time"] += elapsed
+                if depth == 0:
+                    phases[name] = phases.get(name, 0.0)+elapsed
+                self._depth = depth
+        return wrapper
+
+    def _checkAttempt(self, result):
+        # Changesets coming out of _attempt() are marked, so that
+        # alternatives which the solver weighted but never adopted
+        # may be told apart. Memoized results are counted only once.
+        cs = result[1]
+        if "_adopted" not in cs.__dict__:
+            cs._adopted = False
+            self._results += 1
+
+    def attach(self, trans):
+        """Start profiling the given transaction."""
+        self._trans = trans
+        self._policy = policy = trans.getPolicy()
+        for name in SOLVERMETHODS:
+            if name == "_attempt":
+                check = self._checkAttempt
+            else:
+                check = None
+            setattr(trans, name, self._wrap(name, getattr(trans, name),
+                                            True, check))
+        for name in POLICYMETHODS:
+            setattr(policy, name, self._wrap(name, getattr(policy, name),
+                                             False))
+        # Changesets are copied all over the solver, so the count is
+        # taken at the class while the transaction runs.
+        self._copy = copy = ChangeSet.__dict__["copy"]
+        def countcopy(changeset):
+            self._copies += 1
+            return copy(changeset)
+        ChangeSet.copy = countcopy
+        # Likewise for the alternatives adopted by setState().
+        self._setstate = setstate = ChangeSet.__dict__["setState"]
+        def adopt(changeset, state):
+            if getattr(state, "_adopted", None) is False:
+                state._adopted = True
+                self._adopted += 1
+            return setstate(changeset, state)
+        ChangeSet.setState = adopt
+        self._start = time.time()
+
+    def detach(self):
+        """Stop profiling, restoring the transaction and its policy."""
+        self._time += time.time()-self._start
+        ChangeSet.copy = self._copy
+        ChangeSet.setState = self._setstate
+        for name in SOLVERMETHODS:
+            del self._trans.__dict__[name]
+        for name in POLICYMETHODS:
+            del self._policy.__dict__[name]
+        self._trans = self._policy = None
+        self._copy = self._setstate = None
+
+    def getProfile(self, trans):
+        """Return the collected information as a dictionary."""
+        hits, misses = trans.getMemoStats()
+        attempt = self._methods.get("_attempt", {})
+        depths = {}
+        for depth in self._depths:
+            depths[str(depth)] = self._depths[depth]
+        return {"policy": trans.getPolicy().__class__.__name__,
+                "time": self._time,
+                "changeset": len(trans.getChangeSet()),
+                "methods": self._methods,
+                "phases": self._phases,
+                "depths": depths,
+                "branches": {"explored": misses,
+                             "memoized": hits,
+                             "failed": attempt.get("failures", 0),
+                             "pruned": self._results-self._adopted},
+                "changeset-copies": self._copies}
+
+_profiles = []
+
+def dumpSolverProfile(path, profile):
+    """
+    Append profile to the ones collected so far by this process, and
+    write all of them to path as a JSON list.
+
+    This is called even when the solver fails, so problems writing
+    the file are only warned about, and never replace the solver
+    error.
+    """
+    if json is None:
+        iface.warning(_("Can't dump solver profile: no json module"))
+        return
+    _profiles.append(profile)
+    newpath = path+".new"
+    try:
+        file = open(newpath, "w")
+        try:
+            json.dump(_profiles, file, indent=1, sort_keys=True)
+        finally:
+            file.close()
+        os.rename(newpath, path)
+    except (IOError, OSError), e:
+        iface.warning(_("Can't dump solver profile to %s: %s") % (path, e))
+
+# vim:ts=4:sw=4:et
@@ -46,27 +46,325 @@ def lock_reason(pkg, lockvalue):
     else:
         return _("%s is locked (unknown reason)") % pkg
 
-class ChangeSet(dict):
+# Changesets are copied on nearly every branch the solver explores, so
+# a copy doesn't duplicate anything. Instead, the changes made to a
+# changeset so far are frozen into a layer shared with the copy, and
+# both go on recording their own changes on top of it. Lookups walk
+# the layers down to a complete one, and a layer more than this many
+# levels above it is made complete itself, by flattening the ones
+# below into a new dictionary.
+MAXLAYERDEPTH = 4
+
+_NOTSET = object()
+
+class ChangeSetLayer(object):
+    """
+    Frozen changes over the layer below, mapping packages to their
+    operation, or to None when removed from the changeset. Layers
+    without a parent are complete, and know the complete layer their
+    line started from, and which packages changed since then.
+    """
+
+    __slots__ = ("parent", "changes", "depth", "origin", "touched")
+
+    def __init__(self, parent, changes):
+        if parent is None:
+            self.parent = None
+            self.changes = changes
+            self.depth = 0
+            self.origin = self
+            self.touched = {}
+        elif parent.depth < MAXLAYERDEPTH:
+            self.parent = parent
+            self.changes = changes
+            self.depth = parent.depth+1
+        else:
+            layers = [changes]
+            while parent.parent is not None:
+                layers.append(parent.changes)
+                parent = parent.parent
+            layers.reverse()
+            flat = parent.changes.copy()
+            touched = parent.touched.copy()
+            for changes in layers:
+                touched.update(changes)
+                for pkg in changes:
+                    op = changes[pkg]
+                    if op is None:
+                        if pkg in flat:
+                            del flat[pkg]
+                    else:
+                        flat[pkg] = op
+            self.parent = None
+            self.changes = flat
+            self.depth = 0
+            self.origin = parent.origin
+            self.touched = touched
+
+    def get(self, pkg):
+        layer = self
+        while layer.parent is not None:
+            op = layer.changes.get(pkg, _NOTSET)
+            if op is not _NOTSET:
+                return op
+            layer = layer.parent
+        return layer.changes.get(pkg)
+
+    def getFlat(self):
+        """Return a new dictionary with the complete contents."""
+        layers = []
+        layer = self
+        while layer.parent is not None:
+            layers.append(layer.changes)
+            layer = layer.parent
+        flat = layer.changes.copy()
+        while layers:
+            changes = layers.pop()
+            for pkg in changes:
+                op = changes[pkg]
+                if op is None:
+                    if pkg in flat:
+                        del flat[pkg]
+                else:
+                    flat[pkg] = op
+        return flat
+
+    def getTouched(self, touched):
+        """
+        Add packages which may have changed since the origin to the
+        touched dictionary, and return the origin.
+        """
+        layer = self
+        while layer.parent is not None:
+            touched.update(layer.changes)
+            layer = layer.parent
+        touched.update(layer.touched)
+        return layer.origin
+
+class ChangeSet(object):
 
     def __init__(self, cache, state=None, requested=None):
         self._cache = cache
+        self._layer = None
+        # Own changes, with None for packages removed from the layer.
+        # Without a layer, they're the complete contents.
+        self._changes = {}
+        # Complete contents, once needed, kept up to date from then on.
+        self._flat = self._changes
+        self._size = 0
+        # Hashes of the (package, operation) pairs in the changeset,
+        # xored together, so that it's kept up to date on every change.
+        self._fingerprint = 0
         self._requested = {}
+        self._requestedshared = False
         if state:
             self.update(state)
         if requested:
-            self._requested.update(requested)
+            self._ownRequested().update(requested)
+
+    def _freeze(self):
+        if self._changes:
+            if self._layer is None:
+                self._flat = None
+            self._layer = ChangeSetLayer(self._layer, self._changes)
+            self._changes = {}
+        return self._layer
+
+    def _share(self, other):
+        self._layer = other._freeze()
+        self._changes = {}
+        if self._layer is None:
+            self._flat = self._changes
+        else:
+            self._flat = None
+        self._size = other._size
+        self._fingerprint = other._fingerprint
+        self._requested = other._requested
+        self._requestedshared = other._requestedshared = True
+
+    def _ownRequested(self):
+        if self._requestedshared:
+            self._requested = self._requested.copy()
+            self._requestedshared = False
+        return self._requested
+
+    def _getFlat(self):
+        flat = self._flat
+        if flat is None:
+            flat = self._layer.getFlat()
+            changes = self._changes
+            for pkg in changes:
+                op = changes[pkg]
+                if op is None:
+                    if pkg in flat:
+                        del flat[pkg]
+                else:
+                    flat[pkg] = op
+            self._flat = flat
+        return flat
+
+    def _getTouched(self):
+        """
+        Return the origin of the changeset and a dictionary with the
+        packages which may have changed since then, or None and the
+        complete contents when there's no origin.
+        """
+        if self._layer is None:
+            return None, self._changes
+        touched = self._changes.copy()
+        return self._layer.getTouched(touched), touched
+
+    def get(self, pkg, default=None):
+        flat = self._flat
+        if flat is not None:
+            return flat.get(pkg, default)
+        op = self._changes.get(pkg, _NOTSET)
+        if op is _NOTSET:
+            op = self._layer.get(pkg)
+        if op is None:
+            return default
+        return op
+
+    def __getitem__(self, pkg):
+        flat = self._flat
+        if flat is not None:
+            return flat[pkg]
+        op = self._changes.get(pkg, _NOTSET)
+        if op is _NOTSET:
+            op = self._layer.get(pkg)
+        if op is None:
+            raise KeyError, pkg
+        return op
+
+    def __setitem__(self, pkg, op):
+        current = self.get(pkg)
+        if current is None:
+            self._size += 1
+        else:
+            self._fingerprint ^= hash((pkg, current))
+        self._fingerprint ^= hash((pkg, op))
+        self._changes[pkg] = op
+        flat = self._flat
+        if flat is not None and flat is not self._changes:
+            flat[pkg] = op
+
+    def __delitem__(self, pkg):
+        op = self.get(pkg)
+        if op is None:
+            raise KeyError, pkg
+        self._size -= 1
+        self._fingerprint ^= hash((pkg, op))
+        if self._layer is None:
+            del self._changes[pkg]
+        else:
+            self._changes[pkg] = None
+            if self._flat is not None:
+                del self._flat[pkg]
+
+    def __contains__(self, pkg):
+        return self.get(pkg) is not None
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self._size
+
+    def __nonzero__(self):
+        return self._size != 0
+
+    def __iter__(self):
+        return iter(self._getFlat())
+
+    def __eq__(self, other):
+        if isinstance(other, ChangeSet):
+            if (self._size != other._size or
+                self._fingerprint != other._fingerprint):
+                return False
+            if (self._layer is other._layer and
+                not self._changes and not other._changes):
+                return True
+            origin, touched = self._getTouched()
+            if origin is None:
+                return self._changes == other._getFlat()
+            otherorigin, othertouched = other._getTouched()
+            if origin is not otherorigin:
+                return self._getFlat() == other._getFlat()
+            touched.update(othertouched)
+            get = self.get
+            otherget = other.get
+            for pkg in touched:
+                if get(pkg) is not otherget(pkg):
+                    return False
+            return True
+        if isinstance(other, dict):
+            return self._getFlat() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def iterkeys(self):
+        return iter(self._getFlat())
+
+    def itervalues(self):
+        return self._getFlat().itervalues()
+
+    def iteritems(self):
+        return self._getFlat().iteritems()
+
+    def keys(self):
+        return self._getFlat().keys()
+
+    def values(self):
+        return self._getFlat().values()
+
+    def items(self):
+        return self._getFlat().items()
+
+    def pop(self, pkg, *default):
+        op = self.get(pkg)
+        if op is None:
+            if default:
+                return default[0]
+            raise KeyError, pkg
+        del self[pkg]
+        return op
+
+    def setdefault(self, pkg, op):
+        current = self.get(pkg)
+        if current is None:
+            self[pkg] = current = op
+        return current
 
     def clear(self):
-        dict.clear(self)
-        self._requested.clear()
+        self._layer = None
+        self._changes = self._flat = {}
+        self._size = 0
+        self._fingerprint = 0
+        self._requested = {}
+        self._requestedshared = False
 
     def update(self, other):
-        dict.update(self, other)
         if type(other) is ChangeSet:
-            self._requested.update(other._requested)
+            if not self._size:
+                self._share(other)
+                return
+            for pkg, op in other.iteritems():
+                self[pkg] = op
+            self._ownRequested().update(other._requested)
+        else:
+            for pkg in other.keys():
+                self[pkg] = other[pkg]
 
     def copy(self):
-        return ChangeSet(self._cache, self, self._requested)
+        changeset = ChangeSet(self._cache)
+        changeset._share(self)
+        return changeset
 
     def getCache(self):
         return self._cache
@@ -81,9 +379,10 @@ class ChangeSet(dict):
 
     def getPersistentState(self):
         state = {}
-        for pkg in self:
-            req = pkg in self._requested
-            state[(pkg.__class__, pkg.name, pkg.version)] = self[pkg], req
+        requested = self._requested
+        for pkg, op in self.iteritems():
+            req = pkg in requested
+            state[(pkg.__class__, pkg.name, pkg.version)] = op, req
         return state
 
     def setPersistentState(self, state):
@@ -142,9 +441,9 @@ class ChangeSet(dict):
     def setRequested(self, pkg, flag):
         assert pkg in self
         if flag:
-            self._requested[pkg] = True
+            self._ownRequested()[pkg] = True
         elif pkg in self._requested:
-            del self._requested[pkg]
+            del self._ownRequested()[pkg]
 
     def set(self, pkg, op, force=False):
         if self.get(pkg) is op:
@@ -156,7 +455,7 @@ class ChangeSet(dict):
                 if pkg in self:
                     del self[pkg]
                     if pkg in self._requested:
-                        del self._requested[pkg]
+                        del self._ownRequested()[pkg]
         else:
             if force or pkg.installed:
                 self[pkg] = REMOVE
@@ -164,17 +463,37 @@ class ChangeSet(dict):
                 if pkg in self:
                     del self[pkg]
                     if pkg in self._requested:
-                        del self._requested[pkg]
+                        del self._ownRequested()[pkg]
 
     def installed(self, pkg):
-        op = self.get(pkg)
+        # Called for nearly every package the solver looks at, so the
+        # lookup in get() is done here as well.
+        flat = self._flat
+        if flat is not None:
+            op = flat.get(pkg)
+        else:
+            op = self._changes.get(pkg, _NOTSET)
+            if op is _NOTSET:
+                op = self._layer.get(pkg)
         return op is INSTALL or pkg.installed and not op is REMOVE
 
     def difference(self, other):
         diff = ChangeSet(self._cache)
-        for pkg in self:
-            sop = self[pkg]
-            if sop is not other.get(pkg):
+        # Against a changeset copied from the same line, only packages
+        # changed by either one since they parted may differ.
+        origin, touched = self._getTouched()
+        if origin is not None and type(other) is ChangeSet:
+            otherorigin, othertouched = other._getTouched()
+            if origin is otherorigin:
+                touched.update(othertouched)
+            else:
+                touched = self._getFlat()
+        elif origin is not None:
+            touched = self._getFlat()
+        get = self.get
+        for pkg in touched:
+            sop = get(pkg)
+            if sop is not None and sop is not other.get(pkg):
                 diff[pkg] = sop
                 if pkg in self._requested:
                     diff._requested[pkg] = True
@@ -182,8 +501,7 @@ class ChangeSet(dict):
 
     def intersect(self, other):
         isct = ChangeSet(self._cache)
-        for pkg in self:
-            sop = self[pkg]
+        for pkg, sop in self.iteritems():
             if sop is other.get(pkg):
                 isct[pkg] = sop
                 if pkg in self._requested:
@@ -192,8 +510,8 @@ class ChangeSet(dict):
 
     def __str__(self):
         l = []
-        for pkg in self:
-            l.append("%s %s\n" % (self[pkg] is INSTALL and "I" or "R", pkg))
+        for pkg, op in self.iteritems():
+            l.append("%s %s\n" % (op is INSTALL and "I" or "R", pkg))
         return "".join(l)
 
 class Policy(object):
@@ -264,41 +582,37 @@ class PolicyInstall(Policy):
         self._upgrading = upgrading = {}
         self._upgraded = upgraded = {}
         self._downgraded = downgraded = {}
-        for pkg in self._trans.getCache().getPackages():
-            # Precompute upgrade relations.
-            for upg in pkg.upgrades:
-                for prv in upg.providedby:
-                    for prvpkg in prv.packages:
-                        if prvpkg.installed:
-                            if (self.getPriority(pkg) >=
-                                self.getPriority(prvpkg)):
-                                upgrading[pkg] = True
-                                if prvpkg in upgraded:
-                                    upgraded[prvpkg].append(pkg)
-                                else:
-                                    upgraded[prvpkg] = [pkg]
-                            else:
-                                if prvpkg in downgraded:
-                                    downgraded[prvpkg].append(pkg)
-                                else:
-                                    downgraded[prvpkg] = [pkg]
-            # Downgrades are upgrades if they have a higher priority.
-            for prv in pkg.provides:
-                for upg in prv.upgradedby:
-                    for upgpkg in upg.packages:
-                        if upgpkg.installed:
-                            if (self.getPriority(pkg) >
-                                self.getPriority(upgpkg)):
-                                upgrading[pkg] = True
-                                if upgpkg in upgraded:
-                                    upgraded[upgpkg].append(pkg)
-                                else:
-                                    upgraded[upgpkg] = [pkg]
-                            else:
-                                if upgpkg in downgraded:
-                                    downgraded[upgpkg].append(pkg)
-                                else:
-                                    downgraded[upgpkg] = [pkg]
+        upgindex, upgbyindex = self._trans.getCache().getUpgradeIndex()
+        # Precompute upgrade relations.
+        for pkg in upgindex:
+            for prvpkg in upgindex[pkg]:
+                if prvpkg.installed:
+                    if self.getPriority(pkg) >= self.getPriority(prvpkg):
+                        upgrading[pkg] = True
+                        if prvpkg in upgraded:
+                            upgraded[prvpkg].append(pkg)
+                        else:
+                            upgraded[prvpkg] = [pkg]
+                    else:
+                        if prvpkg in downgraded:
+                            downgraded[prvpkg].append(pkg)
+                        else:
+                            downgraded[prvpkg] = [pkg]
+        # Downgrades are upgrades if they have a higher priority.
+        for pkg in upgbyindex:
+            for upgpkg in upgbyindex[pkg]:
+                if upgpkg.installed:
+                    if self.getPriority(pkg) > self.getPriority(upgpkg):
+                        upgrading[pkg] = True
+                        if upgpkg in upgraded:
+                            upgraded[upgpkg].append(pkg)
+                        else:
+                            upgraded[upgpkg] = [pkg]
+                    else:
+                        if upgpkg in downgraded:
+                            downgraded[upgpkg].append(pkg)
+                        else:
+                            downgraded[upgpkg] = [pkg]
 
     def runFinished(self):
         Policy.runFinished(self)
@@ -307,6 +621,9 @@ class PolicyInstall(Policy):
         del self._downgraded
 
     def getWeight(self, changeset):
+        # Weighting reads every package, so it's done on the complete
+        # contents rather than through the changeset layers.
+        changeset = changeset._getFlat()
         weight = 0
         upgrading = self._upgrading
         upgraded = self._upgraded
@@ -339,8 +656,8 @@ class PolicyRemove(Policy):
 
     def getWeight(self, changeset):
         weight = 0
-        for pkg in changeset:
-            if changeset[pkg] is REMOVE:
+        for op in changeset._getFlat().itervalues():
+            if op is REMOVE:
                 weight += 1
             else:
                 weight += 5
@@ -356,39 +673,37 @@ class PolicyUpgrade(Policy):
         self._sortbonus = sortbonus = {}
         self._stablebonus = stablebonus = {}
         queue = self._trans.getQueue()
-        for pkg in self._trans.getCache().getPackages():
-            # Precompute upgrade relations.
-            for upg in pkg.upgrades:
-                for prv in upg.providedby:
-                    for prvpkg in prv.packages:
-                        if (prvpkg.installed and
-                            self.getPriority(pkg) >= self.getPriority(prvpkg)):
-                            dct = upgrading.get(pkg)
-                            if dct:
-                                dct[prvpkg] = True
-                            else:
-                                upgrading[pkg] = {prvpkg: True}
-                            lst = upgraded.get(prvpkg)
-                            if lst:
-                                lst.append(pkg)
-                            else:
-                                upgraded[prvpkg] = [pkg]
-            # Downgrades are upgrades if they have a higher priority.
-            for prv in pkg.provides:
-                for upg in prv.upgradedby:
-                    for upgpkg in upg.packages:
-                        if (upgpkg.installed and
-                            self.getPriority(pkg) > self.getPriority(upgpkg)):
-                            dct = upgrading.get(pkg)
-                            if dct:
-                                dct[upgpkg] = True
-                            else:
-                                upgrading[pkg] = {upgpkg: True}
-                            lst = upgraded.get(upgpkg)
-                            if lst:
-                                lst.append(pkg)
-                            else:
-                                upgraded[upgpkg] = [pkg]
+        upgindex, upgbyindex = self._trans.getCache().getUpgradeIndex()
+        # Precompute upgrade relations.
+        for pkg in upgindex:
+            for prvpkg in upgindex[pkg]:
+                if (prvpkg.installed and
+                    self.getPriority(pkg) >= self.getPriority(prvpkg)):
+                    dct = upgrading.get(pkg)
+                    if dct:
+                        dct[prvpkg] = True
+                    else:
+                        upgrading[pkg] = {prvpkg: True}
+                    lst = upgraded.get(prvpkg)
+                    if lst:
+                        lst.append(pkg)
+                    else:
+                        upgraded[prvpkg] = [pkg]
+        # Downgrades are upgrades if they have a higher priority.
+        for pkg in upgbyindex:
+            for upgpkg in upgbyindex[pkg]:
+                if (upgpkg.installed and
+                    self.getPriority(pkg) > self.getPriority(upgpkg)):
+                    dct = upgrading.get(pkg)
+                    if dct:
+                        dct[upgpkg] = True
+                    else:
+                        upgrading[pkg] = {upgpkg: True}
+                    lst = upgraded.get(upgpkg)
+                    if lst:
+                        lst.append(pkg)
+                    else:
+                        upgraded[upgpkg] = [pkg]
 
         # If package A-2.0 upgrades package A-1.0, and package A-2.0 is
         # upgraded by A-3.0, give a bonus if A-1.0 is upgraded without
@@ -406,35 +721,29 @@ class PolicyUpgrade(Policy):
                 path = queue.pop(0)
                 pathlen = len(path)
                 pkg = path[-1]
-                for prv in pkg.provides:
-                    for upg in prv.upgradedby:
-                        for upgpkg in upg.packages:
-                            if (not upgpkg.installed and
-                                upgpkg in upgmap and upgpkg not in path and
-                                self.getPriority(pkg) <=
-                                self.getPriority(upgpkg)):
-                                if pathlen > 1:
-                                    # Paths always increase in size, so we can
-                                    # be sure that the value being introduced
-                                    # here is >= to the previous one.
-                                    bonusvalue[pkg] = -30*(pathlen-1)
-                                    deps = bonusdeps.setdefault(pkg, {})
-                                    for pathpkg in path[1:]:
-                                        deps[pathpkg] = True
-                                queue.append(path+[upgpkg])
-                for upg in pkg.upgrades:
-                    for prv in upg.providedby:
-                        for prvpkg in prv.packages:
-                            if (not prvpkg.installed and
-                                prvpkg in upgmap and prvpkg not in path and
-                                self.getPriority(pkg) <
-                                self.getPriority(prvpkg)):
-                                if pathlen > 1:
-                                    bonusvalue[pkg] = -30*(pathlen-1)
-                                    deps = bonusdeps.setdefault(pkg, {})
-                                    for pathpkg in path[1:-1]:
-                                        deps[pathpkg] = True
-                                queue.append(path+[prvpkg])
+                for upgpkg in upgbyindex.get(pkg, ()):
+                    if (not upgpkg.installed and
+                        upgpkg in upgmap and upgpkg not in path and
+                        self.getPriority(pkg) <= self.getPriority(upgpkg)):
+                        if pathlen > 1:
+                            # Paths always increase in size, so we can
+                            # be sure that the value being introduced
+                            # here is >= to the previous one.
+                            bonusvalue[pkg] = -30*(pathlen-1)
+                            deps = bonusdeps.setdefault(pkg, {})
+                            for pathpkg in path[1:]:
+                                deps[pathpkg] = True
+                        queue.append(path+[upgpkg])
+                for prvpkg in upgindex.get(pkg, ()):
+                    if (not prvpkg.installed and
+                        prvpkg in upgmap and prvpkg not in path and
+                        self.getPriority(pkg) < self.getPriority(prvpkg)):
+                        if pathlen > 1:
+                            bonusvalue[pkg] = -30*(pathlen-1)
+                            deps = bonusdeps.setdefault(pkg, {})
+                            for pathpkg in path[1:-1]:
+                                deps[pathpkg] = True
+                        queue.append(path+[prvpkg])
             if bonusvalue:
                 lst = [(bonusvalue[pkg], bonusdeps[pkg]) for pkg in bonusvalue]
                 lst.sort()
@@ -451,6 +760,7 @@ class PolicyUpgrade(Policy):
         del self._upgraded
 
     def getWeight(self, changeset):
+        changeset = changeset._getFlat()
         weight = 0
         upgrading = self._upgrading
         upgraded = self._upgraded
@@ -505,6 +815,10 @@ class Transaction(object):
         self._policy = policy and policy(self) or Policy(self)
         self._changeset = changeset or ChangeSet(cache)
         self._queue = queue or {}
+        self._memo = {}
+        self._memoentries = 0
+        self._memohits = 0
+        self._memomisses = 0
 
     def clear(self):
         self._changeset.clear()
@@ -543,6 +857,70 @@ class Transaction(object):
     def __str__(self):
         return str(self._changeset)
 
+    def getMemoStats(self):
+        """Return the (hits, misses) of the solver memo in the last run."""
+        return self._memohits, self._memomisses
+
+    def _attempt(self, op, pkg, changeset, locked, depth=0):
+        """
+        Try to install or remove pkg on top of copies of changeset and
+        locked, returning a (weight, changeset, locked) tuple with the
+        result, or raising Failed.
+
+        The same alternative is often tried from the very same state
+        while exploring different branches, so results are memoized
+        during the run. The returned objects are shared with the memo,
+        and must be copied before being changed.
+        """
+        memosize = sysconf.get("solver-memo-size", 0)
+        if not memosize:
+            return self._tryAttempt(op, pkg, changeset, locked, depth)
+        # The fingerprint of the changeset tells most states apart, so
+        # the full comparison is only done to confirm a match, and is
+        # cheap between changesets copied from one another.
+        requested = changeset._requested
+        key = (op, pkg, changeset._fingerprint, len(changeset),
+               len(requested), len(locked))
+        memo = self._memo
+        entries = memo.get(key)
+        if entries:
+            for entry in entries:
+                if (entry[0] == changeset and
+                    (entry[0]._requested is requested or
+                     entry[0]._requested == requested) and
+                    entry[1] == locked):
+                    self._memohits += 1
+                    result = entry[2]
+                    break
+            else:
+                entries = None
+        if not entries:
+            self._memomisses += 1
+            # Copying the changeset is O(1), so the state is kept on
+            # the first attempt already.
+            snapshot = (changeset.copy(), locked.copy())
+            try:
+                result = self._tryAttempt(op, pkg, changeset, locked, depth)
+            except Failed, e:
+                result = e
+            if self._memoentries >= memosize:
+                memo.clear()
+                self._memoentries = 0
+            memo.setdefault(key, []).append(snapshot+(result,))
+            self._memoentries += 1
+        if isinstance(result, Failed):
+            raise result
+        return result
+
+    def _tryAttempt(self, op, pkg, changeset, locked, depth):
+        cs = changeset.copy()
+        lk = locked.copy()
+        if op is INSTALL:
+            self._install(pkg, cs, lk, None, depth)
+        else:
+            self._remove(pkg, cs, lk, None, depth)
+        return (self._policy.getWeight(cs), cs, lk)
+
     def _install(self, pkg, changeset, locked, pending, depth=0):
         #print "[%03d] _install(%s)" % (depth, pkg)
         #depth += 1
@@ -794,13 +1172,12 @@ class Transaction(object):
         # Check if upgrading is possible.
         for upgpkg in upgpkgs:
             try:
-                cs = changeset.copy()
-                lk = locked.copy()
-                self._install(upgpkg, cs, lk, None, depth)
+                weight, cs, lk = self._attempt(INSTALL, upgpkg, changeset,
+                                               locked, depth)
             except Failed:
                 pass
             else:
-                alternatives.append((getweight(cs), cs))
+                alternatives.append((weight, cs))
 
         # Is any downgrading version of this package installed?
         try:
@@ -831,13 +1208,12 @@ class Transaction(object):
             # Check if downgrading is possible.
             for dwnpkg in dwnpkgs:
                 try:
-                    cs = changeset.copy()
-                    lk = locked.copy()
-                    self._install(dwnpkg, cs, lk, None, depth)
+                    weight, cs, lk = self._attempt(INSTALL, dwnpkg,
+                                                   changeset, locked, depth)
                 except Failed:
                     pass
                 else:
-                    alternatives.append((getweight(cs), cs))
+                    alternatives.append((weight, cs))
 
         # If there's only one alternative, it's the one currenlty in use.
         if len(alternatives) > 1:
@@ -898,13 +1274,13 @@ class Transaction(object):
                     pw = self._policy.getPriorityWeights(prvpkgs)
                     for prvpkg in prvpkgs:
                         try:
-                            cs = changeset.copy()
-                            lk = locked.copy()
-                            self._install(prvpkg, cs, lk, None, depth)
+                            weight, cs, lk = self._attempt(INSTALL, prvpkg,
+                                                           changeset, locked,
+                                                           depth)
                         except Failed, e:
                             failures.append(unicode(e))
                         else:
-                            alternatives.append((getweight(cs)+pw[prvpkg]+
+                            alternatives.append((weight+pw[prvpkg]+
                                                  keeporder, cs, lk))
                             keeporder += 0.000001
                     if not alternatives:
@@ -953,14 +1329,13 @@ class Transaction(object):
                     pw = self._policy.getPriorityWeights(prvpkgs)
                     for prvpkg in prvpkgs:
                         try:
-                            cs = changeset.copy()
-                            lk = locked.copy()
-                            self._install(prvpkg, cs, lk, None, depth)
+                            weight, cs, lk = self._attempt(INSTALL, prvpkg,
+                                                           changeset, locked,
+                                                           depth)
                         except Failed, e:
                             failures.append(unicode(e))
                         else:
-                            alternatives.append((getweight(cs)+pw[prvpkg],
-                                                cs, lk))
+                            alternatives.append((weight+pw[prvpkg], cs, lk))
 
                 if not prvpkgs or not alternatives:
 
@@ -1044,14 +1419,12 @@ class Transaction(object):
                 continue
 
             try:
-                cs = changeset.copy()
-                lk = locked.copy()
-                self._install(pkg, cs, lk, None, depth)
+                csweight, cs, lk = self._attempt(INSTALL, pkg, changeset,
+                                                 locked, depth)
             except Failed, e:
                 pass
             else:
                 lockedstate[pkg] = lk
-                csweight = getweight(cs)
                 if csweight < weight:
                     weight = csweight
                     changeset.setState(cs)
@@ -1070,20 +1443,88 @@ class Transaction(object):
                 pkg not in locked and pkg not in lockedstates):
 
                 try:
-                    cs = changeset.copy()
-                    lk = locked.copy()
                     if op is REMOVE:
-                        self._install(pkg, cs, lk, None, depth)
+                        csweight, cs, lk = self._attempt(INSTALL, pkg,
+                                                         changeset, locked,
+                                                         depth)
                     elif op is INSTALL:
-                        self._remove(pkg, cs, lk, None, depth)
+                        csweight, cs, lk = self._attempt(REMOVE, pkg,
+                                                         changeset, locked,
+                                                         depth)
                 except Failed, e:
                     pass
                 else:
-                    csweight = getweight(cs)
                     if csweight < weight:
                         weight = csweight
                         changeset.setState(cs)
                 
+    def _parallelUpgrade(self, pkgs, changeset, locked, jobs):
+        """
+        Solve independent groups of the upgrade candidates in up to
+        jobs processes, and merge their changes into changeset.
+
+        Return False without touching changeset when there's nothing
+        to gain, or when the groups turned out to interact, so that
+        the serial solver may be used instead.
+        """
+        global _upgradestate
+        try:
+            import multiprocessing
+        except ImportError:
+            return False
+        components = getUpgradeComponents(self._cache, pkgs)
+        if len(components) < 2:
+            return False
+        # Bigger groups first, so that they don't end up running alone.
+        components.sort(key=len, reverse=True)
+        packages = self._cache.getPackages()
+        pkgindex = {}
+        for i, pkg in enumerate(packages):
+            pkgindex[pkg] = i
+        # Workers are forked, so they get the state without pickling it.
+        _upgradestate = (self, changeset, locked, components, pkgindex)
+        try:
+            pool = multiprocessing.Pool(min(jobs, len(components)))
+            try:
+                deltas = pool.map(_upgradeComponent,
+                                  range(len(components)), 1)
+            finally:
+                pool.terminate()
+                pool.join()
+        except Exception, e:
+            iface.debug(_("Parallel upgrade failed: %s") % e)
+            return False
+        finally:
+            _upgradestate = None
+
+        merged = changeset.copy()
+        touched = {}
+        for delta in deltas:
+            for i, op in delta:
+                pkg = packages[i]
+                if pkg in touched:
+                    iface.debug(_("Parallel upgrade: %s changed by "
+                                  "more than one group") % pkg)
+                    return False
+                touched[pkg] = True
+                if op is None:
+                    del merged[pkg]
+                else:
+                    merged[pkg] = op
+        checkset = touched.copy()
+        isinst = merged.installed
+        for pkg in touched:
+            if not isinst(pkg):
+                for prv in pkg.provides:
+                    for req in prv.requiredby:
+                        for reqpkg in req.packages:
+                            checkset[reqpkg] = True
+        if not checkChangeSet(self._cache, merged, checkset):
+            iface.debug(_("Parallel upgrade: groups interact"))
+            return False
+        changeset.setState(merged)
+        return True
+
     def _fix(self, pkgs, changeset, locked, pending, depth=0):
         #print "[%03d] _fix()" % depth
         #depth += 1
@@ -1153,14 +1594,13 @@ class Transaction(object):
 
             # Try to fix by installing it.
             try:
-                cs = changeset.copy()
-                lk = locked.copy()
-                self._install(pkg, cs, lk, None, depth)
+                weight, cs, lk = self._attempt(INSTALL, pkg, changeset,
+                                               locked, depth)
             except Failed, e:
                 failures.append(unicode(e))
             else:
                 # If they weight the same, it's better to keep the package.
-                alternatives.append((getweight(cs)-0.000001, cs))
+                alternatives.append((weight-0.000001, cs))
 
             # Try to fix by removing it.
             try:
@@ -1183,25 +1623,22 @@ class Transaction(object):
     def enqueue(self, pkg, op):
         if op is UPGRADE:
             isinst = self._changeset.installed
+            upgindex, upgbyindex = self._cache.getUpgradeIndex()
             _upgpkgs = {}
             try:
                 pkgpriority = pkg.getPriority()
-                for prv in pkg.provides:
-                    for upg in prv.upgradedby:
-                        for upgpkg in upg.packages:
-                            if upgpkg.getPriority() < pkgpriority:
-                                continue
-                            if isinst(upgpkg):
-                                raise StopIteration
-                            _upgpkgs[upgpkg] = True
-                for upg in pkg.upgrades:
-                    for prv in upg.providedby:
-                        for prvpkg in prv.packages:
-                            if prvpkg.getPriority() <= pkgpriority:
-                                continue
-                            if isinst(prvpkg):
-                                raise StopIteration
-                            _upgpkgs[prvpkg] = True
+                for upgpkg in upgbyindex.get(pkg, ()):
+                    if upgpkg.getPriority() < pkgpriority:
+                        continue
+                    if isinst(upgpkg):
+                        raise StopIteration
+                    _upgpkgs[upgpkg] = True
+                for prvpkg in upgindex.get(pkg, ()):
+                    if prvpkg.getPriority() <= pkgpriority:
+                        continue
+                    if isinst(prvpkg):
+                        raise StopIteration
+                    _upgpkgs[prvpkg] = True
             except StopIteration:
                 pass
             else:
@@ -1211,8 +1648,26 @@ class Transaction(object):
             self._queue[pkg] = op
 
     def run(self):
+        path = sysconf.get("profile-solver")
+        if not path:
+            self._run()
+            return
+        from smart.solverprofile import SolverProfile, dumpSolverProfile
+        profile = SolverProfile()
+        profile.attach(self)
+        try:
+            self._run()
+        finally:
+            profile.detach()
+            dumpSolverProfile(path, profile.getProfile(self))
+
+    def _run(self):
 
         self._policy.runStarting()
+        self._memo.clear()
+        self._memoentries = 0
+        self._memohits = 0
+        self._memomisses = 0
 
         attempt = sysconf.has("attempt-install", soft=True)
 
@@ -1283,7 +1738,11 @@ class Transaction(object):
                 self._pending(changeset, locked, pending)
 
             if upgpkgs:
-                self._upgrade(upgpkgs, changeset, locked, pending)
+                jobs = sysconf.get("upgrade-jobs", 1)
+                if (jobs < 2 or
+                    not self._parallelUpgrade(upgpkgs, changeset, locked,
+                                              jobs)):
+                    self._upgrade(upgpkgs, changeset, locked, pending)
 
             if fixpkgs:
                 self._fix(fixpkgs, changeset, locked, pending)
@@ -1293,6 +1752,11 @@ class Transaction(object):
         finally:
             self._queue.clear()
             self._policy.runFinished()
+            self._memo.clear()
+            self._memoentries = 0
+            if self._memohits or self._memomisses:
+                iface.debug(_("Solver memo: %d hits, %d misses") %
+                            (self._memohits, self._memomisses))
 
 
 class ChangeSetSplitter(object):
@@ -1663,11 +2127,83 @@ class ChangeSetSplitter(object):
             except Error:
                 pass
 
+_upgradestate = None
+
+def _upgradeComponent(index):
+    if _upgradestate is None:
+        raise Error, _("Upgrade state not available in worker")
+    trans, changeset, locked, components, pkgindex = _upgradestate
+    cs = changeset.copy()
+    trans._upgrade(components[index], cs, locked, [])
+    delta = []
+    for pkg in cs:
+        if cs[pkg] is not changeset.get(pkg):
+            delta.append((pkgindex[pkg], cs[pkg]))
+    for pkg in changeset:
+        if pkg not in cs:
+            delta.append((pkgindex[pkg], None))
+    return delta
+
+def getUpgradeComponents(cache, pkgs):
+    """
+    Split the upgrade candidates in pkgs into groups which don't share
+    any directly related package, and thus may be solved separately.
+    """
+    parent = {}
+    def find(pkg):
+        while parent[pkg] is not pkg:
+            parent[pkg] = parent[parent[pkg]]
+            pkg = parent[pkg]
+        return pkg
+    for pkg in pkgs:
+        parent[pkg] = pkg
+    owner = {}
+    for pkg in pkgs:
+        related = {pkg: True}
+        for namepkg in cache.getPackages(pkg.name):
+            related[namepkg] = True
+        for req in pkg.requires + pkg.recommends:
+            for prv in req.providedby:
+                for prvpkg in prv.packages:
+                    related[prvpkg] = True
+        # Relations without links are tuples, so don't add them up.
+        for rels in (pkg.upgrades, pkg.conflicts):
+            for rel in rels:
+                for prv in rel.providedby:
+                    for prvpkg in prv.packages:
+                        related[prvpkg] = True
+        for prv in pkg.provides:
+            for rels in (prv.upgradedby, prv.conflictedby):
+                for rel in rels:
+                    for relpkg in rel.packages:
+                        related[relpkg] = True
+        # Installed packages may go away, and break their requirers.
+        for relpkg in related.keys():
+            if relpkg.installed:
+                for prv in relpkg.provides:
+                    for req in prv.requiredby:
+                        for reqpkg in req.packages:
+                            related[reqpkg] = True
+        for relpkg in related:
+            other = owner.setdefault(relpkg, pkg)
+            if other is not pkg:
+                root, otherroot = find(pkg), find(other)
+                if root is not otherroot:
+                    parent[otherroot] = root
+    components = {}
+    for pkg in pkgs:
+        components.setdefault(find(pkg), []).append(pkg)
+    return [components[root] for root in components]
+
 def sortUpgrades(pkgs, policy=None):
     upgpkgs = {}
+    if policy:
+        upgindex = policy._trans.getCache().getUpgradeIndex()[0]
+    else:
+        upgindex = None
     for pkg in pkgs:
         dct = {}
-        rupg = recursiveUpgrades(pkg, dct)
+        rupg = recursiveUpgrades(pkg, dct, upgindex)
         del dct[pkg]
         upgpkgs[pkg] = dct
     pkgs.sort()
@@ -1691,8 +2227,13 @@ def sortUpgrades(pkgs, policy=None):
             newpkgs.append(pkg)
     pkgs[:] = newpkgs
 
-def recursiveUpgrades(pkg, set):
+def recursiveUpgrades(pkg, set, upgindex=None):
     set[pkg] = True
+    if upgindex is not None:
+        for prvpkg in upgindex.get(pkg, ()):
+            if prvpkg not in set:
+                recursiveUpgrades(prvpkg, set, upgindex)
+        return
     for upg in pkg.upgrades:
         for prv in upg.providedby:
             for prvpkg in prv.packages:
@@ -1939,6 +2480,42 @@ def checkPackages(cache, checkset, relateset, report=False):
 
     return not problems
 
+def checkChangeSet(cache, changeset, checkset):
+    """
+    Check that packages in checkset which are installed once changeset
+    is applied have their requirements satisfied, and don't conflict
+    with other installed packages.
+    """
+    isinst = changeset.installed
+    for pkg in checkset:
+        if not isinst(pkg):
+            continue
+        for req in pkg.requires:
+            for prv in req.providedby:
+                for prvpkg in prv.packages:
+                    if isinst(prvpkg):
+                        break
+                else:
+                    continue
+                break
+            else:
+                return False
+        for cnf in pkg.conflicts:
+            for prv in cnf.providedby:
+                for prvpkg in prv.packages:
+                    if prvpkg is not pkg and isinst(prvpkg):
+                        return False
+        for prv in pkg.provides:
+            for cnf in prv.conflictedby:
+                for cnfpkg in cnf.packages:
+                    if cnfpkg is not pkg and isinst(cnfpkg):
+                        return False
+        for namepkg in cache.getPackages(pkg.name):
+            if (namepkg is not pkg and isinst(namepkg) and
+                not pkg.coexists(namepkg)):
+                return False
+    return True
+
 def enablePsyco(psyco):
     psyco.bind(PolicyInstall.getWeight)
     psyco.bind(PolicyRemove.getWeight)
@@ -45,6 +45,96 @@ class Uncompressor(object):
         else:
             raise Error, _("Unknown compressed file: %s") % localpath
 
+def uncompressFile(localpath):
+    # Used by worker processes, so errors are sent back as messages.
+    try:
+        Uncompressor().uncompress(localpath)
+    except Exception, e:
+        return unicode(e)
+    return None
+
+class MultiStreamDecompressor(object):
+    """
+    Decompress data made of one or more concatenated streams, using
+    decompressor objects built by factory for each one of them.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._decompressor = factory()
+
+    def decompress(self, data):
+        chunks = []
+        while data:
+            chunks.append(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = self._factory()
+        return "".join(chunks)
+
+    def flush(self):
+        if hasattr(self._decompressor, "flush"):
+            return self._decompressor.flush()
+        return ""
+
+class StreamUncompressor(object):
+    """
+    Uncompress data as it arrives into targetpath, optionally feeding
+    the result to a digester. Any error makes it give up quietly, so
+    that the complete file may still be uncompressed the usual way.
+    """
+
+    def __init__(self, decompressor, targetpath, digester=None):
+        self._decompressor = decompressor
+        self._targetpath = targetpath
+        self._partpath = targetpath+".part"
+        self._digester = digester
+        try:
+            self._output = open(self._partpath, "w")
+        except (IOError, OSError):
+            self._output = None
+
+    def write(self, data):
+        if not self._output:
+            return
+        try:
+            data = self._decompressor.decompress(data)
+            self._output.write(data)
+        except Exception:
+            self.abort()
+        else:
+            if self._digester:
+                self._digester.update(data)
+
+    def abort(self):
+        if self._output:
+            self._output.close()
+            self._output = None
+            if os.path.isfile(self._partpath):
+                os.unlink(self._partpath)
+
+    def close(self):
+        """Return the target path, or None if uncompressing failed."""
+        if not self._output:
+            return None
+        try:
+            data = self._decompressor.flush()
+            self._output.write(data)
+        except Exception:
+            self.abort()
+            return None
+        if self._digester:
+            self._digester.update(data)
+        self._output.close()
+        self._output = None
+        os.rename(self._partpath, self._targetpath)
+        return self._targetpath
+
+    def getDigests(self):
+        if self._digester:
+            return self._digester.getDigests()
+        return None
+
 class UncompressorHandler(object):
 
     def query(self, localpath):
@@ -56,6 +146,21 @@ class UncompressorHandler(object):
     def uncompress(self, localpath):
         raise Error, _("Unsupported file type")
 
+    def getDecompressor(self):
+        """
+        Return an object with decompress() and flush() methods, or None
+        if files may only be uncompressed once complete.
+        """
+        return None
+
+    def getStreamUncompressor(self, localpath, digester=None):
+        decompressor = self.getDecompressor()
+        if decompressor:
+            return StreamUncompressor(decompressor,
+                                      self.getTargetPath(localpath),
+                                      digester)
+        return None
+
 class BZ2Handler(UncompressorHandler):
 
     def query(self, localpath):
@@ -79,6 +184,10 @@ class BZ2Handler(UncompressorHandler):
         except EOFError, e:
             raise Error, ("%s\nPossibly corrupted channel file.") % e
 
+    def getDecompressor(self):
+        import bz2
+        return MultiStreamDecompressor(bz2.BZ2Decompressor)
+
 Uncompressor.addHandler(BZ2Handler)
 
 class LZMAHandler(UncompressorHandler):
@@ -113,6 +222,13 @@ class LZMAHandler(UncompressorHandler):
         except EOFError, e:
             raise Error, ("%s\nPossibly corrupted channel file.") % e
 
+    def getDecompressor(self):
+        try:
+            from lzma import LZMADecompressor
+        except ImportError:
+            return None
+        return MultiStreamDecompressor(LZMADecompressor)
+
 Uncompressor.addHandler(LZMAHandler)
 
 
@@ -140,6 +256,13 @@ class XZHandler(UncompressorHandler):
         except EOFError, e:
             raise Error, ("%s\nPossibly corrupted channel file.") % e
 
+    def getDecompressor(self):
+        try:
+            from lzma import LZMADecompressor
+        except ImportError:
+            return None
+        return MultiStreamDecompressor(LZMADecompressor)
+
 Uncompressor.addHandler(XZHandler)
 
 class GZipHandler(UncompressorHandler):
@@ -165,6 +288,12 @@ class GZipHandler(UncompressorHandler):
         except EOFError, e:
             raise Error, ("%s\nPossibly corrupted channel file.") % e
 
+    def getDecompressor(self):
+        import zlib
+        # The extra window bits ask zlib for the gzip format.
+        return MultiStreamDecompressor(
+                lambda: zlib.decompressobj(16+zlib.MAX_WBITS))
+
 Uncompressor.addHandler(GZipHandler)
 
 class ZipHandler(UncompressorHandler):
@@ -0,0 +1,94 @@
+#
+# Copyright (c) 2004 Conectiva, Inc.
+#
+# Written by Gustavo Niemeyer <niemeyer@conectiva.com>
+#
+# This file is part of Smart Package Manager.
+#
+# Smart Package Manager is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# Smart Package Manager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Smart Package Manager; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+from smart import Error, _
+import cStringIO
+import cPickle
+import mmap
+import os
+import gc
+
+#
+# On-disk layout of cache files:
+#
+#   SMARTCACHE <format version> <state version>\n
+#   <cPickle protocol 2 stream>
+#
+# The header is checked before anything is unpickled, so that stale
+# caches are discarded without paying for building the object graph.
+# The pickle stream itself is read straight out of a read-only mapping
+# of the file, avoiding an intermediate copy of the whole file. Objects
+# are still all created when the file is loaded.
+#
+
+MAGIC = "SMARTCACHE"
+FORMATVERSION = 1
+
+class CacheFileError(Error): pass
+
+def getCacheHeader(stateversion):
+    return "%s %d %d\n" % (MAGIC, FORMATVERSION, stateversion)
+
+def dumpCacheFile(path, state, stateversion):
+    """Atomically write state into path, tagged with stateversion."""
+    newpath = path+".new"
+    file = open(newpath, "w")
+    try:
+        try:
+            file.write(getCacheHeader(stateversion))
+            cPickle.dump(state, file, 2)
+        finally:
+            file.close()
+    except:
+        os.unlink(newpath)
+        raise
+    os.rename(newpath, path)
+
+def loadCacheFile(path, stateversion):
+    """Load state from path, raising CacheFileError when the file
+    wasn't written with the same format and state versions."""
+    file = open(path)
+    try:
+        size = os.fstat(file.fileno()).st_size
+        header = getCacheHeader(stateversion)
+        if size <= len(header) or file.read(len(header)) != header:
+            raise CacheFileError, _("Unknown format or version of cache "
+                                    "file %s") % path
+        map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            stream = cStringIO.StringIO(buffer(map, len(header)))
+            # Unpickling creates lots of container objects which are
+            # never garbage, so don't let the collector walk them over
+            # and over while the graph is being built.
+            gcenabled = gc.isenabled()
+            gc.disable()
+            try:
+                return cPickle.Unpickler(stream).load()
+            finally:
+                if gcenabled:
+                    gc.enable()
+                stream.close()
+        finally:
+            map.close()
+    finally:
+        file.close()
+
+# vim:ts=4:sw=4:et
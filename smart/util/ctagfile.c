@@ -29,6 +29,9 @@
 #include <string.h>
 #include <stdlib.h>
 #include <ctype.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 #define BLOCKSIZE 16384
 
@@ -45,8 +48,39 @@ typedef struct {
     char *_buf;
     int   _bufread;
     int   _bufsize;
+    char *_map;
+    long  _mapsize;
 } TagFileObject;
 
+/* Files are mapped in memory when possible, so that sections are
+   parsed right from the page cache, and any section may be looked
+   at without reading the file from its offset on. Characters past
+   the end of the map are seen as newlines, as if the file ended in
+   an empty line. */
+#define MAPCHAR(p) ((p) < self->_mapsize ? self->_map[p] : '\n')
+
+static int
+TagFile_open(TagFileObject *self)
+{
+    struct stat st;
+    void *map;
+    self->_file = fopen(self->_filename, "r");
+    if (!self->_file) {
+        PyErr_SetFromErrnoWithFilename(PyExc_IOError, self->_filename);
+        return -1;
+    }
+    if (fstat(fileno(self->_file), &st) == 0 && S_ISREG(st.st_mode) &&
+        st.st_size > 0) {
+        map = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED,
+                   fileno(self->_file), 0);
+        if (map != MAP_FAILED) {
+            self->_map = (char *)map;
+            self->_mapsize = st.st_size;
+        }
+    }
+    return 0;
+}
+
 static int
 TagFile_init(TagFileObject *self, PyObject *args)
 {
@@ -59,11 +93,8 @@ TagFile_init(TagFileObject *self, PyObject *args)
         return -1;
     if (PyString_Check(file)) {
         self->_filename = strdup(STR(file));
-        self->_file = fopen(self->_filename, "r");
-        if (!self->_file) {
-            PyErr_SetFromErrnoWithFilename(PyExc_IOError, self->_filename);
+        if (TagFile_open(self) == -1)
             return -1;
-        }
     } else {
         PyObject *attr;
         attr = PyObject_GetAttrString(file, "read");
@@ -86,6 +117,8 @@ TagFile_dealloc(TagFileObject *self)
     } else {
         free(self->_filename);
         free(self->_buf);
+        if (self->_map)
+            munmap(self->_map, self->_mapsize);
         if (self->_file)
             fclose(self->_file);
     }
@@ -111,11 +144,8 @@ TagFile__setstate__(TagFileObject *self, PyObject *state)
         return NULL;
     }
     self->_filename = strdup(STR(state));
-    self->_file = fopen(self->_filename, "r");
-    if (!self->_file) {
-        PyErr_SetFromErrnoWithFilename(PyExc_IOError, self->_filename);
+    if (TagFile_open(self) == -1)
         return NULL;
-    }
     Py_INCREF(Py_None);
     return Py_None;
 }
@@ -135,7 +165,7 @@ TagFile_setOffset(TagFileObject *self, PyObject *offset)
         if (!res)
             return NULL;
         Py_DECREF(res);
-    } else {
+    } else if (!self->_map) {
         if (fseek(self->_file, self->_offset, SEEK_SET) == -1) {
             PyErr_SetFromErrnoWithFilename(PyExc_IOError, self->_filename);
             return NULL;
@@ -151,6 +181,158 @@ TagFile_getOffset(TagFileObject *self, PyObject *args)
     return PyInt_FromLong(self->_offset);
 }
 
+/* Find where the section at or after pos starts and ends in the map,
+   skipping lines which aren't fields, and return 0 if there are no
+   more sections. */
+static int
+TagFile_findSection(TagFileObject *self, long pos, long *start, long *end)
+{
+    char *map = self->_map;
+    char *nl;
+    long lineend;
+
+    for (;;) {
+        if (pos >= self->_mapsize)
+            return 0;
+        nl = memchr(map+pos, '\n', self->_mapsize-pos);
+        lineend = nl ? nl-map : self->_mapsize;
+        if (!isspace(map[pos]) && memchr(map+pos, ':', lineend-pos))
+            break;
+        pos = lineend+1;
+    }
+    *start = pos;
+    for (;;) {
+        nl = memchr(map+pos, '\n', self->_mapsize-pos);
+        if (!nl || MAPCHAR(nl-map+1) == '\n')
+            break;
+        pos = nl-map+1;
+    }
+    *end = nl ? nl-map+2 : self->_mapsize;
+    if (*end > self->_mapsize)
+        *end = self->_mapsize;
+    return 1;
+}
+
+/* Parse the fields of the mapped section between start and end into
+   dict, or, if onlykey is given, return the value of that field only,
+   or NULL with no exception set if it's not there. Values in a single
+   line are taken from the map as they are, and others are copied into
+   the buffer to have their lines joined. */
+static PyObject *
+TagFile_parseSection(TagFileObject *self, long start, long end,
+                     PyObject *dict, const char *onlykey)
+{
+    char *map = self->_map;
+    long pos = start;
+    long keystart, keyend;
+    long valuestart;
+    int valuelen, valueend;
+    int wanted, i, c;
+    char *out;
+
+    PyObject *key, *value;
+
+    while (pos < end) {
+
+        keystart = pos;
+        keyend = -1;
+
+        for (;;) {
+            c = MAPCHAR(pos);
+            if (c == '\n') {
+                pos += 1;
+                break;
+            }
+            if (c == ':') {
+                if (keyend == -1)
+                    keyend = pos;
+                pos += 1;
+                break;
+            }
+            if (c != ' ' && c != '\t')
+                keyend = pos+1;
+            pos += 1;
+        }
+        if (c == '\n')
+            continue;
+
+        wanted = 1;
+        if (onlykey) {
+            wanted = ((long)strlen(onlykey) == keyend-keystart);
+            for (i = 0; wanted && i != keyend-keystart; i++)
+                wanted = (tolower(map[keystart+i]) == onlykey[i]);
+        }
+
+        while (MAPCHAR(pos) == ' ' || MAPCHAR(pos) == '\t')
+            pos += 1;
+
+        valuestart = pos;
+        valuelen = 0;
+        valueend = 0;
+        out = NULL;
+
+        for (;;) {
+            c = MAPCHAR(pos);
+            if (c == '\n') {
+                pos += 1;
+                c = MAPCHAR(pos);
+                if (c == '\n' || !isspace(c))
+                    break;
+                if (wanted && !out) {
+                    if (end-valuestart > self->_bufsize) {
+                        self->_bufsize = end-valuestart;
+                        self->_buf = (char *)realloc(self->_buf,
+                                                     self->_bufsize);
+                        if (!self->_buf)
+                            return PyErr_NoMemory();
+                    }
+                    out = self->_buf;
+                    memcpy(out, map+valuestart, valuelen);
+                }
+                if (out)
+                    out[valuelen] = '\n';
+                valuelen += 1;
+                if (MAPCHAR(pos+1) == '.' && MAPCHAR(pos+2) == '\n')
+                    pos += 1;
+            } else {
+                if (out)
+                    out[valuelen] = c;
+                valuelen += 1;
+                if (c != ' ' && c != '\t')
+                    valueend = valuelen;
+            }
+            pos += 1;
+        }
+
+        if (!wanted)
+            continue;
+
+        value = PyString_FromStringAndSize(out ? out : map+valuestart,
+                                           valueend);
+        if (!value)
+            return NULL;
+        if (onlykey)
+            return value;
+
+        key = PyString_FromStringAndSize(NULL, keyend-keystart);
+        if (!key) {
+            Py_DECREF(value);
+            return NULL;
+        }
+        for (i = 0; i != keyend-keystart; i++)
+            PyString_AS_STRING(key)[i] = tolower(map[keystart+i]);
+        PyString_InternInPlace(&key);
+        PyDict_SetItem(dict, key, value);
+        Py_DECREF(key);
+        Py_DECREF(value);
+    }
+
+    if (onlykey)
+        return NULL;
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
 static PyObject *
 TagFile_advanceSection(TagFileObject *self, PyObject *args)
 {
@@ -166,6 +348,22 @@ TagFile_advanceSection(TagFileObject *self, PyObject *args)
 
     PyDict_Clear((PyObject *)&self->dict);
 
+    if (self->_map) {
+        long start, end;
+        PyObject *res;
+        if (!TagFile_findSection(self, self->_offset, &start, &end)) {
+            self->_offset = self->_mapsize;
+            return PyBool_FromLong(0);
+        }
+        res = TagFile_parseSection(self, start, end,
+                                   (PyObject *)&self->dict, NULL);
+        if (!res)
+            return NULL;
+        Py_DECREF(res);
+        self->_offset = end;
+        return PyBool_FromLong(PyDict_Size((PyObject *)&self->dict));
+    }
+
     /* Ensure we have a whole section in the buffer. */
     sectionstart = pos = 0;
     skip = 1;
@@ -347,12 +545,57 @@ exitvalueloop:
     return PyBool_FromLong(PyDict_Size((PyObject *)&self->dict));
 }
 
+static PyObject *
+TagFile_getField(TagFileObject *self, PyObject *args)
+{
+    PyObject *offset, *value;
+    const char *key;
+    long start, end;
+
+    if (!PyArg_ParseTuple(args, "Os", &offset, &key))
+        return NULL;
+
+    if (!self->_map) {
+        /* Parse the whole section, as it has to be read anyway. */
+        value = TagFile_setOffset(self, offset);
+        if (!value)
+            return NULL;
+        Py_DECREF(value);
+        value = TagFile_advanceSection(self, NULL);
+        if (!value)
+            return NULL;
+        Py_DECREF(value);
+        value = PyDict_GetItemString((PyObject *)&self->dict, key);
+        if (!value)
+            value = Py_None;
+        Py_INCREF(value);
+        return value;
+    }
+
+    if (!PyInt_Check(offset)) {
+        PyErr_SetString(PyExc_ValueError, "Invalid offset");
+        return NULL;
+    }
+    value = NULL;
+    if (TagFile_findSection(self, PyInt_AsLong(offset), &start, &end)) {
+        value = TagFile_parseSection(self, start, end, NULL, key);
+        if (!value && PyErr_Occurred())
+            return NULL;
+    }
+    if (!value) {
+        Py_INCREF(Py_None);
+        value = Py_None;
+    }
+    return value;
+}
+
 static PyMethodDef TagFile_methods[] = {
     {"__getstate__", (PyCFunction)TagFile__getstate__, METH_NOARGS, NULL},
     {"__setstate__", (PyCFunction)TagFile__setstate__, METH_O, NULL},
     {"getOffset", (PyCFunction)TagFile_getOffset, METH_NOARGS, NULL},
     {"setOffset", (PyCFunction)TagFile_setOffset, METH_O, NULL},
     {"advanceSection", (PyCFunction)TagFile_advanceSection, METH_NOARGS, NULL},
+    {"getField", (PyCFunction)TagFile_getField, METH_VARARGS, NULL},
     {NULL, NULL}
 };
 
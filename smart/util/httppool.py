@@ -0,0 +1,210 @@
+#
+# Copyright (c) 2004 Conectiva, Inc.
+#
+# Written by Gustavo Niemeyer <niemeyer@conectiva.com>
+#
+# This file is part of Smart Package Manager.
+#
+# Smart Package Manager is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# Smart Package Manager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Smart Package Manager; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+import threading
+import urlparse
+import httplib
+import urllib
+import base64
+import socket
+
+MAXPERHOST = 5
+MAXREDIRECTS = 10
+DRAINSIZE = 65536
+DEFAULTPORTS = {"http": 80, "https": 443}
+
+class HTTPPoolResponse(urllib.addinfourl):
+    """
+    Response read from a pooled connection. It looks like what
+    urllib.FancyURLopener returns, including the errcode and errmsg
+    attributes for unsuccessful requests, and gives the connection
+    back to the pool once closed.
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        # addinfourl.__init__() wants a file object, which
+        # httplib responses aren't.
+        self.fp = response
+        self.read = response.read
+        self.headers = response.msg
+        self.url = url
+        self.code = response.status
+        if not 200 <= response.status < 300:
+            self.errcode = response.status
+            self.errmsg = response.reason
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+
+    def __repr__(self):
+        return "<%s for %s>" % (self.__class__.__name__, self.url)
+
+    def close(self):
+        conn = self._conn
+        if not conn:
+            return
+        self._conn = None
+        response = self.fp
+        if (not response.isclosed() and response.length is not None and
+            response.length <= DRAINSIZE):
+            # Small bodies, like error pages, are read out so that
+            # the connection may still be used.
+            try:
+                response.read()
+            except (httplib.HTTPException, socket.error):
+                pass
+        reuse = response.isclosed() and not response.will_close
+        response.close()
+        self._pool.release(self._key, conn, reuse)
+
+class HTTPConnectionPool(object):
+    """
+    Keep HTTP/1.1 connections to each host open, so that they may be
+    used for several requests, and limit how many are used at once.
+    """
+
+    def __init__(self, maxperhost=MAXPERHOST):
+        self._maxperhost = maxperhost
+        self._lock = threading.Condition()
+        self._idle = {}   # (scheme, host, port) -> [conn, ...]
+        self._active = {} # (scheme, host, port) -> num
+
+    def acquire(self, key):
+        """
+        Return a (conn, reused) tuple for the given (scheme, host, port),
+        waiting while the host has as many connections in use as allowed.
+        """
+        self._lock.acquire()
+        try:
+            while self._active.get(key, 0) >= self._maxperhost:
+                self._lock.wait()
+            self._active[key] = self._active.get(key, 0)+1
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        finally:
+            self._lock.release()
+        scheme, host, port = key
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, port)
+        else:
+            conn = httplib.HTTPConnection(host, port)
+        return conn, False
+
+    def release(self, key, conn, reuse):
+        self._lock.acquire()
+        try:
+            self._active[key] -= 1
+            if reuse:
+                self._idle.setdefault(key, []).append(conn)
+                conn = None
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+        if conn:
+            conn.close()
+
+    def getIdleCount(self, key=None):
+        self._lock.acquire()
+        try:
+            if key:
+                return len(self._idle.get(key, ()))
+            return sum([len(x) for x in self._idle.values()])
+        finally:
+            self._lock.release()
+
+    def closeIdle(self):
+        self._lock.acquire()
+        try:
+            idle = self._idle.values()
+            self._idle.clear()
+        finally:
+            self._lock.release()
+        for conns in idle:
+            for conn in conns:
+                conn.close()
+
+    def open(self, url, headers=(), user=None, passwd=None):
+        """
+        Send a GET request for url with the given (name, value) headers,
+        following redirections, and return an HTTPPoolResponse.
+
+        Credentials are only sent while redirections stay on the scheme,
+        host and port of url. Raise IOError if there are more than
+        MAXREDIRECTS redirections.
+        """
+        origin = self._getOrigin(url)
+        redirects = 0
+        while True:
+            remote = self._open(url, headers, user, passwd)
+            location = remote.headers.get("location")
+            if remote.code not in (301, 302, 303, 307) or not location:
+                break
+            newurl = urlparse.urljoin(url, location)
+            if urllib.splittype(newurl)[0] not in ("http", "https"):
+                break
+            remote.close()
+            if redirects == MAXREDIRECTS:
+                raise IOError, ("http error", "too many redirects")
+            redirects += 1
+            url = newurl
+            if user and self._getOrigin(url) != origin:
+                user = passwd = None
+        return remote
+
+    def _splitURL(self, url):
+        scheme, rest = urllib.splittype(url)
+        hostport, path = urllib.splithost(rest)
+        userpasswd, hostport = urllib.splituser(hostport)
+        host, port = urllib.splitport(hostport)
+        if port:
+            port = int(port)
+        return (scheme, host, port), path
+
+    def _getOrigin(self, url):
+        (scheme, host, port), path = self._splitURL(url)
+        return scheme, (host or "").lower(), port or DEFAULTPORTS.get(scheme)
+
+    def _open(self, url, headers, user, passwd):
+        key, path = self._splitURL(url)
+        reqheaders = {}
+        for name, value in headers:
+            reqheaders[name] = value
+        if user:
+            auth = base64.encodestring("%s:%s" % (user, passwd or ""))
+            reqheaders["Authorization"] = "Basic "+auth.replace("\n", "")
+        while True:
+            conn, reused = self.acquire(key)
+            try:
+                conn.request("GET", path or "/", headers=reqheaders)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                self.release(key, conn, False)
+                if reused:
+                    # The server closed the idle connection.
+                    continue
+                if isinstance(e, socket.error):
+                    raise
+                raise IOError, ("http error", str(e) or
+                                              e.__class__.__name__)
+            return HTTPPoolResponse(self, key, conn, response, url)
+
+# vim:ts=4:sw=4:et
@@ -0,0 +1,97 @@
+#
+# Copyright (c) 2004 Conectiva, Inc.
+#
+# Written by Gustavo Niemeyer <niemeyer@conectiva.com>
+#
+# This file is part of Smart Package Manager.
+#
+# Smart Package Manager is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# Smart Package Manager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Smart Package Manager; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+import threading
+import Queue
+import sys
+
+class MainThreadCalls(object):
+    """
+    Run calls made by other threads in the thread which created this,
+    normally the main one, one at a time, while it waits for those
+    threads with join(). Calls made by that thread run right away.
+    """
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = threading.currentThread()
+
+    def call(self, func, *args, **kwargs):
+        """Call func in the main thread, and return its result."""
+        if threading.currentThread() is self._thread:
+            return func(*args, **kwargs)
+        done = threading.Event()
+        result = []
+        self._queue.put((func, args, kwargs, done, result))
+        done.wait()
+        value, exc_info = result[0]
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return value
+
+    def wrap(self, object, types=()):
+        """
+        Return a proxy for object whose methods run in the main thread.
+        Their results which are instances of types are wrapped as well.
+        """
+        return MainThreadProxy(self, object, types)
+
+    def join(self, threads):
+        """Wait for threads to finish, running their calls meanwhile."""
+        while True:
+            alive = [x for x in threads if x.isAlive()]
+            if not alive and self._queue.empty():
+                break
+            try:
+                # The timeout keeps the main thread interruptible.
+                func, args, kwargs, done, result = self._queue.get(True, 0.5)
+            except Queue.Empty:
+                continue
+            try:
+                result.append((func(*args, **kwargs), None))
+            except:
+                result.append((None, sys.exc_info()))
+            done.set()
+
+class MainThreadProxy(object):
+
+    def __init__(self, calls, object, types=()):
+        self._calls = calls
+        self._object = object
+        self._types = types
+
+    def __getattr__(self, attr):
+        value = getattr(self._object, attr)
+        if not callable(value):
+            return value
+        calls = self._calls
+        types = self._types
+        def method(*args, **kwargs):
+            result = calls.call(value, *args, **kwargs)
+            if types and isinstance(result, types):
+                result = calls.wrap(result, types)
+            return result
+        return method
+
+    def __repr__(self):
+        return "<%s for %r>" % (self.__class__.__name__, self._object)
+
+# vim:ts=4:sw=4:et
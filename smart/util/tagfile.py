@@ -80,4 +80,30 @@ class TagFile(dict):
             pass
         return bool(self)
 
+    def getField(self, offset, key):
+        self.setOffset(offset)
+        self.advanceSection()
+        return self.get(key)
+
+class TagSection(object):
+    """
+    Fields of the section at the given offset of a TagFile, each one
+    parsed on its own when it's first asked for.
+    """
+
+    def __init__(self, tagfile, offset):
+        self._tagfile = tagfile
+        self._offset = offset
+        self._fields = {}
+
+    def get(self, key, default=None):
+        try:
+            value = self._fields[key]
+        except KeyError:
+            value = self._fields[key] = self._tagfile.getField(self._offset,
+                                                               key)
+        if value is None:
+            return default
+        return value
+
 from ctagfile import *
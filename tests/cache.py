@@ -0,0 +1,264 @@
+import cPickle
+
+from tests.mocker import MockerTestCase
+
+from smart.cache import Cache, Loader, Package, Provides, Requires, Conflicts
+from smart.cache import Upgrades
+
+
+class LinkRequires(Requires):
+
+    __slots__ = ()
+
+    def matches(self, prv):
+        return prv.name == self.name
+
+
+class LinkUpgrades(Upgrades):
+
+    __slots__ = ()
+
+    def matches(self, prv):
+        return prv.name == self.name
+
+
+class LinkConflicts(Conflicts):
+
+    __slots__ = ()
+
+    def matches(self, prv):
+        return prv.name == self.name
+
+
+class LinkLoader(Loader):
+
+    def __init__(self, packages, installed=False, upgrades={}):
+        Loader.__init__(self)
+        self._data = packages
+        self._upgrades = upgrades
+        self.setInstalled(installed)
+
+    def getLoadSteps(self):
+        return 1
+
+    def load(self):
+        for name, provides, requires, conflicts in self._data:
+            pkg = self.buildPackage((Package, name, "1.0"),
+                                    [(Provides, x, None) for x in provides],
+                                    [(LinkRequires, x, None, None)
+                                     for x in requires],
+                                    [(LinkUpgrades, x, None, None)
+                                     for x in self._upgrades.get(name, ())],
+                                    [(LinkConflicts, x, None, None)
+                                     for x in conflicts])
+            pkg.loaders[self] = name
+
+    def loadFileProvides(self, fndict):
+        self.fndict = fndict
+
+
+INSTALLED = [("a", ["a"], ["b"], []),
+             ("b", ["b", "/usr/bin/b"], [], [])]
+AVAILABLE = [("c", ["c", "b"], ["a", "/usr/bin/b"], ["d"]),
+             ("e", ["e"], ["c"], [])]
+EXTRA = [("d", ["d", "a"], ["e", "/usr/bin/d"], [])]
+
+
+def getNames(objs):
+    return sorted(str(obj) for obj in objs)
+
+
+def getLinks(cache):
+    links = []
+    for prv in cache.getProvides():
+        for attr in ("requiredby", "conflictedby"):
+            for dep in getattr(prv, attr):
+                links.append((getNames(prv.packages), str(prv), attr,
+                              getNames(dep.packages), str(dep)))
+    for dep in cache.getRequires()+cache.getConflicts():
+        for prv in dep.providedby:
+            links.append((getNames(dep.packages), str(dep),
+                          getNames(prv.packages), str(prv)))
+    links.sort()
+    return links
+
+
+class CacheTest(MockerTestCase):
+
+    def build_cache(self, *data):
+        cache = Cache()
+        for packages in data:
+            cache.addLoader(LinkLoader(packages))
+        cache.load()
+        return cache
+
+    def test_link_deps(self):
+        cache = self.build_cache(INSTALLED, AVAILABLE)
+        [a] = cache.getPackages("a")
+        [c] = cache.getPackages("c")
+        [req] = [x for x in c.requires if x.name == "a"]
+        self.assertEquals(req.providedby, [a.provides[0]])
+        self.assertEquals(a.provides[0].requiredby, [req])
+
+    def test_add_loader(self):
+        cache = self.build_cache(INSTALLED, AVAILABLE)
+        cache.addLoader(LinkLoader(EXTRA))
+        cache.load()
+        self.assertEquals(getLinks(cache),
+                          getLinks(self.build_cache(INSTALLED, AVAILABLE,
+                                                    EXTRA)))
+
+    def test_remove_loader(self):
+        cache = Cache()
+        loaders = [LinkLoader(INSTALLED), LinkLoader(AVAILABLE),
+                   LinkLoader(EXTRA)]
+        for loader in loaders:
+            cache.addLoader(loader)
+        cache.load()
+        cache.removeLoader(loaders[1])
+        cache.load()
+        self.assertEquals(getLinks(cache),
+                          getLinks(self.build_cache(INSTALLED, EXTRA)))
+
+    def test_reload_keeps_links(self):
+        cache = self.build_cache(INSTALLED, AVAILABLE)
+        links = getLinks(cache)
+        cache.load()
+        self.assertEquals(getLinks(cache), links)
+
+    def test_new_loader_gets_all_file_provides(self):
+        cache = Cache()
+        installed = LinkLoader(INSTALLED)
+        cache.addLoader(installed)
+        cache.addLoader(LinkLoader(AVAILABLE))
+        cache.load()
+        self.assertEquals(installed.fndict, {"/usr/bin/b": "/usr/bin/b"})
+        del installed.fndict
+        extra = LinkLoader(EXTRA)
+        cache.addLoader(extra)
+        cache.load()
+        self.assertEquals(installed.fndict, {"/usr/bin/d": "/usr/bin/d"})
+        self.assertEquals(extra.fndict, {"/usr/bin/b": "/usr/bin/b",
+                                         "/usr/bin/d": "/usr/bin/d"})
+
+    def test_pickle_keeps_links(self):
+        cache = self.build_cache(INSTALLED, AVAILABLE)
+        links = getLinks(cache)
+        cache = cPickle.loads(cPickle.dumps(cache, 2))
+        self.assertEquals(getLinks(cache), links)
+        cache.addLoader(LinkLoader(EXTRA))
+        cache.load()
+        self.assertEquals(getLinks(cache),
+                          getLinks(self.build_cache(INSTALLED, AVAILABLE,
+                                                    EXTRA)))
+
+    def test_reset_unlinks(self):
+        cache = self.build_cache(INSTALLED, AVAILABLE)
+        cache.reset()
+        self.assertEquals(cache.getProvides(), [])
+        cache.load()
+        self.assertEquals(getLinks(cache),
+                          getLinks(self.build_cache(INSTALLED, AVAILABLE)))
+
+    def test_get_by_name(self):
+        cache = self.build_cache(INSTALLED, AVAILABLE)
+        [c] = cache.getPackages("c")
+        self.assertEquals(str(c), "c-1.0")
+        [prv] = cache.getProvides("b")
+        self.assertEquals(getNames(prv.packages), ["b-1.0", "c-1.0"])
+        self.assertEquals(cache.getRequires("a")[0].packages, [c])
+        self.assertEquals(cache.getConflicts("d")[0].packages, [c])
+        self.assertEquals(cache.getUpgrades("a"), [])
+        self.assertEquals(cache.getPackages("d"), [])
+
+    def test_get_by_name_returns_copy(self):
+        cache = self.build_cache(INSTALLED, AVAILABLE)
+        cache.getPackages("c").append(None)
+        self.assertEquals(len(cache.getPackages("c")), 1)
+
+    def test_get_by_name_after_load(self):
+        cache = Cache()
+        loader = LinkLoader(AVAILABLE)
+        cache.addLoader(LinkLoader(INSTALLED))
+        cache.addLoader(loader)
+        cache.load()
+        self.assertEquals(len(cache.getPackages("c")), 1)
+        cache.removeLoader(loader)
+        cache.load()
+        self.assertEquals(cache.getPackages("c"), [])
+        self.assertEquals(len(cache.getProvides("b")), 1)
+        cache.addLoader(LinkLoader(EXTRA))
+        cache.load()
+        self.assertEquals(len(cache.getPackages("d")), 1)
+        [prv] = cache.getProvides("a")
+        self.assertEquals(len(prv.packages), 2)
+        cache.reset()
+        self.assertEquals(cache.getPackages("d"), [])
+        cache = cPickle.loads(cPickle.dumps(self.build_cache(EXTRA), 2))
+        self.assertEquals(len(cache.getPackages("d")), 1)
+
+    def test_objects_have_no_dict(self):
+        cache = self.build_cache(INSTALLED, AVAILABLE)
+        for obj in (cache.getPackages() + cache.getProvides() +
+                    cache.getRequires() + cache.getConflicts()):
+            self.assertFalse(hasattr(obj, "__dict__"))
+
+    def test_upgrade_index(self):
+        cache = Cache()
+        cache.addLoader(LinkLoader(INSTALLED))
+        loader = LinkLoader(AVAILABLE, upgrades={"c": ["a"], "e": ["b", "c"]})
+        cache.addLoader(loader)
+        cache.load()
+        index = cache.getUpgradeIndex()
+        upgrades, upgradedby = index
+        self.assertEquals(sorted((str(pkg), getNames(upgrades[pkg]))
+                                 for pkg in upgrades),
+                          [("c-1.0", ["a-1.0"]),
+                           ("e-1.0", ["b-1.0", "c-1.0"])])
+        self.assertEquals(sorted((str(pkg), getNames(upgradedby[pkg]))
+                                 for pkg in upgradedby),
+                          [("a-1.0", ["c-1.0"]),
+                           ("b-1.0", ["e-1.0"]),
+                           ("c-1.0", ["e-1.0"])])
+        self.assertTrue(cache.getUpgradeIndex() is index)
+        cache.removeLoader(loader)
+        cache.load()
+        self.assertEquals(cache.getUpgradeIndex(), ({}, {}))
+
+    def test_missing_relations_are_shared(self):
+        cache = self.build_cache(INSTALLED, AVAILABLE)
+        [b] = cache.getPackages("b")
+        self.assertTrue(b.upgrades is ())
+        self.assertTrue(b.conflicts is ())
+        [c] = cache.getPackages("c")
+        self.assertEquals(getNames(c.conflicts), ["d"])
+
+    def test_file_provides_without_provides(self):
+        loader = LinkLoader([("f", [], [], [])])
+        cache = Cache()
+        cache.addLoader(loader)
+        cache.load()
+        [f] = cache.getPackages("f")
+        loader.buildFileProvides(f, (Provides, "/usr/bin/f", None))
+        self.assertEquals(getNames(f.provides), ["/usr/bin/f"])
+
+    def test_recommends_packages_once(self):
+        cache = Cache()
+        loader = Loader()
+        cache.addLoader(loader)
+        loader.buildPackage((Package, "a", "1.0"), [], [], [], [],
+                            [(LinkRequires, "b", None, None)])
+        [rec] = cache.getRecommends()
+        self.assertEquals(getNames(rec.packages), ["a-1.0"])
+
+    def test_names_are_interned(self):
+        # Build the names at runtime, so that they aren't the same
+        # strings already.
+        name = "".join(["lib", "name"])
+        cache = self.build_cache([(name, [name], [], [])],
+                                 [("user", [], ["".join(["lib", "name"])],
+                                   [])])
+        [pkg] = cache.getPackages("libname")
+        [req] = cache.getRequires("libname")
+        self.assertTrue(pkg.name is req.name)
+        self.assertTrue(pkg.provides[0].name is req.name)
@@ -0,0 +1,156 @@
+from tests.mocker import MockerTestCase
+
+from smart.cachesegment import SegmentSplicer, dumpSegment, getSegmentPath
+from smart.channel import PackageChannel
+from smart.cache import Cache, Loader, Package, Provides, Requires
+
+
+class SegmentRequires(Requires):
+
+    def matches(self, prv):
+        return prv.name == self.name
+
+
+class SegmentLoader(Loader):
+
+    def __init__(self, packages, installed=False):
+        Loader.__init__(self)
+        self._data = packages
+        self._extra = {}
+        self.setInstalled(installed)
+
+    def getLoadSteps(self):
+        return 1
+
+    def load(self):
+        for name, provides, requires in self._data:
+            pkg = self.buildPackage((Package, name, "1.0"),
+                                    [(Provides, x, None) for x in provides],
+                                    [(SegmentRequires, x, None, None)
+                                     for x in requires],
+                                    [], [])
+            pkg.loaders[self] = name
+            self._extra[pkg] = name
+
+
+class SegmentChannel(PackageChannel):
+
+    def __init__(self, alias, digest, packages):
+        super(SegmentChannel, self).__init__("segment", alias)
+        self._packages = packages
+        self._newdigest = digest
+
+    def fetch(self, fetcher, progress):
+        self.removeLoaders()
+        loader = SegmentLoader(self._packages)
+        loader.setChannel(self)
+        self._loaders.append(loader)
+        self._digest = self._newdigest
+        return True
+
+
+INSTALLED = [("a", ["a"], [])]
+AVAILABLE = [("a", ["a"], []), ("b", ["b"], ["a"])]
+
+
+class CacheSegmentTest(MockerTestCase):
+
+    def setUp(self):
+        self.dir = self.makeDir()
+
+    def build_cache(self, channel):
+        cache = Cache()
+        installed = SegmentLoader(INSTALLED, installed=True)
+        cache.addLoader(installed)
+        channel.fetch(None, None)
+        channel.addLoaders(cache)
+        cache.load()
+        return cache
+
+    def restore_cache(self, channel):
+        cache = Cache()
+        cache.addLoader(SegmentLoader(INSTALLED, installed=True))
+        cache.load()
+        channel.fetch(None, None)
+        splicer = SegmentSplicer(cache)
+        path = getSegmentPath(self.dir, channel)
+        result = splicer.restore(path, channel)
+        cache.load()
+        return result, cache
+
+    def test_segment_path(self):
+        channel = SegmentChannel("alias", "digest", AVAILABLE)
+        self.assertEquals(getSegmentPath(self.dir, channel),
+                          self.dir+"/alias%%segment")
+
+    def test_restore(self):
+        channel = SegmentChannel("alias", "digest", AVAILABLE)
+        self.build_cache(channel)
+        path = getSegmentPath(self.dir, channel)
+        self.assertTrue(dumpSegment(path, channel))
+
+        channel = SegmentChannel("alias", "digest", AVAILABLE)
+        result, cache = self.restore_cache(channel)
+        self.assertTrue(result)
+
+        [loader] = channel.getLoaders()
+        self.assertTrue(loader.getCache() is cache)
+        self.assertTrue(loader.getChannel() is channel)
+        self.assertEquals(loader._data, AVAILABLE)
+
+        packages = sorted(cache.getPackages(), key=str)
+        self.assertEquals([str(pkg) for pkg in packages],
+                          ["a-1.0", "b-1.0"])
+        a, b = packages
+        self.assertTrue(a.installed)
+        self.assertFalse(b.installed)
+        self.assertEquals(len(a.loaders), 2)
+        self.assertEquals(a.loaders[loader], "a")
+        self.assertEquals(sorted(loader.getPackages(), key=str), packages)
+        self.assertEquals(sorted(loader._extra.items()),
+                          sorted([(a, "a"), (b, "b")]))
+        self.assertEquals(len(cache.getProvides()), 2)
+        [req] = b.requires
+        self.assertEquals(req.providedby, [a.provides[0]])
+
+    def test_restore_with_different_digest(self):
+        channel = SegmentChannel("alias", "digest", AVAILABLE)
+        self.build_cache(channel)
+        dumpSegment(getSegmentPath(self.dir, channel), channel)
+
+        channel = SegmentChannel("alias", "other", AVAILABLE)
+        result, cache = self.restore_cache(channel)
+        self.assertFalse(result)
+
+    def test_restore_with_different_configuration(self):
+        channel = SegmentChannel("alias", "digest", AVAILABLE)
+        self.build_cache(channel)
+        dumpSegment(getSegmentPath(self.dir, channel), channel)
+
+        channel = SegmentChannel("alias", "digest", INSTALLED)
+        result, cache = self.restore_cache(channel)
+        self.assertFalse(result)
+
+    def test_restore_without_segment(self):
+        channel = SegmentChannel("alias", "digest", AVAILABLE)
+        result, cache = self.restore_cache(channel)
+        self.assertFalse(result)
+
+    def test_restore_broken_segment(self):
+        channel = SegmentChannel("alias", "digest", AVAILABLE)
+        path = getSegmentPath(self.dir, channel)
+        open(path, "w").write("broken")
+        result, cache = self.restore_cache(channel)
+        self.assertFalse(result)
+
+    def test_dump_with_volatile_digest(self):
+        channel = SegmentChannel("alias", object(), AVAILABLE)
+        self.build_cache(channel)
+        self.assertFalse(dumpSegment(getSegmentPath(self.dir, channel),
+                                     channel))
+
+    def test_dump_with_unloaded_loader(self):
+        channel = SegmentChannel("alias", "digest", AVAILABLE)
+        channel.fetch(None, None)
+        self.assertFalse(dumpSegment(getSegmentPath(self.dir, channel),
+                                     channel))
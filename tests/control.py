@@ -0,0 +1,128 @@
+import threading
+
+from tests.mocker import MockerTestCase
+from tests import ctrl
+
+from smart.channel import Channel
+from smart.progress import Progress
+from smart.const import OPTIONAL
+from smart import sysconf, iface
+
+
+class FetchChannel(Channel):
+
+    def __init__(self, alias, fetches, barrier, **kwargs):
+        Channel.__init__(self, "test", alias, **kwargs)
+        self._fetches = fetches
+        self._barrier = barrier
+
+    def fetch(self, fetcher, progress):
+        self._fetches.append((self.getAlias(), fetcher,
+                              fetcher.getLocalPathPrefix()))
+        self._barrier.wait(5)
+        return self.getAlias() != "broken"
+
+
+class ReportChannel(FetchChannel):
+
+    def fetch(self, fetcher, progress):
+        iface.debug(self.getAlias())
+        progress.setTopic(self.getAlias())
+        return FetchChannel.fetch(self, fetcher, progress)
+
+
+class ItemChannel(FetchChannel):
+
+    def fetch(self, fetcher, progress):
+        # Fetched items report through the progress of the interface.
+        subprogress = iface.getSubProgress(fetcher)
+        subprogress.setSub(self.getAlias(), 0, 1)
+        subprogress.setSubDone(self.getAlias())
+        return FetchChannel.fetch(self, fetcher, progress)
+
+
+class ReloadChannelsTest(MockerTestCase):
+
+    def setUp(self):
+        self.fetches = []
+        self.barrier = threading.Event()
+        self.addCleanup(sysconf.remove, "last-update")
+        self.addCleanup(sysconf.remove, "update-jobs", soft=True)
+
+    def build_channels(self, *aliases, **kwargs):
+        return [FetchChannel(alias, self.fetches, self.barrier, **kwargs)
+                for alias in aliases]
+
+    def test_fetch_channels_at_once(self):
+        channels = self.build_channels("a", "b", "c")
+        def release():
+            # All channels must be waiting at the same time.
+            while len(self.fetches) < 3:
+                if not thread.isAlive():
+                    return
+                thread.join(0.01)
+            self.barrier.set()
+        sysconf.set("update-jobs", 3, soft=True)
+        thread = threading.Thread(target=ctrl.reloadChannels,
+                                  args=(channels, OPTIONAL))
+        thread.start()
+        release()
+        thread.join()
+        self.assertTrue(self.barrier.isSet())
+        self.assertEquals(sorted([(alias, prefix)
+                                  for alias, fetcher, prefix
+                                  in self.fetches]),
+                          [("a", "a%%"), ("b", "b%%"), ("c", "c%%")])
+        fetchers = [fetcher for alias, fetcher, prefix in self.fetches]
+        self.assertEquals(len(set(fetchers)), 3)
+        self.assertFalse(ctrl.getFetcher() in fetchers)
+
+    def test_failed_channel(self):
+        self.barrier.set()
+        sysconf.set("update-jobs", 2, soft=True)
+        channels = self.build_channels("a", "broken")
+        self.assertFalse(ctrl.reloadChannels(channels, OPTIONAL))
+        self.assertEquals(len(self.fetches), 2)
+
+    def test_removable_channels_are_fetched_serially(self):
+        self.barrier.set()
+        sysconf.set("update-jobs", 2, soft=True)
+        channels = self.build_channels("a", "b", removable=True)
+        ctrl.reloadChannels(channels, OPTIONAL)
+        self.assertEquals([(alias, fetcher) for alias, fetcher, prefix
+                           in self.fetches],
+                          [("a", ctrl.getFetcher()),
+                           ("b", ctrl.getFetcher())])
+
+    def test_workers_report_in_calling_thread(self):
+        self.barrier.set()
+        threads = []
+        interface = iface.object
+        def debug(msg):
+            threads.append(threading.currentThread())
+        interface.debug = debug
+        self.addCleanup(delattr, interface, "debug")
+        sysconf.set("update-jobs", 2, soft=True)
+        channels = [ReportChannel(alias, self.fetches, self.barrier)
+                    for alias in ("a", "b")]
+        ctrl.reloadChannels(channels, OPTIONAL)
+        self.assertEquals(len(self.fetches), 2)
+        self.assertEquals(threads, [threading.currentThread()]*2)
+        self.assertTrue(iface.object is interface)
+
+    def test_workers_report_item_progress_in_calling_thread(self):
+        self.barrier.set()
+        threads = []
+        progress = Progress()
+        def setSub(subkey, current, total, fragment=1, data=None):
+            threads.append(threading.currentThread())
+        progress.setSub = setSub
+        interface = iface.object
+        interface.getSubProgress = lambda obj: progress
+        self.addCleanup(delattr, interface, "getSubProgress")
+        sysconf.set("update-jobs", 2, soft=True)
+        channels = [ItemChannel(alias, self.fetches, self.barrier)
+                    for alias in ("a", "b")]
+        ctrl.reloadChannels(channels, OPTIONAL)
+        self.assertEquals(len(self.fetches), 2)
+        self.assertEquals(threads, [threading.currentThread()]*2)
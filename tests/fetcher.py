@@ -4,12 +4,17 @@ import unittest
 import socket
 import signal
 import time
+import gzip
+import md5
 import os
 
 from smart.progress import Progress
 from smart.interface import Interface
-from smart.fetcher import Fetcher
-from smart.const import VERSION, SUCCEEDED, FAILED
+from smart.fetcher import Fetcher, DigestCache, HostScheduler, RateLimiter
+from smart.util.cachefile import loadCacheFile
+from smart.uncompress import GZipHandler
+from smart.mirror import MirrorSystem
+from smart.const import VERSION, SUCCEEDED, FAILED, NEVER
 from smart import fetcher, sysconf, iface
 
 from tests.mocker import MockerTestCase
@@ -35,6 +40,10 @@ class FetcherTest(MockerTestCase):
         self.fetcher = Fetcher()
         self.fetcher.setLocalPathPrefix(self.local_path + "/")
 
+        # Some tests enable pycurl, which replaces the handlers of
+        # every scheme it knows about.
+        self.addCleanup(Fetcher._registry.update, Fetcher._registry.copy())
+
         # Smart changes SIGPIPE handling due to a problem which otherwise
         # happens when running external scripts.  Check out smart/__init__.py.
         # We want the normal handling here because in some cases we may
@@ -45,7 +54,7 @@ class FetcherTest(MockerTestCase):
         # See above.
         signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-    def start_server(self, handler, hide_errors=False):
+    def start_server(self, handler, hide_errors=False, requests=1):
         startup_lock = threading.Lock()
         startup_lock.acquire()
         def server():
@@ -64,7 +73,8 @@ class FetcherTest(MockerTestCase):
                     time.sleep(1)
             startup_lock.release()
             httpd.hide_errors = hide_errors
-            httpd.handle_request()
+            for i in range(requests):
+                httpd.handle_request()
 
         self.server_thread = threading.Thread(target=server)
         self.server_thread.start()
@@ -158,6 +168,7 @@ class FetcherTest(MockerTestCase):
         rate_limit = 10
         
         sysconf.set("max-download-rate", rate_limit, soft=True)
+        self.addCleanup(sysconf.remove, "max-download-rate", soft=True)
 
         def handler(request):
             request.send_header("Content-Length", str(bytes))
@@ -172,3 +183,459 @@ class FetcherTest(MockerTestCase):
         
         self.assertTrue(elapsed_time >= bytes / rate_limit)
     
+
+    def test_copies_finish_without_polling(self):
+        source_dir = self.makeDir()
+        urls = []
+        for i in range(20):
+            urls.append(self.makeFile("data", dirname=source_dir,
+                                      basename="file%d.pkg" % i))
+        self.fetcher.setForceCopy(True)
+        for url in urls:
+            self.fetcher.enqueue(url)
+        started = time.time()
+        self.fetcher.run(progress=Progress())
+        # The loop used to sleep 100ms between checks.
+        self.assertTrue(time.time()-started < 0.09)
+        for url in urls:
+            self.assertEquals(self.fetcher.getItem(url).getStatus(),
+                              SUCCEEDED)
+
+    def test_run_closes_wakeup_pipe(self):
+        url = self.makeFile("data")
+        self.fetcher.setForceCopy(True)
+        self.fetcher.enqueue(url)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(self.fetcher._wakeup, None)
+        self.assertFalse(hasattr(fetcher.Fetcher, "__del__"))
+        # Waking up a fetcher which isn't running is harmless.
+        self.fetcher.wakeUp()
+
+    def test_cancel_wakes_up_loop(self):
+        def handler(request):
+            self.fetcher.cancel()
+            time.sleep(0.5)
+        self.start_server(handler, hide_errors=True)
+        self.fetcher.enqueue(URL)
+        self.assertRaises(fetcher.FetcherCancelled,
+                          self.fetcher.run, progress=Progress())
+
+    def test_keep_alive(self):
+        connections = []
+        def handler(request):
+            connections.append(request.client_address)
+            request.protocol_version = "HTTP/1.1"
+            request.close_connection = False
+            request.send_response(200)
+            request.send_header("Content-Length", "5")
+            request.end_headers()
+            request.wfile.write("data\n")
+        self.start_server(handler)
+        # The test server handles a single connection, so both
+        # files must come through it.
+        sysconf.set("max-active-downloads", 1, soft=True)
+        try:
+            self.fetcher.enqueue(URL)
+            self.fetcher.enqueue(URL+"2")
+            self.fetcher.run(progress=Progress())
+        finally:
+            sysconf.remove("max-active-downloads", soft=True)
+        self.assertEquals(len(connections), 2)
+        self.assertEquals(connections[0], connections[1])
+        for url in (URL, URL+"2"):
+            self.assertEquals(self.fetcher.getItem(url).getStatus(),
+                              SUCCEEDED)
+
+    def send_range(self, request, data, ranges):
+        range = request.headers.get("Range")
+        if not range:
+            request.send_response(200)
+            request.send_header("Content-Length", str(len(data)))
+            request.end_headers()
+            request.wfile.write(data)
+            return
+        start, end = range.split("=")[1].split("-")
+        start = int(start)
+        end = int(end or len(data)-1)
+        ranges.append((start, end))
+        request.send_response(206)
+        request.send_header("Content-Range", "bytes %d-%d/%d" %
+                                             (start, end, len(data)))
+        request.send_header("Content-Length", str(end-start+1))
+        request.end_headers()
+        request.wfile.write(data[start:end+1])
+
+    def test_resume_after_connection_closed(self):
+        data = "0123456789"
+        def handler(request):
+            request.send_response(200)
+            request.send_header("Content-Length", str(len(data)))
+            request.end_headers()
+            request.wfile.write(data[:4])
+        self.start_server(handler)
+        self.fetcher.enqueue(URL)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(self.fetcher.getItem(URL).getStatus(), FAILED)
+        self.wait_for_server()
+        ranges = []
+        self.start_server(lambda request:
+                          self.send_range(request, data, ranges))
+        self.fetcher.reset()
+        self.fetcher.enqueue(URL)
+        self.fetcher.run(progress=Progress())
+        item = self.fetcher.getItem(URL)
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(ranges, [(4, 9)])
+        self.assertEquals(open(item.getTargetPath()).read(), data)
+
+    def test_segmented_download(self):
+        data = "".join([chr(i) for i in range(256)])*4
+        ranges = []
+        self.start_server(lambda request:
+                          self.send_range(request, data, ranges),
+                          requests=4)
+        sysconf.set("download-segments", 4, soft=True)
+        sysconf.set("download-segment-size", 100, soft=True)
+        try:
+            self.fetcher.enqueue(URL, size=len(data))
+            self.fetcher.run(progress=Progress())
+        finally:
+            sysconf.remove("download-segments", soft=True)
+            sysconf.remove("download-segment-size", soft=True)
+        item = self.fetcher.getItem(URL)
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(sorted(ranges), [(0, 255), (256, 511),
+                                           (512, 767), (768, 1023)])
+        self.assertEquals(open(item.getTargetPath()).read(), data)
+        self.assertEquals(sorted(os.listdir(self.local_path)),
+                          ["filename.pkg"])
+
+    def test_segmented_download_resumes_parts(self):
+        data = "0123456789"*10
+        local_path = os.path.join(self.local_path, "filename.pkg")
+        open(local_path+".part.0", "w").write(data[:30])
+        open(local_path+".part.50", "w").write(data[50:])
+        ranges = []
+        self.start_server(lambda request:
+                          self.send_range(request, data, ranges))
+        sysconf.set("download-segments", 2, soft=True)
+        sysconf.set("download-segment-size", 10, soft=True)
+        try:
+            self.fetcher.enqueue(URL, size=len(data))
+            self.fetcher.run(progress=Progress())
+        finally:
+            sysconf.remove("download-segments", soft=True)
+            sysconf.remove("download-segment-size", soft=True)
+        item = self.fetcher.getItem(URL)
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(ranges, [(30, 49)])
+        self.assertEquals(open(item.getTargetPath()).read(), data)
+
+    def test_segmented_download_without_range_support(self):
+        data = "0123456789"*10
+        requests = []
+        def handler(request):
+            requests.append(request.headers.get("Range"))
+            request.send_response(200)
+            request.send_header("Content-Length", str(len(data)))
+            request.end_headers()
+            request.wfile.write(data)
+        self.start_server(handler, requests=2)
+        sysconf.set("download-segments", 4, soft=True)
+        sysconf.set("download-segment-size", 10, soft=True)
+        try:
+            self.fetcher.enqueue(URL, size=len(data))
+            self.fetcher.run(progress=Progress())
+        finally:
+            sysconf.remove("download-segments", soft=True)
+            sysconf.remove("download-segment-size", soft=True)
+        item = self.fetcher.getItem(URL)
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(requests, ["bytes=0-24", None])
+        self.assertEquals(open(item.getTargetPath()).read(), data)
+
+    def test_download_caches_digests(self):
+        data = "0123456789"
+        def handler(request):
+            request.send_response(200)
+            request.send_header("Content-Length", str(len(data)))
+            request.end_headers()
+            request.wfile.write(data)
+        self.start_server(handler)
+        self.fetcher.enqueue(URL, md5=md5.new(data).hexdigest())
+        self.fetcher.run(progress=Progress())
+        item = self.fetcher.getItem(URL)
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(
+            self.fetcher.getDigestCache().get(item.getTargetPath()),
+            {"md5": md5.new(data).hexdigest()})
+
+    def test_validate_uses_digest_cache(self):
+        path = self.makeFile("data")
+        item = self.fetcher.enqueue(URL, md5=md5.new("data").hexdigest())
+        self.assertTrue(self.fetcher.validate(item, path))
+        digestcache = self.fetcher.getDigestCache()
+        self.assertEquals(digestcache.get(path),
+                          {"md5": md5.new("data").hexdigest()})
+        # The file isn't read again while it looks the same.
+        digestcache.set(path, {"md5": "bogus"})
+        self.assertFalse(self.fetcher.validate(item, path))
+        os.utime(path, (0, 0))
+        self.assertTrue(self.fetcher.validate(item, path))
+
+    def test_digest_cache_is_saved(self):
+        path = self.makeFile("data")
+        gone = self.makeFile("gone")
+        cachepath = self.makeFile()
+        digestcache = DigestCache(cachepath)
+        digestcache.set(path, {"md5": "digest"})
+        digestcache.set(gone, {"md5": "digest"})
+        os.unlink(gone)
+        digestcache.save()
+        self.assertEquals(
+            loadCacheFile(cachepath, fetcher.DIGESTCACHEVERSION).keys(),
+            [path])
+        self.assertEquals(DigestCache(cachepath).get(path), {"md5": "digest"})
+        os.utime(path, (0, 0))
+        self.assertEquals(DigestCache(cachepath).get(path), {})
+
+    def make_gzip(self, data, path):
+        file = gzip.GzipFile(path, "w")
+        file.write(data)
+        file.close()
+        return open(path).read()
+
+    def test_uncompress_while_downloading(self):
+        data = "0123456789"*1000
+        compressed = self.make_gzip(data, self.makeFile())
+        def handler(request):
+            request.send_response(200)
+            request.send_header("Content-Length", str(len(compressed)))
+            request.end_headers()
+            request.wfile.write(compressed)
+        self.start_server(handler)
+        def uncompress(self, localpath):
+            raise AssertionError("Uncompressed after downloading")
+        original = GZipHandler.uncompress
+        GZipHandler.uncompress = uncompress
+        self.addCleanup(setattr, GZipHandler, "uncompress", original)
+        url = URL+".gz"
+        self.fetcher.enqueue(url, uncomp=True,
+                             uncomp_md5=md5.new(data).hexdigest())
+        self.fetcher.run(progress=Progress())
+        item = self.fetcher.getItem(url)
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(item.getTargetPath(),
+                          os.path.join(self.local_path, "filename.pkg"))
+        self.assertEquals(open(item.getTargetPath()).read(), data)
+        self.assertEquals(open(item.getTargetPath()+".gz").read(),
+                          compressed)
+
+    def test_uncompress_in_worker_processes(self):
+        source_dir = self.makeDir()
+        urls = []
+        for i in range(3):
+            path = os.path.join(source_dir, "file%d.gz" % i)
+            self.make_gzip("data%d" % i, path)
+            urls.append(path)
+        sysconf.set("uncompress-jobs", 2, soft=True)
+        self.addCleanup(sysconf.remove, "uncompress-jobs", soft=True)
+        self.fetcher.setForceCopy(True)
+        for url in urls:
+            self.fetcher.enqueue(url, uncomp=True)
+        self.fetcher.run(progress=Progress())
+        for i, url in enumerate(urls):
+            item = self.fetcher.getItem(url)
+            self.assertEquals(item.getStatus(), SUCCEEDED)
+            self.assertEquals(open(item.getTargetPath()).read(), "data%d" % i)
+
+    def test_uncompress_pool_is_opt_in(self):
+        source_dir = self.makeDir()
+        for i in range(3):
+            path = os.path.join(source_dir, "file%d.gz" % i)
+            self.make_gzip("data%d" % i, path)
+            self.fetcher.enqueue(path, uncomp=True)
+        self.assertEquals(self.fetcher._startUncompressPool(), None)
+        self.fetcher.startUncompressPool()
+        self.assertEquals(self.fetcher._uncompresspool, None)
+
+    def test_uncompress_pool_shared_by_copies(self):
+        source_dir = self.makeDir()
+        sysconf.set("uncompress-jobs", 2, soft=True)
+        self.addCleanup(sysconf.remove, "uncompress-jobs", soft=True)
+        self.fetcher.startUncompressPool()
+        pool = self.fetcher._uncompresspool
+        self.assertTrue(pool)
+        fetchers = []
+        for i in range(2):
+            fetcher = self.fetcher.copy()
+            self.assertTrue(fetcher._uncompresspool is pool)
+            fetcher.setForceCopy(True)
+            path = os.path.join(source_dir, "file%d.gz" % i)
+            self.make_gzip("data%d" % i, path)
+            fetcher.enqueue(path, uncomp=True)
+            fetchers.append((fetcher, path))
+        threads = []
+        for fetcher, path in fetchers:
+            thread = threading.Thread(target=fetcher.run,
+                                      kwargs={"progress": Progress()})
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        for i, (fetcher, path) in enumerate(fetchers):
+            item = fetcher.getItem(path)
+            self.assertEquals(item.getStatus(), SUCCEEDED)
+            self.assertEquals(open(item.getTargetPath()).read(), "data%d" % i)
+        self.fetcher.stopUncompressPool()
+        self.assertEquals(self.fetcher._uncompresspool, None)
+
+    def test_conditional_request(self):
+        lastmodified = "Sat, 01 Jan 2011 00:00:00 GMT"
+        def handler(request):
+            request.send_response(200)
+            request.send_header("ETag", '"abc"')
+            request.send_header("Last-Modified", lastmodified)
+            request.send_header("Content-Length", "4")
+            request.end_headers()
+            request.wfile.write("data")
+        self.start_server(handler)
+        self.fetcher.enqueue(URL)
+        self.fetcher.run(progress=Progress())
+        self.wait_for_server()
+        path = self.fetcher.getItem(URL).getTargetPath()
+        self.assertEquals(self.fetcher.getDigestCache().get(path),
+                          {"etag": '"abc"', "last-modified": lastmodified})
+        headers = {}
+        def handler(request):
+            headers.update(request.headers)
+            request.send_response(304)
+            request.end_headers()
+        self.start_server(handler)
+        self.fetcher.reset()
+        self.fetcher.setCaching(NEVER)
+        self.fetcher.enqueue(URL)
+        self.fetcher.run(progress=Progress())
+        item = self.fetcher.getItem(URL)
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(item.getTargetPath(), path)
+        self.assertEquals(headers.get("if-none-match"), '"abc"')
+        self.assertEquals(headers.get("if-modified-since"), lastmodified)
+        self.assertEquals(open(path).read(), "data")
+
+    def test_items_by_size(self):
+        paths = []
+        def handler(request):
+            paths.append(request.path)
+            request.protocol_version = "HTTP/1.1"
+            request.close_connection = False
+            request.send_response(200)
+            request.send_header("Content-Length", request.path[-1])
+            request.end_headers()
+            request.wfile.write("x"*int(request.path[-1]))
+        self.start_server(handler)
+        sysconf.set("max-host-connections", 1, soft=True)
+        self.addCleanup(sysconf.remove, "max-host-connections", soft=True)
+        self.fetcher.enqueue(URL+"3", size=3)
+        self.fetcher.enqueue(URL+"1", size=1)
+        self.fetcher.enqueue(URL+"5", size=5)
+        self.fetcher.enqueue(URL+"2", size=2)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(paths, ["/filename.pkg1", "/filename.pkg2",
+                                  "/filename.pkg3", "/filename.pkg5"])
+
+    def test_copies_by_size(self):
+        source_dir = self.makeDir()
+        started = []
+        start = fetcher.FetchItem.__dict__["start"]
+        def record(item):
+            started.append(os.path.basename(item.getOriginalURL()))
+            start(item)
+        fetcher.FetchItem.start = record
+        self.addCleanup(setattr, fetcher.FetchItem, "start", start)
+        self.fetcher.setForceCopy(True)
+        for size in (3, 1, 2):
+            path = self.makeFile("x"*size, dirname=source_dir,
+                                 basename="file%d.pkg" % size)
+            self.fetcher.enqueue(path, size=size)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(started, ["file1.pkg", "file2.pkg", "file3.pkg"])
+
+
+class HostSchedulerTest(unittest.TestCase):
+
+    def test_start(self):
+        scheduler = HostScheduler(maximum=5)
+        self.assertEquals(scheduler.getLimit("host"), 2)
+        self.assertTrue(scheduler.start("host"))
+        self.assertTrue(scheduler.start("host"))
+        self.assertFalse(scheduler.start("host"))
+        self.assertTrue(scheduler.start("otherhost"))
+        scheduler.finish("host")
+        self.assertEquals(scheduler.getActive("host"), 1)
+        self.assertTrue(scheduler.start("host"))
+
+    def test_grow_while_faster(self):
+        scheduler = HostScheduler(maximum=3)
+        for i in range(3):
+            limit = scheduler.getLimit("host")
+            for j in range(limit):
+                self.assertTrue(scheduler.start("host"))
+            time.sleep(0.01)
+            for j in range(limit):
+                scheduler.finish("host", 1000)
+        # The first round always grows, and then it stays at the
+        # maximum.
+        self.assertEquals(scheduler.getLimit("host"), 3)
+
+    def test_halve_on_failure(self):
+        scheduler = HostScheduler(maximum=8)
+        scheduler.start("host")
+        scheduler.finish("host", failed=True)
+        self.assertEquals(scheduler.getLimit("host"), 1)
+        scheduler.start("host")
+        scheduler.finish("host", failed=True)
+        self.assertEquals(scheduler.getLimit("host"), 1)
+
+    def test_fewer_after_failures_in_history(self):
+        mirrorsystem = MirrorSystem()
+        mirrorsystem.setHistory([("http://host/", {"failed": 1}),
+                                 ("http://host:8080/a/", {"failed": 1}),
+                                 ("http://otherhost/", {"size": 10}),
+                                 ("http://otherhost/", {"failed": 1}),
+                                 ("http://host/", {"size": 10})])
+        scheduler = HostScheduler(maximum=8, mirrorsystem=mirrorsystem)
+        self.assertEquals(scheduler.getLimit("host"), 1)
+        # Failures before the host transferred something don't count.
+        self.assertEquals(scheduler.getLimit("otherhost"), 2)
+        self.assertEquals(scheduler.getLimit("newhost"), 2)
+
+    def test_set_maximum(self):
+        scheduler = HostScheduler()
+        scheduler.setMaximum(1)
+        self.assertEquals(scheduler.getLimit("host"), 1)
+        scheduler.setMaximum(0)
+        self.assertEquals(scheduler.getMaximum(), 1)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_shared_rate(self):
+        limiter = RateLimiter(100)
+        def consume():
+            for i in range(5):
+                limiter.consume(10)
+        threads = [threading.Thread(target=consume) for i in range(2)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 100 bytes, at 100 bytes per second.
+        self.assertTrue(time.time()-start >= 0.95)
+
+    def test_no_rate(self):
+        limiter = RateLimiter()
+        start = time.time()
+        limiter.consume(1000000)
+        self.assertTrue(time.time()-start < 0.1)
@@ -0,0 +1,121 @@
+from tests.mocker import MockerTestCase, ANY
+
+from smart.cache import Cache, Loader, Package, Provides, Requires
+from smart.loadpool import WorkerInterface
+from smart.const import WARNING
+from smart import iface, sysconf
+
+
+class NameLoader(Loader):
+
+    _loadattrs = ("_bynames",)
+
+    def __init__(self, names, warning=None):
+        Loader.__init__(self)
+        self._names = names
+        self._warning = warning
+        self._bynames = {}
+
+    def getLoadSteps(self):
+        return len(self._names)
+
+    def load(self):
+        prog = iface.getProgress(self._cache)
+        if self._warning:
+            iface.warning(self._warning)
+        for name in self._names:
+            pkg = self.buildPackage((Package, name, "1.0"),
+                                    [(Provides, name, "1.0")],
+                                    [(Requires, "lib"+name, None, None)],
+                                    [], [])
+            pkg.loaders[self] = {"name": name}
+            self._bynames[name] = pkg
+            prog.add(1)
+
+
+class SerialLoader(NameLoader):
+
+    _loadattrs = None
+
+
+class StrayLoader(NameLoader):
+
+    def load(self):
+        NameLoader.load(self)
+        # Packages not built by the loader can't be sent back.
+        self._bynames["stray"] = Package("stray", "1.0")
+
+
+class LoadPoolTest(MockerTestCase):
+
+    def setUp(self):
+        self.old_iface = iface.object
+        iface.object = WorkerInterface()
+
+    def tearDown(self):
+        iface.object = self.old_iface
+
+    def load(self, loaders, jobs):
+        sysconf.set("load-jobs", jobs, soft=True)
+        try:
+            cache = Cache()
+            for loader in loaders:
+                cache.addLoader(loader)
+            cache.load()
+            return cache
+        finally:
+            sysconf.remove("load-jobs", soft=True)
+
+    def get_state(self, cache):
+        state = []
+        for loader in cache._loaders:
+            state.append([(str(pkg), pkg.loaders[loader],
+                           [str(prv) for prv in pkg.provides],
+                           [str(req) for req in pkg.requires])
+                          for pkg in loader.getPackages()])
+        state.append(sorted([str(pkg) for pkg in cache.getPackages()]))
+        state.append(sorted([str(prv) for prv in cache.getProvides()]))
+        return state
+
+    def make_loaders(self):
+        return [NameLoader(["a", "b"]), SerialLoader(["c"]),
+                NameLoader(["b", "d"], "careful")]
+
+    def test_same_as_serial(self):
+        serial = self.load(self.make_loaders(), 1)
+        parallel = self.load(self.make_loaders(), 2)
+        self.assertEquals(self.get_state(parallel), self.get_state(serial))
+        a, b, c = parallel._loaders
+        # Packages are shared between loaders, and linked as usual.
+        self.assertTrue(a.getPackages()[1] is c.getPackages()[0])
+        [prv] = parallel.getProvides("b")
+        self.assertEquals(len(prv.packages), 1)
+
+    def test_attributes_refer_to_built_packages(self):
+        cache = self.load(self.make_loaders(), 2)
+        for loader in cache._loaders:
+            for pkg in loader.getPackages():
+                self.assertTrue(loader._bynames[pkg.name] is pkg)
+
+    def test_messages(self):
+        self.load(self.make_loaders(), 2)
+        self.assertEquals(iface.getMessages(), [(WARNING, "careful")])
+
+    def test_falls_back_to_serial(self):
+        cache = self.load([StrayLoader(["a"]), StrayLoader(["b"])], 2)
+        for loader in cache._loaders:
+            self.assertEquals(sorted(loader._bynames), [loader._names[0],
+                                                         "stray"])
+            self.assertTrue(loader._bynames[loader._names[0]]
+                            is loader.getPackages()[0])
+
+    def test_serial_by_default(self):
+        pool = self.mocker.replace("multiprocessing.Pool")
+        pool(ANY)
+        self.mocker.count(0)
+        self.mocker.replay()
+        cache = Cache()
+        for loader in self.make_loaders():
+            cache.addLoader(loader)
+        cache.load()
+        self.assertEquals(len(cache.getPackages()), 4)
@@ -0,0 +1,100 @@
+import socket
+import time
+
+from tests.mocker import MockerTestCase
+
+from smart.mirror import MirrorSystem, HISTORYHALFLIFE
+
+
+ORIGIN = "http://origin.tld/path/"
+URL = ORIGIN+"file.pkg"
+
+
+class MirrorSystemTest(MockerTestCase):
+
+    def setUp(self):
+        self.system = MirrorSystem()
+
+    def get_order(self, url=URL):
+        item = self.system.get(url)
+        urls = []
+        url = item.getNext()
+        while url:
+            urls.append(url)
+            url = item.getNext()
+        return urls
+
+    def test_info_is_dated(self):
+        self.system.setMirrors({ORIGIN: ["http://a.tld/"]})
+        self.system.addInfo("http://a.tld/", failed=1)
+        [(mirror, info)] = self.system.getHistory()
+        self.assertTrue(abs(info["date"]-time.time()) < 5)
+
+    def test_old_info_counts_less(self):
+        self.system.setMirrors({ORIGIN: ["http://a.tld/"]})
+        now = time.time()
+        # The origin was slow long ago, and a.tld is a bit slow now.
+        self.system.setHistory([
+            (ORIGIN, {"time": 100, "size": 1000000,
+                      "date": now-10*HISTORYHALFLIFE}),
+            ("http://a.tld/", {"time": 10, "size": 1000000}),
+            (ORIGIN, {"time": 1, "size": 1000000, "date": now}),
+            ])
+        self.assertEquals(self.get_order(),
+                          [URL, "http://a.tld/file.pkg"])
+
+    def test_probed_mirrors_are_ranked(self):
+        self.system.setMirrors({ORIGIN: ["http://a.tld/", "http://b.tld/"]})
+        self.system.setHistory([
+            (ORIGIN, {"time": 1, "size": 1000000}),
+            ("http://a.tld/", {"latency": 0.5}),
+            ("http://b.tld/", {"latency": 0.01}),
+            ])
+        # Mirrors only probed are expected to transfer as fast as
+        # the others once connected.
+        self.assertEquals(self.get_order(),
+                          [URL, "http://b.tld/file.pkg",
+                           "http://a.tld/file.pkg"])
+
+    def test_preferences(self):
+        self.system.setMirrors({ORIGIN: ["http://a.tld", "http://b.tld"]})
+        self.system.setPreferences({"http://a.tld": 10, "http://b.tld": 90,
+                                    ORIGIN: 50})
+        self.assertEquals(self.get_order(),
+                          ["http://b.tld/file.pkg", URL,
+                           "http://a.tld/file.pkg"])
+        # Anything known is still worth more than preferences.
+        self.system.addInfo("http://b.tld/", failed=1)
+        self.assertEquals(self.get_order()[-1], "http://b.tld/file.pkg")
+
+    def test_probe(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(5)
+        self.addCleanup(server.close)
+        port = server.getsockname()[1]
+        # Nothing should be listening on the port just freed.
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        closedport = closed.getsockname()[1]
+        closed.close()
+        reachable = "http://127.0.0.1:%d/" % port
+        unreachable = "http://127.0.0.1:%d/" % closedport
+        self.system.setMirrors({ORIGIN: [reachable, unreachable,
+                                         "file:///mirror/"]})
+        self.system.probe([URL], timeout=1)
+        history = dict(self.system.getHistory())
+        # The origin name can't be resolved here, and file mirrors
+        # aren't probed at all.
+        self.assertEquals(sorted(history), sorted([ORIGIN, reachable,
+                                                   unreachable]))
+        self.assertTrue(history[reachable]["latency"] < 1)
+        self.assertEquals(history[unreachable].get("failed"), 1)
+        # Mirrors measured lately aren't probed again.
+        self.system.probe([URL], timeout=1)
+        self.assertEquals(len(self.system.getHistory()), 3)
+        self.system.getHistory()[:] = [(mirror, info) for mirror, info
+                                       in self.system.getHistory()
+                                       if mirror != unreachable]
+        self.system.probe([URL], timeout=1)
+        self.assertEquals(len(self.system.getHistory()), 3)
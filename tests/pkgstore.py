@@ -0,0 +1,126 @@
+import errno
+import os
+
+from tests.mocker import MockerTestCase, ANY
+
+from smart.util.pathlocks import PathLocks
+from smart.pkgstore import PackageStore, putFile
+
+
+class Info(object):
+
+    def __init__(self, **digests):
+        self._digests = digests
+
+    def getSHA256(self, url):
+        return self._digests.get("sha256")
+
+    def getSHA(self, url):
+        return self._digests.get("sha")
+
+    def getMD5(self, url):
+        return self._digests.get("md5")
+
+
+class PackageStoreTest(MockerTestCase):
+
+    def setUp(self):
+        self.path = self.makeDir()
+        self.store = PackageStore(self.path)
+
+    def test_get_key(self):
+        self.assertEquals(self.store.getKey(Info(md5="AB", sha="cd"), "url"),
+                          ("sha", "cd"))
+        self.assertEquals(self.store.getKey(Info(md5="ab", sha256="ef"),
+                                            "url"),
+                          ("sha256", "ef"))
+        self.assertEquals(self.store.getKey(Info(), "url"), None)
+
+    def test_add_and_get(self):
+        path = self.makeFile("data")
+        key = ("md5", "8d777f385d3dfec8815d20f7496026dc")
+        self.assertFalse(self.store.has(key))
+        self.store.add(key, path)
+        self.assertTrue(self.store.has(key))
+        self.assertEquals(self.store.getStorePath(key),
+                          os.path.join(self.path, "md5", "8d", key[1]))
+        target = os.path.join(self.makeDir(), "file.pkg")
+        self.assertTrue(self.store.get(key, target))
+        self.assertEquals(open(target).read(), "data")
+        self.assertTrue(os.path.samefile(target, path))
+
+    def test_get_missing(self):
+        target = os.path.join(self.makeDir(), "file.pkg")
+        self.assertFalse(self.store.get(("md5", "00"), target))
+        self.assertFalse(os.path.exists(target))
+
+    def test_add_replaces(self):
+        key = ("md5", "00")
+        self.store.add(key, self.makeFile("bad"))
+        self.store.add(key, self.makeFile("good"))
+        self.assertEquals(open(self.store.getStorePath(key)).read(), "good")
+        self.assertEquals(os.listdir(os.path.dirname(
+                              self.store.getStorePath(key))), ["00"])
+
+    def test_put_file_on_itself(self):
+        path = self.makeFile("data", dirname=self.makeDir())
+        putFile(path, path)
+        self.assertEquals(open(path).read(), "data")
+        self.assertEquals(len(os.listdir(os.path.dirname(path))), 1)
+
+    def test_put_file_skips_taken_names(self):
+        path = self.makeFile("data")
+        dirname = self.makeDir()
+        target = os.path.join(dirname, "file.pkg")
+        # Another host is putting the same file.
+        taken = self.makeFile("other", dirname=dirname,
+                              basename="file.pkg.new.00000000")
+        getrandbits = self.mocker.replace("random.getrandbits")
+        getrandbits(32)
+        self.mocker.result(0)
+        getrandbits(32)
+        self.mocker.result(1)
+        self.mocker.replay()
+        putFile(path, target)
+        self.assertEquals(open(target).read(), "data")
+        self.assertEquals(open(taken).read(), "other")
+        self.assertEquals(sorted(os.listdir(dirname)),
+                          ["file.pkg", "file.pkg.new.00000000"])
+
+    def test_put_file_copies_without_links(self):
+        path = self.makeFile("data")
+        dirname = self.makeDir()
+        target = os.path.join(dirname, "file.pkg")
+        link = self.mocker.replace("os.link")
+        link(path, ANY)
+        self.mocker.throw(OSError(errno.EXDEV, "Cross-device link"))
+        self.mocker.replay()
+        putFile(path, target)
+        self.assertEquals(open(target).read(), "data")
+        self.assertFalse(os.path.samefile(target, path))
+        self.assertEquals(os.listdir(dirname), ["file.pkg"])
+
+    def test_evict_least_recently_used(self):
+        for i, name in enumerate(["aa", "bb", "cc"]):
+            self.store.add(("md5", name), self.makeFile("x"*10))
+            path = self.store.getStorePath(("md5", name))
+            os.utime(path, (1000+i, 1000))
+        # Getting a file makes it the most recently used.
+        self.store.get(("md5", "aa"), os.path.join(self.makeDir(), "a"))
+        self.assertEquals(self.store.getSize(), 30)
+        self.assertEquals(self.store.evict(15), 2)
+        self.assertTrue(self.store.has(("md5", "aa")))
+        self.assertFalse(self.store.has(("md5", "bb")))
+        self.assertFalse(self.store.has(("md5", "cc")))
+        self.assertEquals(self.store.evict(), 1)
+        self.assertEquals(self.store.getSize(), 0)
+
+    def test_evict_waits_for_other_processes(self):
+        self.store.add(("md5", "aa"), self.makeFile("data"))
+        locks = PathLocks(False)
+        self.assertTrue(locks.lock(self.path))
+        self.addCleanup(locks.unlockAll)
+        self.assertEquals(self.store.evict(), 0)
+        self.assertTrue(self.store.has(("md5", "aa")))
+        locks.unlock(self.path)
+        self.assertEquals(self.store.evict(), 1)
@@ -0,0 +1,360 @@
+import cPickle
+import os
+
+from tests.mocker import MockerTestCase
+
+from smart.cache import Cache, Loader, Package, PackageInfo, Provides
+from smart.channel import PackageChannel
+from smart.searchindex import SearchIndex, buildSearchIndex
+from smart.searchindex import getSearchIndex, getCandidates
+from smart.searchindex import buildNameIndex, getNameIndex, getIndexPath
+from smart.searchindex import getPackageCandidates, getProvidesCandidates
+from smart.searcher import Searcher
+from smart import sysconf
+
+
+class Info(PackageInfo):
+
+    def __init__(self, package, data):
+        PackageInfo.__init__(self, package)
+        self._data = data
+
+    def getGroup(self):
+        return self._data[0]
+
+    def getSummary(self):
+        return self._data[1]
+
+    def getDescription(self):
+        return self._data[2]
+
+    def getPathList(self):
+        return self._data[3]
+
+
+class InfoLoader(Loader):
+
+    def __init__(self, data):
+        Loader.__init__(self)
+        self._data = data
+        self.infos = 0
+
+    def getLoadSteps(self):
+        return 1
+
+    def load(self):
+        for name in sorted(self._data):
+            pkg = self.buildPackage((Package, name, "1.0"), [], [], [], [])
+            pkg.loaders[self] = name
+
+    def getInfo(self, pkg):
+        self.infos += 1
+        return Info(pkg, self._data[pkg.loaders[self]])
+
+    def search(self, searcher):
+        self.searched = True
+        Loader.search(self, searcher)
+
+
+DATA = {"vim": ("Applications/Editors", "Text editor",
+                "Vi IMproved, a text-mode editor.",
+                ["/usr/bin/vim", "/usr/share/vim/vimrc"]),
+        "emacs": ("Applications/Editors", "GNU Emacs",
+                  "The extensible, self-documenting editor.",
+                  ["/usr/bin/emacs"]),
+        "bash": ("System/Shells", "The GNU Bourne Again shell",
+                 "Bash is a sh-compatible command interpreter.",
+                 ["/bin/bash", "/usr/share/doc/bash"]),
+        }
+
+
+class SearchIndexTest(MockerTestCase):
+
+    def setUp(self):
+        self.cache = Cache()
+        self.loader = InfoLoader(DATA)
+        self.cache.addLoader(self.loader)
+        self.cache.load()
+        self.index = SearchIndex(self.loader)
+        self.loader.infos = 0
+
+    def get_names(self, **kwargs):
+        packages = self.index.getPackages(**kwargs)
+        if packages is None:
+            return None
+        return sorted([pkg.name for pkg in packages])
+
+    def test_words(self):
+        self.assertEquals(self.get_names(summary=["gnu"]), ["bash", "emacs"])
+        self.assertEquals(self.get_names(summary=["text EDITOR"]), ["vim"])
+        self.assertEquals(self.get_names(group=["editors"]),
+                          ["emacs", "vim"])
+        self.assertEquals(self.get_names(description=["nothing"]), [])
+
+    def test_parts_of_words(self):
+        self.assertEquals(self.get_names(description=["edit"]),
+                          ["emacs", "vim"])
+        self.assertEquals(self.get_names(description=["self-doc*ing"]),
+                          ["emacs"])
+        self.assertEquals(self.get_names(summary=["g?u"]), ["bash", "emacs"])
+
+    def test_any_pattern(self):
+        self.assertEquals(self.get_names(summary=["shell"],
+                                         group=["editors"]),
+                          ["bash", "emacs", "vim"])
+
+    def test_unindexed_patterns(self):
+        self.assertEquals(self.get_names(summary=["*"]), None)
+        self.assertEquals(self.get_names(summary=["[gG]nu"]), None)
+        self.assertEquals(self.get_names(path=["*/vim"]), None)
+
+    def test_paths(self):
+        self.assertEquals(self.get_names(path=["/usr/bin/vim"]), ["vim"])
+        self.assertEquals(self.get_names(path=["/USR/bin/e*"]), ["emacs"])
+        self.assertEquals(self.get_names(path=["/usr/share/*"]),
+                          ["bash", "vim"])
+        self.assertEquals(self.get_names(path=["/usr/bin/v"]), [])
+        self.assertEquals(self.get_names(path=["/usr/local/*"]), [])
+
+    def test_validity(self):
+        self.assertEquals(getSearchIndex(self.loader), None)
+        buildSearchIndex(self.loader)
+        self.assertTrue(getSearchIndex(self.loader))
+        self.loader.reset()
+        self.assertEquals(getSearchIndex(self.loader), None)
+
+    def test_not_pickled_with_loader(self):
+        buildSearchIndex(self.loader)
+        cache = cPickle.loads(cPickle.dumps(self.cache, 2))
+        [loader] = cache._loaders
+        self.assertEquals(getSearchIndex(loader), None)
+
+    def test_saved_apart(self):
+        datadir = self.makeDir()
+        os.mkdir(os.path.join(datadir, "channels"))
+        sysconf.set("data-dir", datadir, soft=True)
+        self.addCleanup(sysconf.remove, "data-dir", soft=True)
+        channel = PackageChannel("test", "alias")
+        channel.getLoaders().append(self.loader)
+        self.loader.setChannel(channel)
+        self.assertEquals(getIndexPath(self.loader, "searchindex"),
+                          os.path.join(datadir, "channels",
+                                       "alias%%searchindex0"))
+        buildSearchIndex(self.loader)
+        self.assertTrue(os.path.isfile(getIndexPath(self.loader,
+                                                    "searchindex")))
+        cache = cPickle.loads(cPickle.dumps(self.cache, 2))
+        [loader] = cache._loaders
+        self.assertEquals(getSearchIndex(loader), None)
+        loader.infos = 0
+        index = getSearchIndex(loader, build=True)
+        self.assertEquals(loader.infos, 0)
+        self.assertEquals([pkg.name for pkg
+                           in index.getPackages(summary=["emacs"])],
+                          ["emacs"])
+        self.assertTrue(index.getPackages(summary=["emacs"])[0]
+                        in loader.getPackages())
+
+    def test_saved_index_of_other_packages(self):
+        datadir = self.makeDir()
+        os.mkdir(os.path.join(datadir, "channels"))
+        sysconf.set("data-dir", datadir, soft=True)
+        self.addCleanup(sysconf.remove, "data-dir", soft=True)
+        channel = PackageChannel("test", "alias")
+        channel.getLoaders().append(self.loader)
+        self.loader.setChannel(channel)
+        buildSearchIndex(self.loader)
+        loader = InfoLoader({"vim": DATA["vim"]})
+        loader.setChannel(channel)
+        channel.getLoaders()[:] = [loader]
+        cache = Cache()
+        cache.addLoader(loader)
+        cache.load()
+        index = getSearchIndex(loader, build=True)
+        self.assertEquals(loader.infos, 1)
+        self.assertEquals(index.getPackages(summary=["emacs"]), [])
+
+    def test_candidates(self):
+        sysconf.set("search-index", False, soft=True)
+        try:
+            self.assertEquals(getCandidates(self.cache, summary=["gnu"]),
+                              None)
+        finally:
+            sysconf.remove("search-index", soft=True)
+        self.assertEquals(getCandidates(self.cache, summary=["[gG]nu"]),
+                          None)
+        self.assertEquals(getSearchIndex(self.loader), None)
+        # The index is built the first time it's needed.
+        candidates = getCandidates(self.cache, summary=["gnu"],
+                                   path=["/bin/*"])
+        self.assertEquals(sorted([pkg.name for pkg in candidates]),
+                          ["bash", "emacs"])
+        self.assertTrue(getSearchIndex(self.loader))
+
+    def test_searcher(self):
+        buildSearchIndex(self.loader)
+        self.loader.infos = 0
+        searcher = Searcher()
+        searcher.addSummary("gnu*shell")
+        searcher.addPath("/bin/bash")
+        self.cache.search(searcher)
+        self.assertEquals([(ratio, pkg.name) for ratio, pkg
+                           in searcher.getResults()],
+                          [(1.0, "bash")])
+        # Only packages which may match have their information read.
+        self.assertEquals(self.loader.infos, 1)
+        self.assertFalse(hasattr(self.loader, "searched"))
+
+    def test_searcher_without_index(self):
+        sysconf.set("search-index", False, soft=True)
+        self.addCleanup(sysconf.remove, "search-index", soft=True)
+        searcher = Searcher()
+        searcher.addDescription("edit")
+        self.cache.search(searcher)
+        self.assertEquals(sorted([pkg.name for ratio, pkg
+                                  in searcher.getResults()]),
+                          ["emacs", "vim"])
+        self.assertTrue(self.loader.searched)
+        self.assertEquals(getSearchIndex(self.loader), None)
+
+    def test_searcher_builds_index(self):
+        searcher = Searcher()
+        searcher.addDescription("edit")
+        self.cache.search(searcher)
+        self.assertEquals(sorted([pkg.name for ratio, pkg
+                                  in searcher.getResults()]),
+                          ["emacs", "vim"])
+        self.assertFalse(hasattr(self.loader, "searched"))
+        self.assertTrue(getSearchIndex(self.loader))
+
+    def test_searcher_unindexed_patterns(self):
+        searcher = Searcher()
+        searcher.addDescription("*")
+        self.cache.search(searcher)
+        self.assertTrue(self.loader.searched)
+        self.assertEquals(getSearchIndex(self.loader), None)
+
+    def test_searcher_inexact_paths(self):
+        buildSearchIndex(self.loader)
+        searcher = Searcher()
+        searcher.addPath("/usr/bin/vin", 0.7)
+        self.cache.search(searcher)
+        self.assertEquals([pkg.name for ratio, pkg in searcher.getResults()],
+                          ["vim"])
+        self.assertTrue(self.loader.searched)
+
+
+NAMES = ["firefox", "firefox-esr", "thunderbird", "fire", "fox", "ab",
+         "abxd", "aaaa", "libfoo", "libfoo-devel", "foolib", "python",
+         "python-foo", "pythonx", "x"]
+
+
+class NameLoader(Loader):
+
+    def __init__(self, names):
+        Loader.__init__(self)
+        self._names = names
+
+    def getLoadSteps(self):
+        return 1
+
+    def load(self):
+        for name in self._names:
+            pkg = self.buildPackage((Package, name, "1.0-1"),
+                                    [(Provides, name, "1.0-1"),
+                                     (Provides, name.upper()+"(x)", None)],
+                                    [], [], [])
+            pkg.loaders[self] = name
+
+
+class NameIndexTest(MockerTestCase):
+
+    def setUp(self):
+        self.cache = Cache()
+        self.loader = NameLoader(NAMES)
+        self.cache.addLoader(self.loader)
+        self.cache.load()
+
+    def search(self, pattern, cutoff):
+        searcher = Searcher()
+        searcher.addNameVersion(pattern, cutoff)
+        searcher.addProvides(pattern, cutoff)
+        self.cache.search(searcher)
+        return sorted([(ratio, str(obj))
+                       for ratio, obj in searcher.getResults()])
+
+    def test_same_results(self):
+        patterns = ["firefx", "firefox", "fierfox-esr", "thunderbrid",
+                    "abcd", "aaa", "libfo", "fo", "foo-1.0", "pyth?n",
+                    "python-1.0-1", "FIREFOX(x)", "x", "y", "ffox"]
+        expected = {}
+        sysconf.set("search-index", False, soft=True)
+        try:
+            for pattern in patterns:
+                for cutoff in (1.0, 0.95, 0.7, 0.5, 2):
+                    expected[pattern, cutoff] = self.search(pattern, cutoff)
+        finally:
+            sysconf.remove("search-index", soft=True)
+        self.assertEquals(getNameIndex(self.loader), None)
+        buildNameIndex(self.loader)
+        for pattern in patterns:
+            for cutoff in (1.0, 0.95, 0.7, 0.5, 2):
+                self.assertEquals(self.search(pattern, cutoff),
+                                  expected[pattern, cutoff],
+                                  (pattern, cutoff))
+
+    def test_shortlist(self):
+        buildNameIndex(self.loader)
+        index = getNameIndex(self.loader)
+        self.assertEquals(sorted([pkg.name for pkg
+                                  in index.getPackages([("firefx", 0.7)])]),
+                          ["aaaa", "ab", "abxd", "fire", "firefox", "fox",
+                           "x"])
+        self.assertEquals(index.getPackages([("fire*", 0.7)]), None)
+        self.assertEquals(sorted([prv.name for prv in
+                                  index.getProvides([("thunderbird", 1.0)])]),
+                          ["thunderbird"])
+
+    def test_candidates(self):
+        self.assertEquals(getPackageCandidates(self.cache,
+                                               [("fire*", 1.0)]), None)
+        self.assertEquals(getNameIndex(self.loader), None)
+        # Names are looked up as the start of name-version strings.
+        self.assertEquals(sorted([pkg.name for pkg in
+                                  getPackageCandidates(self.cache,
+                                                       [("firefox", 1.0)])]),
+                          ["fire", "firefox", "fox"])
+        self.assertEquals(sorted([prv.name for prv in
+                                  getProvidesCandidates(self.cache,
+                                                        [("fox", 1.0)])]),
+                          ["fox"])
+        self.assertTrue(getNameIndex(self.loader))
+
+    def test_validity(self):
+        buildNameIndex(self.loader)
+        self.assertTrue(getNameIndex(self.loader))
+        pkg = self.loader.getPackages()[0]
+        self.loader.buildFileProvides(pkg, (Provides, "/usr/bin/foo", None))
+        self.assertEquals(getNameIndex(self.loader), None)
+
+    def test_saved_apart(self):
+        datadir = self.makeDir()
+        os.mkdir(os.path.join(datadir, "channels"))
+        sysconf.set("data-dir", datadir, soft=True)
+        self.addCleanup(sysconf.remove, "data-dir", soft=True)
+        channel = PackageChannel("test", "alias")
+        channel.getLoaders().append(self.loader)
+        self.loader.setChannel(channel)
+        buildNameIndex(self.loader)
+        cache = cPickle.loads(cPickle.dumps(self.cache, 2))
+        [loader] = cache._loaders
+        self.assertEquals(getNameIndex(loader), None)
+        index = getNameIndex(loader, build=True)
+        packages = index.getPackages([("firefx", 0.7)])
+        self.assertEquals(sorted([pkg.name for pkg in packages]),
+                          ["aaaa", "ab", "abxd", "fire", "firefox", "fox",
+                           "x"])
+        for pkg in packages:
+            self.assertTrue(pkg in loader.getPackages())
+        [prv] = index.getProvides([("thunderbird", 1.0)])
+        self.assertTrue(prv in cache.getProvides())
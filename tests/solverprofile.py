@@ -0,0 +1,102 @@
+import json
+import os
+
+from tests.mocker import MockerTestCase, ANY
+
+from smart.transaction import Transaction, ChangeSet, PolicyUpgrade, Failed
+from smart.cache import Cache
+from smart.const import UPGRADE
+from smart import sysconf, iface, solverprofile
+
+from tests.transaction import TestLoader, INSTALLED, AVAILABLE
+
+
+class SolverProfileTest(MockerTestCase):
+
+    def setUp(self):
+        self.cache = Cache()
+        self.cache.addLoader(TestLoader(INSTALLED, installed=True))
+        self.cache.addLoader(TestLoader(AVAILABLE))
+        self.cache.load()
+        self.trans = Transaction(self.cache, PolicyUpgrade)
+        for pkg in self.cache.getPackages():
+            if pkg.installed:
+                self.trans.enqueue(pkg, UPGRADE)
+        self.path = self.makeFile()
+        sysconf.set("profile-solver", self.path, soft=True)
+        del solverprofile._profiles[:]
+
+    def tearDown(self):
+        sysconf.remove("profile-solver", soft=True)
+        del solverprofile._profiles[:]
+
+    def test_dump(self):
+        self.trans.run()
+        [profile] = json.load(open(self.path))
+        self.assertEquals(profile["policy"], "PolicyUpgrade")
+        self.assertEquals(profile["changeset"], 3)
+        methods = profile["methods"]
+        self.assertEquals(methods["_upgrade"]["calls"], 1)
+        self.assertTrue(methods["_install"]["calls"] > 0)
+        self.assertTrue(methods["_install"]["failures"] > 0)
+        self.assertTrue(methods["getWeight"]["calls"] > 0)
+        self.assertEquals(methods["runStarting"]["calls"], 1)
+        self.assertEquals(sorted(profile["phases"]),
+                          ["_upgrade", "runStarting"])
+        self.assertEquals(profile["depths"]["0"], 1)
+        self.assertTrue(profile["changeset-copies"] > 0)
+        hits, misses = self.trans.getMemoStats()
+        self.assertEquals(profile["branches"]["explored"], misses)
+        self.assertEquals(profile["branches"]["memoized"], hits)
+        self.assertTrue(profile["branches"]["pruned"] > 0)
+
+    def test_pruned_counts_alternatives_not_taken(self):
+        profile = solverprofile.SolverProfile()
+        profile.attach(self.trans)
+        try:
+            a, b = ChangeSet(self.cache), ChangeSet(self.cache)
+            for cs in (a, b, a):
+                profile._checkAttempt((0, cs, {}))
+            ChangeSet(self.cache).setState(a)
+            ChangeSet(self.cache).setState(a)
+        finally:
+            profile.detach()
+        branches = profile.getProfile(self.trans)["branches"]
+        self.assertEquals(branches["pruned"], 1)
+
+    def test_dump_failure_keeps_solver_error(self):
+        self.path = os.path.join(self.makeDir(), "missing", "profile")
+        sysconf.set("profile-solver", self.path, soft=True)
+        error = Failed("solver error")
+        def fail():
+            raise error
+        self.trans._run = fail
+        iface_mock = self.mocker.patch(iface.object)
+        iface_mock.warning(ANY)
+        self.mocker.replay()
+        try:
+            self.trans.run()
+        except Failed, e:
+            self.assertTrue(e is error)
+        else:
+            self.fail("Failed not raised")
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_dump_keeps_previous_runs(self):
+        self.trans.run()
+        self.trans.run()
+        self.assertEquals(len(json.load(open(self.path))), 2)
+
+    def test_detach_restores_methods(self):
+        copy = ChangeSet.copy
+        setstate = ChangeSet.setState
+        self.trans.run()
+        self.assertEquals(ChangeSet.copy, copy)
+        self.assertEquals(ChangeSet.setState, setstate)
+        self.assertFalse("_install" in self.trans.__dict__)
+        self.assertFalse("getWeight" in self.trans.getPolicy().__dict__)
+
+    def test_disabled(self):
+        sysconf.remove("profile-solver", soft=True)
+        self.trans.run()
+        self.assertFalse(os.path.exists(self.path))
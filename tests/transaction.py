@@ -0,0 +1,345 @@
+from tests.mocker import MockerTestCase
+
+from smart.transaction import Transaction, ChangeSet, PolicyUpgrade, Failed
+from smart.transaction import getUpgradeComponents, checkChangeSet
+from smart.cache import Cache, Loader, Package, Provides, Requires
+from smart.cache import Upgrades, Conflicts
+from smart.channel import PackageChannel
+from smart.const import INSTALL, REMOVE, UPGRADE
+from smart import sysconf
+
+
+class TestRequires(Requires):
+
+    __slots__ = ()
+
+    def matches(self, prv):
+        return prv.name == self.name
+
+
+class TestUpgrades(Upgrades):
+
+    __slots__ = ()
+
+    def matches(self, prv):
+        return prv.name == self.name and prv.version < self.version
+
+
+class TestConflicts(Conflicts):
+
+    __slots__ = ()
+
+    def matches(self, prv):
+        return prv.name == self.name and prv.version < self.version
+
+
+class TestLoader(Loader):
+
+    def __init__(self, packages, installed=False):
+        Loader.__init__(self)
+        self._data = packages
+        self.setInstalled(installed)
+
+    def getChannel(self):
+        return PackageChannel("dummy", "test")
+
+    def load(self):
+        for name, version, provides, requires in self._data:
+            pkg = self.buildPackage((Package, name, version),
+                                    [(Provides, x, version)
+                                     for x in [name]+provides],
+                                    [(TestRequires, x, None, None)
+                                     for x in requires],
+                                    [(TestUpgrades, name, "<", version)],
+                                    [(TestConflicts, name, "<", version)])
+            pkg.loaders[self] = name
+
+
+INSTALLED = [("a", "1", [], []),
+             ("b", "1", [], [])]
+AVAILABLE = [("a", "2", [], ["lib"]),
+             ("b", "2", [], ["missing"]),
+             ("lib1", "1", ["lib"], []),
+             ("lib2", "1", ["lib"], [])]
+
+
+class TransactionMemoTest(MockerTestCase):
+
+    def setUp(self):
+        self.cache = Cache()
+        self.cache.addLoader(TestLoader(INSTALLED, installed=True))
+        self.cache.addLoader(TestLoader(AVAILABLE))
+        self.cache.load()
+        self.trans = Transaction(self.cache)
+        sysconf.set("solver-memo-size", 1000, soft=True)
+
+    def tearDown(self):
+        sysconf.remove("solver-memo-size", soft=True)
+
+    def get_package(self, name, version):
+        for pkg in self.cache.getPackages(name):
+            if pkg.version == version:
+                return pkg
+
+    def test_attempt_is_memoized(self):
+        pkg = self.get_package("lib1", "1")
+        changeset = ChangeSet(self.cache)
+        for i in range(3):
+            weight1, cs1, lk1 = self.trans._attempt(INSTALL, pkg,
+                                                    changeset, {})
+        weight2, cs2, lk2 = self.trans._attempt(INSTALL, pkg, changeset, {})
+        self.assertEquals(self.trans.getMemoStats(), (3, 1))
+        self.assertTrue(cs1 is cs2)
+        self.assertEquals(cs1.get(pkg), INSTALL)
+        self.assertEquals(changeset, {})
+
+    def test_attempt_with_different_state(self):
+        pkg = self.get_package("lib1", "1")
+        lib2 = self.get_package("lib2", "1")
+        changeset = ChangeSet(self.cache)
+        self.trans._attempt(INSTALL, pkg, changeset, {})
+        other = ChangeSet(self.cache)
+        other.set(lib2, INSTALL)
+        self.trans._attempt(INSTALL, pkg, other, {})
+        self.trans._attempt(INSTALL, pkg, changeset, {lib2: True})
+        self.trans._attempt(REMOVE, pkg, changeset, {})
+        other = ChangeSet(self.cache)
+        other.set(lib2, INSTALL)
+        other.setRequested(lib2, True)
+        self.trans._attempt(INSTALL, pkg, other, {})
+        self.assertEquals(self.trans.getMemoStats(), (0, 5))
+
+    def test_attempt_checks_state_on_same_sizes(self):
+        pkg = self.get_package("lib1", "1")
+        lib2 = self.get_package("lib2", "1")
+        changeset = ChangeSet(self.cache)
+        changeset.set(lib2, INSTALL)
+        other = ChangeSet(self.cache)
+        other.set(lib2, REMOVE)
+        self.trans._attempt(INSTALL, pkg, other, {})
+        weight, cs, lk = self.trans._attempt(INSTALL, pkg, changeset, {})
+        self.assertEquals(self.trans.getMemoStats(), (0, 2))
+        self.assertEquals(cs, {pkg: INSTALL, lib2: INSTALL})
+
+    def test_memo_size(self):
+        sysconf.set("solver-memo-size", 2, soft=True)
+        pkg = self.get_package("lib1", "1")
+        for name, version in [("lib2", "1"), ("a", "2"), ("b", "2")]:
+            changeset = ChangeSet(self.cache)
+            changeset.set(self.get_package(name, version), INSTALL)
+            for i in range(2):
+                self.trans._attempt(INSTALL, pkg, changeset, {})
+        self.assertEquals(self.trans.getMemoStats(), (3, 3))
+        self.assertEquals(self.trans._memoentries, 1)
+        self.assertEquals(len(self.trans._memo), 1)
+
+    def test_attempt_failure_is_memoized(self):
+        pkg = self.get_package("b", "2")
+        changeset = ChangeSet(self.cache)
+        for i in range(3):
+            self.assertRaises(Failed, self.trans._attempt,
+                              INSTALL, pkg, changeset, {})
+        self.assertEquals(self.trans.getMemoStats(), (2, 1))
+
+    def test_attempt_on_copied_changeset(self):
+        pkg = self.get_package("lib1", "1")
+        lib2 = self.get_package("lib2", "1")
+        changeset = ChangeSet(self.cache)
+        changeset.set(lib2, INSTALL)
+        weight1, cs1, lk1 = self.trans._attempt(INSTALL, pkg, changeset, {})
+        copy = changeset.copy()
+        copy.set(pkg, INSTALL)
+        copy.set(pkg, REMOVE)
+        weight2, cs2, lk2 = self.trans._attempt(INSTALL, pkg, copy, {})
+        self.assertEquals(self.trans.getMemoStats(), (1, 1))
+        self.assertTrue(cs1 is cs2)
+
+    def test_memo_disabled_by_default(self):
+        sysconf.remove("solver-memo-size", soft=True)
+        pkg = self.get_package("lib1", "1")
+        changeset = ChangeSet(self.cache)
+        for i in range(3):
+            self.trans._attempt(INSTALL, pkg, changeset, {})
+        self.assertEquals(self.trans.getMemoStats(), (0, 0))
+        self.assertEquals(self.trans._memo, {})
+
+    def test_run_resets_memo(self):
+        trans = Transaction(self.cache, PolicyUpgrade)
+        trans.enqueue(self.get_package("a", "1"), UPGRADE)
+        trans.enqueue(self.get_package("b", "1"), UPGRADE)
+        trans.run()
+        hits, misses = trans.getMemoStats()
+        self.assertTrue(misses > 0)
+        self.assertEquals(trans._memo, {})
+        changeset = trans.getChangeSet()
+        self.assertEquals(changeset.get(self.get_package("a", "2")), INSTALL)
+        self.assertEquals(changeset.get(self.get_package("a", "1")), REMOVE)
+        self.assertEquals(changeset.get(self.get_package("b", "2")), None)
+        trans.run()
+        self.assertEquals(trans.getMemoStats(), (0, 0))
+
+
+PARALLEL_INSTALLED = [("a", "1", [], []),
+                      ("b", "1", [], []),
+                      ("c", "1", [], []),
+                      ("d", "1", [], [])]
+PARALLEL_AVAILABLE = [("a", "2", [], ["liba"]),
+                      ("b", "2", [], ["missing"]),
+                      ("c", "2", [], ["libc"]),
+                      ("d", "2", [], ["liba"]),
+                      ("liba", "1", [], []),
+                      ("libc", "1", [], [])]
+
+
+class ParallelUpgradeTest(MockerTestCase):
+
+    def setUp(self):
+        self.cache = Cache()
+        self.cache.addLoader(TestLoader(PARALLEL_INSTALLED, installed=True))
+        self.cache.addLoader(TestLoader(PARALLEL_AVAILABLE))
+        self.cache.load()
+
+    def get_package(self, name, version):
+        for pkg in self.cache.getPackages(name):
+            if pkg.version == version:
+                return pkg
+
+    def get_upgrades(self):
+        return [self.get_package(name, "2") for name in "abcd"]
+
+    def run_upgrade(self, jobs):
+        sysconf.set("upgrade-jobs", jobs, soft=True)
+        try:
+            trans = Transaction(self.cache, PolicyUpgrade)
+            for pkg in self.cache.getPackages():
+                if pkg.installed:
+                    trans.enqueue(pkg, UPGRADE)
+            trans.run()
+            return trans.getChangeSet()
+        finally:
+            sysconf.remove("upgrade-jobs", soft=True)
+
+    def test_components(self):
+        a, b, c, d = self.get_upgrades()
+        components = getUpgradeComponents(self.cache, [a, b, c, d])
+        self.assertEquals(sorted(sorted(str(pkg) for pkg in component)
+                                 for component in components),
+                          [["a-2", "d-2"], ["b-2"], ["c-2"]])
+
+    def test_parallel_upgrade(self):
+        trans = Transaction(self.cache, PolicyUpgrade)
+        pkgs = self.get_upgrades()
+        for pkg in pkgs:
+            trans.getQueue()[pkg] = UPGRADE
+        trans.getPolicy().runStarting()
+        changeset = ChangeSet(self.cache)
+        self.assertTrue(trans._parallelUpgrade(pkgs, changeset, {}, 2))
+        self.assertEquals(sorted((str(pkg), str(op))
+                                 for pkg, op in changeset.items()),
+                          [("a-1", "REMOVE"), ("a-2", "INSTALL"),
+                           ("c-1", "REMOVE"), ("c-2", "INSTALL"),
+                           ("d-1", "REMOVE"), ("d-2", "INSTALL"),
+                           ("liba-1", "INSTALL"), ("libc-1", "INSTALL")])
+
+    def test_parallel_matches_serial(self):
+        serial = self.run_upgrade(1)
+        self.assertEquals(len(serial), 8)
+        self.assertEquals(self.run_upgrade(2), serial)
+
+    def test_check_changeset(self):
+        a = self.get_package("a", "2")
+        liba = self.get_package("liba", "1")
+        changeset = ChangeSet(self.cache)
+        changeset.set(a, INSTALL)
+        self.assertFalse(checkChangeSet(self.cache, changeset, [a]))
+        changeset.set(liba, INSTALL)
+        # a-2 conflicts with a-1, which is still installed.
+        self.assertFalse(checkChangeSet(self.cache, changeset, [a]))
+        a1 = self.get_package("a", "1")
+        changeset.set(a1, REMOVE)
+        self.assertTrue(checkChangeSet(self.cache, changeset, [a, a1]))
+        changeset.set(liba, REMOVE)
+        self.assertFalse(checkChangeSet(self.cache, changeset, [a, a1]))
+
+
+class ChangeSetTest(MockerTestCase):
+
+    def setUp(self):
+        self.cache = Cache()
+        self.cache.addLoader(TestLoader(INSTALLED, installed=True))
+        self.cache.addLoader(TestLoader(AVAILABLE))
+        self.cache.load()
+        self.pkgs = sorted(self.cache.getPackages(), key=str)
+
+    def test_copy_is_independent(self):
+        a1, a2, b1, b2, lib1, lib2 = self.pkgs
+        changeset = ChangeSet(self.cache)
+        changeset[a2] = INSTALL
+        changeset[a1] = REMOVE
+        copy = changeset.copy()
+        changeset[lib1] = INSTALL
+        del changeset[a1]
+        copy[lib2] = INSTALL
+        self.assertEquals(changeset, {a2: INSTALL, lib1: INSTALL})
+        self.assertEquals(copy, {a2: INSTALL, a1: REMOVE, lib2: INSTALL})
+        self.assertEquals(len(changeset), 2)
+        self.assertEquals(len(copy), 3)
+        self.assertTrue(a1 not in changeset)
+        self.assertRaises(KeyError, changeset.__getitem__, a1)
+        self.assertRaises(KeyError, changeset.__delitem__, a1)
+        self.assertEquals(sorted(str(pkg) for pkg in copy),
+                          ["a-1", "a-2", "lib2-1"])
+
+    def test_copies_compare_equal(self):
+        a1, a2, b1, b2, lib1, lib2 = self.pkgs
+        changeset = ChangeSet(self.cache)
+        changeset[a2] = INSTALL
+        copy = changeset.copy()
+        self.assertTrue(copy == changeset)
+        copy[lib1] = INSTALL
+        self.assertFalse(copy == changeset)
+        del copy[lib1]
+        self.assertTrue(copy == changeset)
+        copy[a2] = REMOVE
+        self.assertTrue(copy != changeset)
+
+    def test_deep_copies_keep_contents(self):
+        changeset = ChangeSet(self.cache)
+        copies = []
+        for i in range(20):
+            pkg = self.pkgs[i % len(self.pkgs)]
+            if pkg in changeset:
+                del changeset[pkg]
+            else:
+                changeset[pkg] = INSTALL
+            copies.append((changeset.copy(), dict(changeset.items())))
+        for copy, items in copies:
+            self.assertEquals(dict(copy.items()), items)
+
+    def test_difference(self):
+        a1, a2, b1, b2, lib1, lib2 = self.pkgs
+        changeset = ChangeSet(self.cache)
+        changeset[a2] = INSTALL
+        changeset[a1] = REMOVE
+        copy = changeset.copy()
+        copy[lib1] = INSTALL
+        copy[a1] = INSTALL
+        self.assertEquals(copy.difference(changeset),
+                          {lib1: INSTALL, a1: INSTALL})
+        self.assertEquals(changeset.difference(copy), {a1: REMOVE})
+        other = ChangeSet(self.cache, {a2: INSTALL})
+        self.assertEquals(copy.difference(other),
+                          {lib1: INSTALL, a1: INSTALL})
+
+    def test_requested_is_not_shared(self):
+        a1, a2, b1, b2, lib1, lib2 = self.pkgs
+        changeset = ChangeSet(self.cache)
+        changeset[a2] = INSTALL
+        changeset.setRequested(a2, True)
+        copy = changeset.copy()
+        copy[lib1] = INSTALL
+        copy.setRequested(lib1, True)
+        copy.setRequested(a2, False)
+        self.assertTrue(changeset.getRequested(a2))
+        self.assertFalse(changeset.getRequested(lib1))
+        self.assertFalse(copy.getRequested(a2))
@@ -1,7 +1,7 @@
 import unittest
 import os
 
-from smart.uncompress import Uncompressor
+from smart.uncompress import Uncompressor, uncompressFile
 
 from tests import TESTDATADIR
 
@@ -44,3 +44,42 @@ class UncompressorTest(unittest.TestCase):
     def test_7zip(self):
         self.uncompress_file("%s/uncompress/test.7z" % TESTDATADIR)
 
+    def stream_file(self, file, copies=1):
+        handler = Uncompressor().getHandler(file)
+        stream = handler.getStreamUncompressor(file)
+        data = open(file).read()*copies
+        for i in range(0, len(data), 7):
+            stream.write(data[i:i+7])
+        path = "%s/uncompress/test" % TESTDATADIR
+        self.assertEquals(stream.close(), path)
+        orig = open("%s/uncompress/test.txt" % TESTDATADIR).read()
+        self.assertEquals(open(path).read(), orig*copies)
+
+    def test_stream_gzip(self):
+        self.stream_file("%s/uncompress/test.gz" % TESTDATADIR)
+
+    def test_stream_bzip2(self):
+        self.stream_file("%s/uncompress/test.bz2" % TESTDATADIR)
+
+    def test_stream_concatenated(self):
+        self.stream_file("%s/uncompress/test.gz" % TESTDATADIR, copies=2)
+        self.stream_file("%s/uncompress/test.bz2" % TESTDATADIR, copies=2)
+
+    def test_stream_corrupted(self):
+        file = "%s/uncompress/test.gz" % TESTDATADIR
+        stream = Uncompressor().getHandler(file).getStreamUncompressor(file)
+        stream.write("Not compressed at all.")
+        self.assertEquals(stream.close(), None)
+        self.assertFalse(os.path.exists("%s/uncompress/test.part"
+                                        % TESTDATADIR))
+
+    def test_stream_unsupported(self):
+        file = "%s/uncompress/test.zip" % TESTDATADIR
+        handler = Uncompressor().getHandler(file)
+        self.assertEquals(handler.getStreamUncompressor(file), None)
+
+    def test_uncompress_file(self):
+        self.assertEquals(
+            uncompressFile("%s/uncompress/test.gz" % TESTDATADIR), None)
+        self.assertTrue(uncompressFile("%s/uncompress/missing.gz"
+                                       % TESTDATADIR))
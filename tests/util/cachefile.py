@@ -0,0 +1,43 @@
+import cPickle
+import os
+
+from tests.mocker import MockerTestCase
+
+from smart.util.cachefile import dumpCacheFile, loadCacheFile
+from smart.util.cachefile import CacheFileError
+
+
+class CacheFileTest(MockerTestCase):
+
+    def setUp(self):
+        self.path = self.makeFile()
+
+    def test_dump_and_load(self):
+        state = ({"a": [1, 2, 3]}, "b", (None, 1.5))
+        dumpCacheFile(self.path, state, 1)
+        self.assertEquals(loadCacheFile(self.path, 1), state)
+
+    def test_dump_is_atomic(self):
+        dumpCacheFile(self.path, "state", 1)
+        self.assertFalse(os.path.exists(self.path+".new"))
+
+    def test_load_with_different_state_version(self):
+        dumpCacheFile(self.path, "state", 1)
+        self.assertRaises(CacheFileError, loadCacheFile, self.path, 2)
+
+    def test_load_old_plain_pickle(self):
+        file = open(self.path, "w")
+        cPickle.dump((1, "state"), file, 2)
+        file.close()
+        self.assertRaises(CacheFileError, loadCacheFile, self.path, 1)
+
+    def test_load_empty_file(self):
+        open(self.path, "w").close()
+        self.assertRaises(CacheFileError, loadCacheFile, self.path, 1)
+
+    def test_load_keeps_gc_state(self):
+        dumpCacheFile(self.path, "state", 1)
+        import gc
+        self.assertTrue(gc.isenabled())
+        loadCacheFile(self.path, 1)
+        self.assertTrue(gc.isenabled())
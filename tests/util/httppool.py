@@ -0,0 +1,156 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+
+from tests.mocker import MockerTestCase
+
+from smart.util.httppool import HTTPConnectionPool, MAXREDIRECTS
+
+
+class KeepAliveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Closed connections are expected while testing.
+        pass
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.client_address)
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("x-test")))
+        self.server.auths.append(self.headers.get("authorization"))
+        location = {"/redirect": "/target",
+                    "/loop": "/loop",
+                    "/elsewhere": "http://localhost:%d/target"
+                                  % self.server.server_address[1]}
+        if self.path in location:
+            self.send_response(302)
+            self.send_header("Location", location[self.path])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path == "/missing":
+            body = "Not here"
+            self.send_response(404)
+        else:
+            body = "Content of %s" % self.path
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPConnectionPoolTest(MockerTestCase):
+
+    def setUp(self):
+        self.server = KeepAliveServer(("127.0.0.1", 0), KeepAliveHandler)
+        self.server.connections = []
+        self.server.requests = []
+        self.server.auths = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.pool = HTTPConnectionPool(maxperhost=1)
+
+    def tearDown(self):
+        self.pool.closeIdle()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, path, headers=()):
+        remote = self.pool.open(self.url+path, headers)
+        try:
+            return remote.read()
+        finally:
+            remote.close()
+
+    def test_connection_is_reused(self):
+        self.assertEquals(self.fetch("/a"), "Content of /a")
+        self.assertEquals(self.fetch("/b", [("X-Test", "yes")]),
+                          "Content of /b")
+        self.assertEquals(self.server.requests, [("/a", None),
+                                                 ("/b", "yes")])
+        self.assertEquals(len(self.server.connections), 1)
+        self.assertEquals(self.pool.getIdleCount(), 1)
+
+    def test_error_response(self):
+        remote = self.pool.open(self.url+"/missing")
+        self.assertEquals(remote.errcode, 404)
+        self.assertEquals(remote.errmsg, "Not Found")
+        remote.close()
+        # The error page was drained, so the connection is still good.
+        self.assertEquals(self.fetch("/a"), "Content of /a")
+        self.assertEquals(len(self.server.connections), 1)
+
+    def test_redirect(self):
+        remote = self.pool.open(self.url+"/redirect")
+        self.assertEquals(remote.geturl(), self.url+"/target")
+        self.assertFalse(hasattr(remote, "errcode"))
+        self.assertEquals(remote.read(), "Content of /target")
+        remote.close()
+
+    def test_redirect_keeps_credentials_on_same_origin(self):
+        remote = self.pool.open(self.url+"/redirect", user="user",
+                                passwd="secret")
+        remote.close()
+        self.assertEquals(self.server.auths,
+                          ["Basic dXNlcjpzZWNyZXQ="]*2)
+
+    def test_redirect_drops_credentials_on_other_origin(self):
+        remote = self.pool.open(self.url+"/elsewhere", user="user",
+                                passwd="secret")
+        self.assertEquals(remote.read(), "Content of /target")
+        remote.close()
+        self.assertEquals(self.server.auths,
+                          ["Basic dXNlcjpzZWNyZXQ=", None])
+
+    def test_too_many_redirects(self):
+        try:
+            self.pool.open(self.url+"/loop")
+        except IOError, e:
+            self.assertEquals(e.args, ("http error", "too many redirects"))
+        else:
+            self.fail("IOError not raised")
+        self.assertEquals(len(self.server.requests), MAXREDIRECTS+1)
+
+    def test_unread_response_is_not_reused(self):
+        remote = self.pool.open(self.url+"/a")
+        remote.fp.length = 1000000
+        remote.close()
+        self.assertEquals(self.pool.getIdleCount(), 0)
+
+    def test_stale_connection_is_replaced(self):
+        self.fetch("/a")
+        [[conn]] = self.pool._idle.values()
+        conn.sock.close()
+        self.assertEquals(self.fetch("/b"), "Content of /b")
+        self.assertEquals(len(self.server.connections), 2)
+
+    def test_limit_per_host(self):
+        remote = self.pool.open(self.url+"/a")
+        result = []
+        def fetch():
+            result.append(self.fetch("/b"))
+        thread = threading.Thread(target=fetch)
+        thread.start()
+        time.sleep(0.2)
+        self.assertEquals(result, [])
+        remote.read()
+        remote.close()
+        thread.join()
+        self.assertEquals(result, ["Content of /b"])
+        self.assertEquals(len(self.server.connections), 1)
@@ -0,0 +1,78 @@
+import threading
+
+from tests.mocker import MockerTestCase
+
+from smart.util.mainthread import MainThreadCalls
+
+
+class Recorder(object):
+
+    size = 3
+
+    def __init__(self):
+        self.threads = []
+
+    def record(self, value):
+        self.threads.append(threading.currentThread())
+        return value
+
+    def fail(self):
+        raise ValueError("failed")
+
+    def other(self):
+        return Recorder()
+
+
+class MainThreadCallsTest(MockerTestCase):
+
+    def setUp(self):
+        self.calls = MainThreadCalls()
+        self.recorder = Recorder()
+        self.proxy = self.calls.wrap(self.recorder)
+
+    def run_threads(self, target, count=3):
+        threads = []
+        for i in range(count):
+            thread = threading.Thread(target=target)
+            thread.start()
+            threads.append(thread)
+        self.calls.join(threads)
+
+    def test_calls_run_in_creating_thread(self):
+        results = []
+        def target():
+            results.append(self.proxy.record(1))
+        self.run_threads(target)
+        self.assertEquals(results, [1, 1, 1])
+        self.assertEquals(self.recorder.threads,
+                          [threading.currentThread()]*3)
+
+    def test_call_in_creating_thread(self):
+        self.assertEquals(self.proxy.record(2), 2)
+        self.assertEquals(self.recorder.threads,
+                          [threading.currentThread()])
+
+    def test_exceptions_reach_caller(self):
+        errors = []
+        def target():
+            try:
+                self.proxy.fail()
+            except ValueError, e:
+                errors.append(str(e))
+        self.run_threads(target, 1)
+        self.assertEquals(errors, ["failed"])
+
+    def test_attributes(self):
+        self.assertEquals(self.proxy.size, 3)
+
+    def test_results_of_types_are_wrapped(self):
+        self.assertTrue(isinstance(self.proxy.other(), Recorder))
+        proxy = self.calls.wrap(self.recorder, Recorder)
+        other = proxy.other()
+        self.assertFalse(isinstance(other, Recorder))
+        def target():
+            other.record(1)
+            other.other().record(2)
+        self.run_threads(target, 1)
+        self.assertEquals(other._object.threads,
+                          [threading.currentThread()])
@@ -0,0 +1,78 @@
+import cPickle
+from StringIO import StringIO
+
+from tests.mocker import MockerTestCase
+
+from smart.util.tagfile import TagFile, TagSection
+
+
+SECTIONS = """\
+Package: first
+Version: 1.0
+Description: Summary
+ Long description
+ .
+ more.
+
+Package: second
+Depends: first (>= 1.0),
+ other
+
+Package: third
+Version: 3.0"""
+
+
+class TagFileTest(MockerTestCase):
+
+    def setUp(self):
+        self.path = self.makeFile(SECTIONS)
+
+    def get_offsets(self, tagfile):
+        offsets = []
+        offset = tagfile.getOffset()
+        while tagfile.advanceSection():
+            offsets.append(offset)
+            offset = tagfile.getOffset()
+        return offsets
+
+    def test_sections(self):
+        tagfile = TagFile(self.path)
+        self.assertEquals(self.get_offsets(tagfile), [0, 78, 127])
+        tagfile.setOffset(0)
+        tagfile.advanceSection()
+        self.assertEquals(tagfile.copy(),
+                          {"package": "first", "version": "1.0",
+                           "description": "Summary\nLong description\n\nmore."})
+        tagfile.advanceSection()
+        self.assertEquals(tagfile.get("depends"), "first (>= 1.0),\nother")
+
+    def test_same_sections_from_file_objects(self):
+        tagfile = TagFile(self.path)
+        fileobj = TagFile(StringIO(SECTIONS))
+        self.assertEquals(self.get_offsets(tagfile),
+                          self.get_offsets(fileobj))
+        for offset in [78, 0]:
+            tagfile.setOffset(offset)
+            tagfile.advanceSection()
+            fileobj.setOffset(offset)
+            fileobj.advanceSection()
+            self.assertEquals(tagfile.copy(), fileobj.copy())
+
+    def test_get_field(self):
+        tagfile = TagFile(self.path)
+        self.assertEquals(tagfile.getField(127, "version"), "3.0")
+        self.assertEquals(tagfile.getField(0, "description"),
+                          "Summary\nLong description\n\nmore.")
+        self.assertEquals(tagfile.getField(78, "version"), None)
+        self.assertEquals(tagfile.getField(78, "depends"),
+                          "first (>= 1.0),\nother")
+
+    def test_pickled(self):
+        tagfile = cPickle.loads(cPickle.dumps(TagFile(self.path), 2))
+        self.assertEquals(tagfile.getField(0, "package"), "first")
+
+    def test_section(self):
+        section = TagSection(TagFile(self.path), 78)
+        self.assertEquals(section.get("package"), "second")
+        self.assertEquals(section.get("version"), None)
+        self.assertEquals(section.get("version", "0"), "0")